@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import numpy as np
+
+# Compact image <-> article mapping built once from database.json, where every
+# article lists the ids of its images. Both directions are CSR arrays:
+#   image_ids[i] belongs to article_ids[image_articles[image_offsets[i]:image_offsets[i + 1]]]
+#   article_ids[a] holds image_ids[article_images[article_offsets[a]:article_offsets[a + 1]]]
+FUSIONS = ('max', 'sum', 'rrf')
+
+
+class ArticleIndex():
+    def __init__(self, article_ids, image_ids, image_offsets, image_articles, article_offsets, article_images):
+        self.article_ids = article_ids
+        self.image_ids = image_ids
+        self.image_offsets = image_offsets
+        self.image_articles = image_articles
+        self.article_offsets = article_offsets
+        self.article_images = article_images
+        self.image_index = {image_id: row for row, image_id in enumerate(image_ids.tolist())}
+        self.article_index = {article_id: row for row, article_id in enumerate(article_ids.tolist())}
+
+    @classmethod
+    def from_database(cls, database):
+        article_ids = list(database)
+        pair_images, pair_articles = [], []
+        image_index = {}
+        for article_code, article_id in enumerate(article_ids):
+            for image_id in dict.fromkeys(database[article_id].get('images', [])):
+                pair_images.append(image_index.setdefault(image_id, len(image_index)))
+                pair_articles.append(article_code)
+        pair_images = np.asarray(pair_images, dtype=np.int32)
+        pair_articles = np.asarray(pair_articles, dtype=np.int32)
+
+        def csr(keys, values, num_keys):
+            order = np.argsort(keys, kind='stable')
+            offsets = np.zeros(num_keys + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum(np.bincount(keys, minlength=num_keys))
+            return offsets, values[order]
+
+        image_offsets, image_articles = csr(pair_images, pair_articles, len(image_index))
+        article_offsets, article_images = csr(pair_articles, pair_images, len(article_ids))
+        return cls(np.asarray(article_ids, dtype=str), np.asarray(list(image_index), dtype=str),
+                   image_offsets, image_articles, article_offsets, article_images)
+
+    def save(self, path):
+        np.savez(path, article_ids=self.article_ids, image_ids=self.image_ids,
+                 image_offsets=self.image_offsets, image_articles=self.image_articles,
+                 article_offsets=self.article_offsets, article_images=self.article_images)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['article_ids'], data['image_ids'], data['image_offsets'], data['image_articles'],
+                   data['article_offsets'], data['article_images'])
+
+    def articles_of(self, image_id):
+        row = self.image_index.get(image_id)
+        if row is None:
+            return []
+        return self.article_ids[self.image_articles[self.image_offsets[row]:self.image_offsets[row + 1]]].tolist()
+
+    def images_of(self, article_id):
+        row = self.article_index.get(article_id)
+        if row is None:
+            return []
+        return self.image_ids[self.article_images[self.article_offsets[row]:self.article_offsets[row + 1]]].tolist()
+
+    def fuse(self, candidate_ids, topk_indices, topk_similarities, top_k=10, fusion='max', rrf_k=60):
+        """Article-level top-k of every query from its image-level top-k.
+
+        candidate_ids: database image ids that topk_indices point into.
+        fusion: 'max' (best image score), 'sum' (sum of image scores) or
+        'rrf' (reciprocal rank fusion, sum of 1 / (rrf_k + rank)).
+        Returns (article_codes, fused_scores), both (Q, top_k); missing entries are -1 / -inf.
+        """
+        topk_indices = np.asarray(topk_indices)
+        scores = np.asarray(topk_similarities, dtype=np.float64)
+        num_queries, k = topk_indices.shape
+
+        # Map each distinct candidate once to its row in this index (-1 if it has no article
+        # or is search padding).
+        used, codes = np.unique(topk_indices, return_inverse=True)
+        used_rows = np.asarray([self.image_index.get(candidate_ids[idx], -1) if idx >= 0 else -1
+                                for idx in used.tolist()], dtype=np.int64)
+        image_rows = used_rows[codes.reshape(-1)]
+        if fusion == 'rrf':
+            scores = np.broadcast_to(1.0 / (rrf_k + np.arange(1, k + 1)), (num_queries, k))
+        scores = scores.reshape(-1)
+        query_rows = np.repeat(np.arange(num_queries), k)
+        valid = image_rows >= 0
+        image_rows, scores, query_rows = image_rows[valid], scores[valid], query_rows[valid]
+
+        # Expand every (query, image) hit to one entry per article of the image.
+        starts, ends = self.image_offsets[image_rows], self.image_offsets[image_rows + 1]
+        counts = ends - starts
+        pair_positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        articles = self.image_articles[pair_positions].astype(np.int64)
+        query_rows, scores = np.repeat(query_rows, counts), np.repeat(scores, counts)
+
+        # Aggregate per (query, article).
+        keys, group = np.unique(query_rows * len(self.article_ids) + articles, return_inverse=True)
+        if fusion == 'max':
+            fused = np.full(len(keys), -np.inf)
+            np.maximum.at(fused, group, scores)
+        elif fusion in ('sum', 'rrf'):
+            fused = np.zeros(len(keys))
+            np.add.at(fused, group, scores)
+        else:
+            raise ValueError(f"Unsupported fusion: {fusion}. Choose from {FUSIONS}")
+        key_queries, key_articles = keys // len(self.article_ids), keys % len(self.article_ids)
+
+        # Best articles first within each query, then keep the first top_k of each query.
+        order = np.lexsort((-fused, key_queries))
+        key_queries, key_articles, fused = key_queries[order], key_articles[order], fused[order]
+        group_starts = np.searchsorted(key_queries, np.arange(num_queries))
+        positions = np.arange(len(key_queries)) - group_starts[key_queries]
+        keep = positions < top_k
+
+        article_codes = np.full((num_queries, top_k), -1, dtype=np.int64)
+        fused_scores = np.full((num_queries, top_k), -np.inf)
+        article_codes[key_queries[keep], positions[keep]] = key_articles[keep]
+        fused_scores[key_queries[keep], positions[keep]] = fused[keep]
+        return article_codes, fused_scores
+
+
+def load_article_index(database_json, index_path=None):
+    """Load the reverse index next to database.json, (re)building it when missing or outdated."""
+    index_path = index_path or os.path.splitext(database_json)[0] + '_article_index.npz'
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(database_json):
+        return ArticleIndex.load(index_path)
+    with open(database_json, 'r', encoding='utf-8') as f:
+        database = json.load(f)
+    index = ArticleIndex.from_database(database)
+    index.save(index_path)
+    print(f"Saved article index ({len(index.article_ids)} articles, {len(index.image_ids)} images) to {index_path}")
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the image -> article reverse index from database.json")
+    parser.add_argument('--database_json', type=str, default='./data/database/database.json')
+    parser.add_argument('--index_path', type=str, default=None,
+                        help="Output .npz (default: <database>_article_index.npz next to database.json)")
+    args = parser.parse_args()
+    load_article_index(args.database_json, args.index_path)
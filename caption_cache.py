@@ -0,0 +1,74 @@
+import hashlib
+import json
+import os
+import diskcache
+from embedding_manifest import file_content_hash
+
+
+class CaptionCache():
+    """Persistent, size-bounded LRU cache of generated captions.
+
+    Keys combine the image content hash with the model name, prompt and
+    generation config, so a caption is reused for the same pixels wherever
+    the file lives and regenerated as soon as any generation input changes.
+    """
+
+    def __init__(self, directory='./cache/captions', size_limit_gb=2.0):
+        self.cache = diskcache.Cache(directory, size_limit=int(size_limit_gb * 2**30),
+                                     eviction_policy='least-recently-used')
+        self.hits = 0
+        self.misses = 0
+        self._image_hashes = {}
+
+    def image_hash(self, image_path):
+        stat = os.stat(image_path)
+        memo_key = (os.path.abspath(image_path), stat.st_size, stat.st_mtime_ns)
+        if memo_key not in self._image_hashes:
+            self._image_hashes[memo_key] = file_content_hash(image_path)
+        return self._image_hashes[memo_key]
+
+    @staticmethod
+    def key(image_hash, model_name, prompt, generation_config):
+        payload = json.dumps([image_hash, model_name, prompt, generation_config], sort_keys=True)
+        return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+    def lookup(self, image_path, model_name, prompt, generation_config):
+        """Cached caption or None, without generating anything."""
+        caption = self.cache.get(self.key(self.image_hash(image_path), model_name, prompt, generation_config))
+        if caption is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return caption
+
+    def get_or_generate(self, image_path, model_name, prompt, generation_config, generate):
+        """Return the cached caption, or call generate() and cache its result (failures are not cached)."""
+        key = self.key(self.image_hash(image_path), model_name, prompt, generation_config)
+        caption = self.cache.get(key)
+        if caption is not None:
+            self.hits += 1
+            return caption
+        self.misses += 1
+        caption = generate()
+        self.cache.set(key, caption)
+        return caption
+
+    def put(self, image_path, model_name, prompt, generation_config, caption):
+        """Store a caption generated elsewhere under the key get_or_generate would use."""
+        self.cache.set(self.key(self.image_hash(image_path), model_name, prompt, generation_config), caption)
+
+    def report(self):
+        total = self.hits + self.misses
+        print(f"🗂️ Caption cache: {self.hits} hits, {self.misses} misses "
+              f"({self.hits / max(total, 1):.1%} hit rate), {len(self.cache)} entries, "
+              f"{self.cache.volume() / 2**20:.1f} MiB on disk")
+
+    def close(self):
+        self.cache.close()
+
+
+def open_caption_cache(directory, size_limit_gb=2.0):
+    """CaptionCache in `directory`, or None when caching is disabled (empty directory)."""
+    if not directory:
+        return None
+    return CaptionCache(directory, size_limit_gb=size_limit_gb)
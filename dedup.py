@@ -0,0 +1,135 @@
+import argparse
+import os
+import numpy as np
+import torch
+from embedding_store import EmbeddingStore, EmbeddingStoreWriter
+from knn_graph import build_knn_graph
+
+# A deduplicated store holds one row per near-duplicate cluster plus
+# clusters.npz, which maps every original image id to its representative:
+#   ids[i] is represented by ids[representative[i]] (a representative points to itself)
+CLUSTERS_FILE = 'clusters.npz'
+
+
+def union_find(num_rows, pairs):
+    """Connected components of the (a, b) pairs; every row is labelled with the smallest row of its component."""
+    labels = np.arange(num_rows)
+    if len(pairs) == 0:
+        return labels
+    a, b = pairs[:, 0], pairs[:, 1]
+    while True:
+        # Hook both ends of every edge onto the smaller root, then compress paths.
+        roots = np.minimum(labels[a], labels[b])
+        previous = labels.copy()
+        np.minimum.at(labels, labels[a], roots)
+        np.minimum.at(labels, labels[b], roots)
+        while not np.array_equal(labels, labels[labels]):
+            labels = labels[labels]
+        if np.array_equal(labels, previous):
+            return labels
+
+
+def near_duplicate_pairs(embeddings, threshold=0.95, k=16, device='cpu', max_memory_mb=4096):
+    """(P, 2) row pairs whose cosine similarity is at least `threshold`, from a blocked kNN self-join."""
+    neighbors, similarities = build_knn_graph(embeddings, k=k, device=device, max_memory_mb=max_memory_mb)
+    rows = torch.arange(len(neighbors)).unsqueeze(1).expand_as(neighbors)
+    hit = similarities >= threshold
+    return torch.stack([rows[hit], neighbors[hit]], dim=1).numpy()
+
+
+class DuplicateClusters():
+    def __init__(self, ids, representative):
+        self.ids = list(ids)
+        self.representative = np.asarray(representative, dtype=np.int64)
+        self.index = {image_id: row for row, image_id in enumerate(self.ids)}
+        # Members of every cluster, representative first.
+        order = np.argsort(self.representative, kind='stable')
+        boundaries = np.flatnonzero(np.diff(self.representative[order])) + 1
+        self.members = {
+            self.ids[group[0]]: [self.ids[row] for row in group]
+            for group in np.split(order, boundaries) if len(group)
+        }
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['ids'].tolist(), data['representative'])
+
+    def save(self, path):
+        np.savez(path, ids=np.asarray(self.ids, dtype=str), representative=self.representative)
+
+    def __len__(self):
+        return len(self.members)
+
+    def representative_of(self, image_id):
+        row = self.index.get(image_id)
+        return image_id if row is None else self.ids[self.representative[row]]
+
+    def expand(self, image_ids):
+        """Replace every representative by all members of its cluster, keeping the ranking."""
+        return [member for image_id in image_ids for member in self.members.get(image_id, [image_id])]
+
+    def expand_topk(self, representative_ids, topk_indices, topk_similarities, k):
+        """Expand (Q, k) results over representatives into (Q, k) results over all ids.
+
+        Members inherit the score of their representative. Returns (ids, indices, similarities)
+        where indices point into `ids`.
+        """
+        expanded_indices, expanded_similarities = [], []
+        for indices, similarities in zip(topk_indices.tolist(), topk_similarities.tolist()):
+            rows, scores = [], []
+            for idx, score in zip(indices, similarities):
+                if idx < 0:  # padding of a search with fewer than k reachable rows
+                    continue
+                members = self.members.get(representative_ids[idx], [representative_ids[idx]])
+                rows.extend(self.index.get(member, -1) for member in members)
+                scores.extend([score] * len(members))
+            expanded_indices.append((rows + [-1] * k)[:k])
+            expanded_similarities.append((scores + [float('-inf')] * k)[:k])
+        return (self.ids, torch.tensor(expanded_indices, dtype=torch.long),
+                torch.tensor(expanded_similarities, dtype=topk_similarities.dtype))
+
+
+def load_clusters(folder):
+    """Clusters of a deduplicated store, or None for a plain store."""
+    path = os.path.join(folder, CLUSTERS_FILE) if folder else None
+    if path is None or not os.path.exists(path):
+        return None
+    return DuplicateClusters.load(path)
+
+
+def deduplicate_store(input_folder, output_folder, threshold=0.95, k=16, device='cpu', batch_size=65536):
+    store = EmbeddingStore(input_folder)
+    embeddings = store.as_tensor('cpu')
+    pairs = near_duplicate_pairs(embeddings, threshold=threshold, k=k, device=device)
+    representative = union_find(len(store), pairs)
+    clusters = DuplicateClusters(store.ids, representative)
+
+    representative_rows = np.flatnonzero(representative == np.arange(len(store)))
+    with EmbeddingStoreWriter(output_folder, dtype=store.embeddings.dtype) as writer:
+        for start in range(0, len(representative_rows), batch_size):
+            rows = representative_rows[start:start + batch_size]
+            writer.append([store.ids[row] for row in rows], store.embeddings[rows])
+    clusters.save(os.path.join(output_folder, CLUSTERS_FILE))
+
+    num_duplicates = len(store) - len(representative_rows)
+    print(f"✅ {len(store)} images -> {len(representative_rows)} clusters "
+          f"({num_duplicates} near-duplicates, {num_duplicates / max(len(store), 1):.1%}) saved to {output_folder}")
+    return clusters
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Group near-duplicate database images and keep one representative each")
+    parser.add_argument('--input_folder', type=str, default='./embeddings/database_image_internVL_g/',
+                        help="Embedding store to deduplicate")
+    parser.add_argument('--output_folder', type=str, default='./embeddings/database_image_internVL_g_dedup/',
+                        help="Store with one row per cluster, plus clusters.npz")
+    parser.add_argument('--threshold', type=float, default=0.95,
+                        help="Cosine similarity at or above which two images are near-duplicates")
+    parser.add_argument('--k', type=int, default=16, help="Neighbours checked per image")
+    parser.add_argument('--device', type=str, default='cuda:0')
+    args = parser.parse_args()
+
+    device = args.device if torch.cuda.is_available() else 'cpu'
+    with torch.no_grad():
+        deduplicate_store(args.input_folder, args.output_folder, threshold=args.threshold, k=args.k, device=device)
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+from tqdm import tqdm
+
+# Each store folder may carry a manifest describing the images behind its rows:
+# {"model_name": ..., "mode": ..., "images": {image_id: {"file", "hash", "size", "mtime"}}}
+MANIFEST_FILE = 'manifest.json'
+
+
+def file_content_hash(path, chunk_size=1 << 20):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def describe_image(path, previous=None):
+    stat = os.stat(path)
+    # Only re-read the file when its size or mtime moved since the last run.
+    if previous is not None and previous['size'] == stat.st_size and previous['mtime'] == stat.st_mtime_ns:
+        return dict(previous, file=os.path.basename(path))
+    return {
+        'file': os.path.basename(path),
+        'hash': file_content_hash(path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+    }
+
+
+def load_manifest(store_folder):
+    path = os.path.join(store_folder, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(store_folder, manifest):
+    os.makedirs(store_folder, exist_ok=True)
+    path = os.path.join(store_folder, MANIFEST_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def new_manifest(model_name, mode, images=None):
+    return {'model_name': model_name, 'mode': mode, 'images': images or {}}
+
+
+def plan_incremental_update(manifest, store_ids, image_files, model_name, mode, known_entries=None):
+    """Compare the images on disk with what a store already holds.
+
+    Returns (to_encode, entries, stale_ids): the image paths that need an
+    embedding, the manifest entries of every image currently on disk, and the
+    store rows to drop (deleted or changed images, rows written by a run that
+    never recorded them, or everything when the model or mode changed).
+    `known_entries` (e.g. from planning another store over the same files)
+    saves re-hashing files that this store has no record of.
+    """
+    previous = {}
+    if manifest is not None and manifest['model_name'] == model_name and manifest['mode'] == mode:
+        previous = manifest['images']
+    store_ids = set(store_ids)
+
+    to_encode = []
+    entries = {}
+    for path in tqdm(image_files, desc="Checking image manifest"):
+        image_id = os.path.splitext(os.path.basename(path))[0]
+        prev = previous.get(image_id)
+        entry = describe_image(path, prev or (known_entries or {}).get(image_id))
+        entries[image_id] = entry
+        if prev is None or prev['hash'] != entry['hash'] or image_id not in store_ids:
+            to_encode.append(path)
+
+    encode_ids = {os.path.splitext(os.path.basename(path))[0] for path in to_encode}
+    stale_ids = [image_id for image_id in store_ids if image_id not in entries or image_id in encode_ids]
+    return to_encode, entries, stale_ids
@@ -0,0 +1,276 @@
+import argparse
+import hashlib
+import os
+import shutil
+import struct
+import numpy as np
+import torch
+from tqdm import tqdm
+from embedding_manifest import load_manifest
+
+# A store is a folder holding one contiguous float matrix (a regular .npy file,
+# opened with mmap) and the image ids of its rows, one per line.
+MATRIX_FILE = 'embeddings.npy'
+IDS_FILE = 'ids.txt'
+# Fixed-size .npy header so the row count can be rewritten in place on append.
+HEADER_SIZE = 128
+
+
+def is_embedding_store(folder):
+    return os.path.exists(os.path.join(folder, MATRIX_FILE))
+
+
+def _write_header(f, num_rows, dim, dtype):
+    header = {
+        'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        'fortran_order': False,
+        'shape': (num_rows, dim),
+    }
+    header_str = repr(header).encode('latin1')
+    prefix = np.lib.format.magic(1, 0) + struct.pack('<H', HEADER_SIZE - 10)
+    padding = HEADER_SIZE - len(prefix) - len(header_str) - 1
+    assert padding >= 0, "Embedding matrix header overflow"
+    f.seek(0)
+    f.write(prefix + header_str + b' ' * padding + b'\n')
+
+
+def _read_ids(folder):
+    ids_path = os.path.join(folder, IDS_FILE)
+    if not os.path.exists(ids_path):
+        return []
+    with open(ids_path, 'r', encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f]
+
+
+class EmbeddingStore():
+    def __init__(self, folder):
+        self.folder = folder
+        # Copy-on-write mapping: nothing is read until rows are touched, and the
+        # array stays writable so torch.from_numpy does not need a copy.
+        self.embeddings = np.load(os.path.join(folder, MATRIX_FILE), mmap_mode='c')
+        self.ids = _read_ids(folder)[:len(self.embeddings)]
+        self.embeddings = self.embeddings[:len(self.ids)]
+        self.index = {image_id: row for row, image_id in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, image_id):
+        return image_id in self.index
+
+    @property
+    def dim(self):
+        return self.embeddings.shape[1]
+
+    def rows(self, image_ids):
+        return [self.index[image_id] for image_id in image_ids if image_id in self.index]
+
+    def get(self, image_ids):
+        """Return the embeddings of the known ids as (ids, matrix) in input order."""
+        found = [image_id for image_id in image_ids if image_id in self.index]
+        matrix = self.embeddings[[self.index[image_id] for image_id in found]]
+        return found, np.asarray(matrix)
+
+    def as_tensor(self, device='cpu'):
+        return torch.from_numpy(self.embeddings).to(device)
+
+
+class EmbeddingStoreWriter():
+    """Appends embeddings to a store, creating it on the first write."""
+
+    def __init__(self, folder, dtype=np.float32):
+        self.folder = folder
+        self.dtype = np.dtype(dtype)
+        os.makedirs(folder, exist_ok=True)
+        self.matrix_path = os.path.join(folder, MATRIX_FILE)
+        self.ids_path = os.path.join(folder, IDS_FILE)
+        self.matrix_file = None
+        self.dim = None
+        self.num_rows = 0
+
+        if os.path.exists(self.matrix_path):
+            existing = np.load(self.matrix_path, mmap_mode='r')
+            self.dim = existing.shape[1]
+            self.dtype = existing.dtype
+            del existing
+            self.matrix_file = open(self.matrix_path, 'r+b')
+            self._recover()
+
+        self.ids_file = open(self.ids_path, 'a', encoding='utf-8')
+
+    def _recover(self):
+        # A crash can leave rows or ids past the last header update; keep the
+        # longest prefix that has both.
+        row_bytes = self.dim * self.dtype.itemsize
+        rows_on_disk = (os.path.getsize(self.matrix_path) - HEADER_SIZE) // row_bytes
+        ids = _read_ids(self.folder)
+        self.num_rows = min(rows_on_disk, len(ids))
+        self.matrix_file.truncate(HEADER_SIZE + self.num_rows * row_bytes)
+        if len(ids) != self.num_rows:
+            with open(self.ids_path, 'w', encoding='utf-8') as f:
+                f.writelines(f"{image_id}\n" for image_id in ids[:self.num_rows])
+        _write_header(self.matrix_file, self.num_rows, self.dim, self.dtype)
+
+    def append(self, image_ids, embeddings):
+        if isinstance(embeddings, torch.Tensor):
+            embeddings = embeddings.detach().float().cpu().numpy()
+        embeddings = np.ascontiguousarray(embeddings, dtype=self.dtype)
+        if embeddings.ndim == 1:
+            embeddings = embeddings[None]
+        assert len(image_ids) == len(embeddings), "Number of ids and embeddings differ"
+        if len(image_ids) == 0:
+            return
+
+        if self.matrix_file is None:
+            self.dim = embeddings.shape[1]
+            self.matrix_file = open(self.matrix_path, 'w+b')
+            _write_header(self.matrix_file, 0, self.dim, self.dtype)
+        assert embeddings.shape[1] == self.dim, f"Expected dim {self.dim}, got {embeddings.shape[1]}"
+
+        self.matrix_file.seek(0, os.SEEK_END)
+        self.matrix_file.write(embeddings.tobytes())
+        self.ids_file.writelines(f"{image_id}\n" for image_id in image_ids)
+        self.num_rows += len(image_ids)
+
+    def flush(self):
+        if self.matrix_file is None:
+            return
+        self.matrix_file.flush()
+        self.ids_file.flush()
+        _write_header(self.matrix_file, self.num_rows, self.dim, self.dtype)
+        self.matrix_file.flush()
+
+    def close(self):
+        self.flush()
+        if self.matrix_file is not None:
+            self.matrix_file.close()
+        self.ids_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def store_digest(folder, ids):
+    """Fingerprint of a database's rows, for files derived from them (indexes, codes, graphs).
+
+    Covers the ids in row order and, from the manifest, the content hash behind every
+    row, so any update that reorders, replaces or re-encodes rows changes it even when
+    the row count stays the same. Stores without a manifest fall back to the matrix
+    file's size and mtime.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    manifest = load_manifest(folder) if folder and os.path.isdir(folder) else None
+    if manifest is not None:
+        images = manifest['images']
+        digest.update(f"{manifest['model_name']}\t{manifest['mode']}\n".encode('utf-8'))
+        digest.update('\n'.join(f"{image_id}\t{images.get(image_id, {}).get('hash', '')}" for image_id in ids).encode('utf-8'))
+    else:
+        digest.update('\n'.join(ids).encode('utf-8'))
+        if folder and is_embedding_store(folder):
+            stat = os.stat(os.path.join(folder, MATRIX_FILE))
+            digest.update(f"\n{stat.st_size}\t{stat.st_mtime_ns}".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def npz_path(path):
+    """`path` as np.savez will write it (it appends .npz when missing)."""
+    return path if path.endswith('.npz') else path + '.npz'
+
+
+def load_embeddings(folder, device='cpu'):
+    """Load a folder as an (N, D) tensor plus row names.
+
+    Stores are mapped in one call; folders of per-image .pt files from older
+    runs are still read file by file.
+    """
+    if is_embedding_store(folder):
+        store = EmbeddingStore(folder)
+        return store.as_tensor(device), list(store.ids)
+
+    embeddings = []
+    names = []
+    for fname in tqdm(sorted(os.listdir(folder)), desc=f"Loading embeddings from {folder}"):
+        if fname.endswith('.pt'):
+            path = os.path.join(folder, fname)
+            embeddings.append(torch.load(path, map_location=device).squeeze(0))
+            names.append(fname.replace('.pt', ''))
+    return torch.stack(embeddings).to(device), names
+
+
+def convert_pt_folder(pt_folder, store_folder, batch_size=4096):
+    names = sorted(f for f in os.listdir(pt_folder) if f.endswith('.pt'))
+    with EmbeddingStoreWriter(store_folder) as writer:
+        for start in tqdm(range(0, len(names), batch_size), desc="Converting .pt embeddings"):
+            batch = names[start:start + batch_size]
+            embeddings = torch.stack([
+                torch.load(os.path.join(pt_folder, fname), map_location='cpu').squeeze(0).float()
+                for fname in batch
+            ])
+            writer.append([fname.replace('.pt', '') for fname in batch], embeddings)
+    print(f"✅ Converted {len(names)} embeddings from {pt_folder} into store {store_folder}")
+
+
+def remove_store(folder):
+    for name in (MATRIX_FILE, IDS_FILE):
+        path = os.path.join(folder, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def drop_rows(folder, drop_ids, batch_size=65536):
+    """Rewrite a store without the rows of `drop_ids`; returns how many were dropped."""
+    if not is_embedding_store(folder):
+        return 0
+    drop_ids = set(drop_ids)
+    store = EmbeddingStore(folder)
+    keep_rows = [row for row, image_id in enumerate(store.ids) if image_id not in drop_ids]
+    num_dropped = len(store) - len(keep_rows)
+    if num_dropped == 0:
+        return 0
+    if not keep_rows:
+        del store
+        remove_store(folder)
+        return num_dropped
+
+    tmp_folder = folder.rstrip('/') + '.compacting'
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    with EmbeddingStoreWriter(tmp_folder, dtype=store.embeddings.dtype) as writer:
+        for start in range(0, len(keep_rows), batch_size):
+            rows = keep_rows[start:start + batch_size]
+            writer.append([store.ids[row] for row in rows], store.embeddings[rows])
+    del store
+    for name in (IDS_FILE, MATRIX_FILE):
+        os.replace(os.path.join(tmp_folder, name), os.path.join(folder, name))
+    shutil.rmtree(tmp_folder)
+    return num_dropped
+
+
+def merge_stores(input_folders, output_folder, batch_size=65536):
+    with EmbeddingStoreWriter(output_folder) as writer:
+        for folder in input_folders:
+            if not is_embedding_store(folder):
+                continue
+            store = EmbeddingStore(folder)
+            for start in range(0, len(store), batch_size):
+                writer.append(store.ids[start:start + batch_size], store.embeddings[start:start + batch_size])
+    print(f"✅ Merged {len(input_folders)} stores into {output_folder}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Maintain memory-mapped embedding stores")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert_parser = subparsers.add_parser('convert', help="Pack a folder of per-image .pt files into a store")
+    convert_parser.add_argument('--pt_folder', type=str, required=True)
+    convert_parser.add_argument('--store_folder', type=str, required=True)
+    merge_parser = subparsers.add_parser('merge', help="Concatenate several stores into one")
+    merge_parser.add_argument('--inputs', type=str, nargs='+', required=True)
+    merge_parser.add_argument('--output', type=str, required=True)
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        convert_pt_folder(args.pt_folder, args.store_folder)
+    else:
+        merge_stores(args.inputs, args.output)
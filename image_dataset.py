@@ -0,0 +1,49 @@
+import torch
+from torch.utils.data import Dataset, DataLoader
+from image_loading import load_image, processor_input_size
+
+
+class ImagePathDataset(Dataset):
+    """Decodes and preprocesses images inside DataLoader workers."""
+
+    def __init__(self, image_paths, image_processor, decode_size=None):
+        self.image_paths = list(image_paths)
+        self.image_processor = image_processor
+        self.decode_size = decode_size
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        path = self.image_paths[idx]
+        try:
+            image = load_image(path, self.decode_size)
+            pixel_values = self.image_processor(images=[image], return_tensors='pt').pixel_values[0]
+        except Exception as e:
+            print(f"❌ Failed to load image {path}: {e}")
+            return path, None
+        return path, pixel_values
+
+
+def collate_skip_failed(batch):
+    """Stack the readable images of a batch and report the unreadable ones."""
+    paths = [path for path, pixel_values in batch if pixel_values is not None]
+    failed_paths = [path for path, pixel_values in batch if pixel_values is None]
+    if not paths:
+        return paths, None, failed_paths
+    pixel_values = torch.stack([pv for _, pv in batch if pv is not None])
+    return paths, pixel_values, failed_paths
+
+
+def build_image_loader(image_paths, image_processor, batch_size=32, num_workers=8, fast_decode=True):
+    # Fast decoding decodes JPEGs near the processor's input size instead of at full resolution.
+    decode_size = processor_input_size(image_processor) if fast_decode else None
+    return DataLoader(
+        ImagePathDataset(image_paths, image_processor, decode_size=decode_size),
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+        collate_fn=collate_skip_failed,
+        pin_memory=torch.cuda.is_available(),
+        prefetch_factor=4 if num_workers > 0 else None,
+    )
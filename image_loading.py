@@ -0,0 +1,90 @@
+import argparse
+import os
+import time
+import numpy as np
+import torch
+from PIL import Image
+
+
+def processor_input_size(image_processor):
+    """Shortest edge the image processor resizes to (224 for InternVL-14B-224px)."""
+    size = image_processor.size
+    if 'shortest_edge' in size:
+        return size['shortest_edge']
+    return min(size['height'], size['width'])
+
+
+def load_image(path, decode_size=None, reducing_gap=2.0):
+    """Open an image as RGB, decoding it only as large as needed.
+
+    With `decode_size`, JPEGs are decoded at the smallest DCT scale (1/2, 1/4,
+    1/8) whose sides are still >= decode_size, and the result is resized so its
+    shortest edge is decode_size, the size CLIPImageProcessor would resize to
+    anyway. Without it the full-resolution image is returned.
+    """
+    image = Image.open(path)
+    if decode_size is None:
+        return image.convert('RGB')
+    if image.format == 'JPEG':
+        image.draft('RGB', (decode_size, decode_size))
+    image = image.convert('RGB')
+    width, height = image.size
+    short, long = min(width, height), max(width, height)
+    if short > decode_size:
+        # Same output size as the processor's shortest-edge resize, so its own resize is a no-op.
+        new_long = int(decode_size * long / short)
+        new_size = (decode_size, new_long) if width <= height else (new_long, decode_size)
+        image = image.resize(new_size, Image.BICUBIC, reducing_gap=reducing_gap)
+    return image
+
+
+def check_decode_drift(embedding_model, image_paths, mode='InternVL-G', tolerance=0.01):
+    """Compare embeddings of full and reduced-resolution decoding; returns the largest 1 - cosine."""
+    decode_size = processor_input_size(embedding_model.image_processor)
+    drifts = []
+    with torch.no_grad():
+        for path in image_paths:
+            full = embedding_model.encode_pixel_values(embedding_model.preprocess_images([load_image(path)]), mode=mode)
+            fast = embedding_model.encode_pixel_values(
+                embedding_model.preprocess_images([load_image(path, decode_size)]), mode=mode)
+            drifts.append(1 - torch.nn.functional.cosine_similarity(full.float(), fast.float()).item())
+    max_drift = max(drifts) if drifts else 0.0
+    status = "✅" if max_drift <= tolerance else "⚠️"
+    print(f"{status} Decode drift on {len(drifts)} images: mean {np.mean(drifts) if drifts else 0.0:.2e}, "
+          f"max {max_drift:.2e} (tolerance {tolerance:.0e})")
+    return max_drift
+
+
+def benchmark_decode(image_paths, decode_size):
+    timings = {}
+    for name, size in (('full', None), ('reduced', decode_size)):
+        start = time.process_time()
+        for path in image_paths:
+            load_image(path, size)
+        timings[name] = (time.process_time() - start) / max(len(image_paths), 1)
+    print(f"⏱️ Decode CPU time per image: full {timings['full'] * 1000:.1f} ms, "
+          f"reduced {timings['reduced'] * 1000:.1f} ms ({timings['full'] / max(timings['reduced'], 1e-9):.1f}x faster)")
+    return timings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark reduced-resolution decoding and check its embedding drift")
+    parser.add_argument('--input_folder', type=str, default='./data/database/database_origin/database_img/')
+    parser.add_argument('--samples', type=int, default=64, help="Number of images to check")
+    parser.add_argument('--decode_size', type=int, default=224)
+    parser.add_argument('--mode', type=str, default='InternVL-G', choices=['InternVL-G', 'InternVL-C'])
+    parser.add_argument('--tolerance', type=float, default=0.01, help="Largest acceptable 1 - cosine similarity")
+    parser.add_argument('--skip_drift', action='store_true', help="Only time decoding, do not load the model")
+    parser.add_argument('--device', type=str, default='cuda:0')
+    args = parser.parse_args()
+
+    image_paths = sorted(
+        os.path.join(args.input_folder, f) for f in os.listdir(args.input_folder)
+        if f.lower().endswith(('.jpg', '.jpeg', '.png'))
+    )[:args.samples]
+    benchmark_decode(image_paths, args.decode_size)
+    if not args.skip_drift:
+        from internvl import CustonInternVLRetrievalModel
+        device = args.device if torch.cuda.is_available() else 'cpu'
+        check_decode_drift(CustonInternVLRetrievalModel(device=device), image_paths, mode=args.mode,
+                           tolerance=args.tolerance)
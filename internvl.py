@@ -1,3 +1,4 @@
+import threading
 import torch
 from PIL import Image
 from transformers import AutoModel, CLIPImageProcessor
@@ -9,6 +10,18 @@ from typing import List, Optional, Tuple, Union
 from transformers import (AutoModel, GenerationConfig, LlamaForCausalLM,
                           LlamaTokenizer, Qwen2ForCausalLM)
 import torch.nn as nn
+from image_loading import load_image, processor_input_size
+
+
+class _CachedVisionTower(nn.Module):
+    """Stands in for the vision tower and returns features that were already computed."""
+
+    def __init__(self, outputs):
+        super().__init__()
+        self.outputs = outputs
+
+    def forward(self, *args, **kwargs):
+        return self.outputs
 
 
 class CustonInternVLRetrievalModel():
@@ -25,21 +38,67 @@ class CustonInternVLRetrievalModel():
 
         self.image_processor = CLIPImageProcessor.from_pretrained(
             model_name, trust_remote_code=True)
+        # Image paths are decoded at (about) the processor's input size; None decodes at full resolution.
+        self.decode_size = processor_input_size(self.image_processor)
 
         self.tokenizer = AutoTokenizer.from_pretrained(
             model_name, use_fast=False, add_eos_token=True, trust_remote_code=True)
         self.tokenizer.pad_token_id = 0  
+        # encode_pixel_values_multi briefly swaps model.vision_model; every use of the
+        # vision tower holds this lock so concurrent threads never see the swapped one.
+        self.vision_lock = threading.Lock()
+        self._empty_text_features = None
 
     def encode_image(self, images, mode='InternVL-G', is_path = False):
         if is_path:
-            images = [Image.open(path).convert('RGB') for path in images]
+            images = [load_image(path, self.decode_size) for path in images]
+
+        pixel_values = self.preprocess_images(images)
+        return self.encode_pixel_values(pixel_values, mode=mode)
+
+    def preprocess_images(self, images):
+        # CLIPImageProcessor handles every image independently, so per-image
+        # outputs can be stacked later without changing the pixel values.
+        return self.image_processor(images=images, return_tensors='pt').pixel_values
 
-        pixel_values = self.image_processor(images=images, return_tensors='pt').pixel_values
-        pixel_values = pixel_values.to(torch.bfloat16).to(self.device)
-        embedding = self.model.encode_image(pixel_values, mode=mode)
+    def encode_pixel_values(self, pixel_values, mode='InternVL-G'):
+        pixel_values = pixel_values.to(torch.bfloat16).to(self.device, non_blocking=True)
+        with self.vision_lock:
+            embedding = self.model.encode_image(pixel_values, mode=mode)
         embedding = embedding / embedding.norm(dim=-1, keepdim=True)
         return embedding
     
+    def encode_image_multi(self, images, modes=('InternVL-C', 'InternVL-G'), is_path=False):
+        if is_path:
+            images = [load_image(path, self.decode_size) for path in images]
+
+        pixel_values = self.preprocess_images(images)
+        return self.encode_pixel_values_multi(pixel_values, modes=modes)
+
+    def encode_pixel_values_multi(self, pixel_values, modes=('InternVL-C', 'InternVL-G')):
+        """{mode: normalized embeddings} from a single pass of the vision backbone.
+
+        Both heads start from the same vision_model output, so it is computed
+        once and served to model.encode_image of every mode. The heads stay
+        those of the model's own code (the G head runs QLLaMA on the backbone
+        features); the tower is swapped under vision_lock, so other threads
+        encoding with this model wait instead of reading the cached features.
+        """
+        if len(modes) == 1:
+            return {modes[0]: self.encode_pixel_values(pixel_values, mode=modes[0])}
+        pixel_values = pixel_values.to(torch.bfloat16).to(self.device, non_blocking=True)
+        embeddings = {}
+        with self.vision_lock:
+            vision_model = self.model.vision_model
+            vision_outputs = vision_model(pixel_values=pixel_values, output_hidden_states=False, return_dict=True)
+            self.model.vision_model = _CachedVisionTower(vision_outputs)
+            try:
+                for mode in modes:
+                    embeddings[mode] = self.model.encode_image(pixel_values, mode=mode)
+            finally:
+                self.model.vision_model = vision_model
+        return {mode: embedding / embedding.norm(dim=-1, keepdim=True) for mode, embedding in embeddings.items()}
+
     def encode_text(self, text):
         prefix = 'summarize:'
         text = prefix + text 
@@ -49,6 +108,30 @@ class CustonInternVLRetrievalModel():
         feature_text = feature_text / feature_text.norm(dim=-1, keepdim=True)
         return feature_text
 
+    @torch.no_grad()
+    def encode_texts(self, texts, batch_size=64):
+        if len(texts) == 0:
+            # (0, D) like any other result; D and the dtype come from encoding one empty text once.
+            if self._empty_text_features is None:
+                self._empty_text_features = self.encode_texts([''])[:0]
+            return self._empty_text_features
+        prefix = 'summarize:'
+        input_ids = self.tokenizer([prefix + text for text in texts], max_length=80,
+                                   truncation=True).input_ids
+        # Batch texts of similar length together and pad each batch only to its
+        # longest member instead of always to max_length.
+        order = sorted(range(len(texts)), key=lambda i: len(input_ids[i]))
+        features = [None] * len(texts)
+        for start in range(0, len(order), batch_size):
+            batch_indices = order[start:start + batch_size]
+            batch = self.tokenizer.pad({'input_ids': [input_ids[i] for i in batch_indices]},
+                                       padding='longest', return_tensors='pt').input_ids.to(self.device)
+            feature_text = self.model.encode_text(batch)
+            feature_text = feature_text / feature_text.norm(dim=-1, keepdim=True)
+            for row, i in enumerate(batch_indices):
+                features[i] = feature_text[row]
+        return torch.stack(features)
+
     def compute_image_text_probs(self, image, text, mode='InternVL-G', is_image_path = False, soft_max = True):
         with torch.no_grad():
             image = self.encode_image(image, mode=mode, is_path=is_image_path)
@@ -114,8 +197,16 @@ class CustonInternVLRetrievalModel():
 
 
 class CustonInternVLCaptionModel():
-    def __init__(self, model_name = 'OpenGVLab/InternVL2_5-8B' , device='cuda:0'):
+    DETAILED_CAPTION_PROMPT = '<image>\nPlease describe detailed the image in a paragraph'
+    DETAILED_CAPTION_CONFIG = dict(max_new_tokens=1024, do_sample=True)
+    SHORT_CAPTION_PROMPT = '<image>\nPlease describe the unique features espescially the posting human or the features of that image of the image in one or two sentence'
+    SHORT_CAPTION_CONFIG = dict(max_new_tokens=512, do_sample=True)
+
+    def __init__(self, model_name = 'OpenGVLab/InternVL2_5-8B' , device='cuda:0', caption_cache=None):
         self.device = torch.device(device)
+        self.model_name = model_name
+        # Optional CaptionCache shared across runs; captions are keyed by image content, model, prompt and config.
+        self.caption_cache = caption_cache
         
         self.IMAGENET_MEAN = (0.485, 0.456, 0.406)
         self.IMAGENET_STD = (0.229, 0.224, 0.225)
@@ -222,24 +313,23 @@ class CustonInternVLCaptionModel():
             return response
         
     
-    def generate_caption(self, image_path):
-        with torch.no_grad():
-            image = self.load_image(image_path, max_num=12).to(torch.bfloat16).to(self.device)
-            generation_config = dict(max_new_tokens=1024, do_sample=True)
+    def caption_image(self, image_path, question, generation_config):
+        def generate():
+            with torch.no_grad():
+                image = self.load_image(image_path, max_num=12).to(torch.bfloat16).to(self.device)
+                response, history = self.model.chat(self.tokenizer, image, question, dict(generation_config),
+                                                    history=None, return_history=True)
+                return response
+
+        if self.caption_cache is None:
+            return generate()
+        return self.caption_cache.get_or_generate(image_path, self.model_name, question, generation_config, generate)
 
+    def generate_caption(self, image_path):
+        return self.caption_image(image_path, self.DETAILED_CAPTION_PROMPT, self.DETAILED_CAPTION_CONFIG)
 
-            question = '<image>\nPlease describe detailed the image in a paragraph'
-            response, history = self.model.chat(self.tokenizer, image, question, generation_config, history=None, return_history=True)
-            return response
     def generate__short_caption(self, image_path):
-        with torch.no_grad():
-            image = self.load_image(image_path, max_num=12).to(torch.bfloat16).to(self.device)
-            generation_config = dict(max_new_tokens=512, do_sample=True)
-
-
-            question = '<image>\nPlease describe the unique features espescially the posting human or the features of that image of the image in one or two sentence'
-            response, history = self.model.chat(self.tokenizer, image, question, generation_config, history=None, return_history=True)
-            return response
+        return self.caption_image(image_path, self.SHORT_CAPTION_PROMPT, self.SHORT_CAPTION_CONFIG)
     
     
     def generate_captions(self, image_paths):
@@ -0,0 +1,147 @@
+import argparse
+import os
+import numpy as np
+import torch
+from embedding_store import load_embeddings, store_digest, npz_path
+from search_index import blocked_topk
+
+# Sparse top-k neighbour graph of the database, built offline once:
+#   neighbors[i]    (N, k) rows of the k nearest other database images of row i
+#   similarities[i] (N, k) their cosine similarities, best first
+RESCORE_METHODS = ('none', 'aqe', 'diffusion')
+
+
+def build_knn_graph(embeddings, k=20, device='cpu', max_memory_mb=4096):
+    """Exact kNN self-join of the rows of `embeddings` (self matches removed).
+
+    All rows go through one blocked_topk call with the matrix moved to `device`
+    once, so the database is streamed a single time instead of once per query slice.
+    """
+    print(f"Building kNN graph of {len(embeddings)} rows (k={k})")
+    queries = embeddings.float().to(device)
+    similarities, indices = blocked_topk(queries, queries, k + 1, max_memory_mb=max_memory_mb)
+    rows = torch.arange(len(queries), device=indices.device).unsqueeze(1)
+    keep = indices != rows
+    # Rows whose own entry lost a tie drop their weakest neighbour instead.
+    keep[keep.all(dim=1), -1] = False
+    return indices[keep].view(len(queries), -1).cpu(), similarities[keep].view(len(queries), -1).cpu()
+
+
+def default_graph_path(database_folder, k):
+    return os.path.join(database_folder, f"knn_graph_k{k}.npz")
+
+
+def save_knn_graph(path, neighbors, similarities, digest=''):
+    np.savez(path, neighbors=neighbors.numpy().astype(np.int32), similarities=similarities.numpy().astype(np.float16),
+             digest=np.array(digest))
+
+
+def load_knn_graph(path):
+    """(neighbors, similarities, digest of the database rows it was built from; None for older files)."""
+    data = np.load(path)
+    digest = str(data['digest']) if 'digest' in data.files else None
+    return (torch.from_numpy(data['neighbors'].astype(np.int64)),
+            torch.from_numpy(data['similarities'].astype(np.float32)), digest)
+
+
+def shortlist_affinity(neighbors, similarities, shortlist):
+    """(Q, K, K) graph similarities between the shortlisted rows of every query, 0 where there is no edge."""
+    shortlist_neighbors = neighbors[shortlist]  # (Q, K, k)
+    shortlist_similarities = similarities[shortlist]  # (Q, K, k)
+    edges = shortlist_neighbors.unsqueeze(-1) == shortlist[:, None, None, :]  # (Q, K, k, K)
+    affinity = (edges * shortlist_similarities.clamp(min=0).unsqueeze(-1)).amax(dim=2)
+    # Symmetric: an edge in either neighbour list counts.
+    return torch.maximum(affinity, affinity.transpose(1, 2))
+
+
+def alpha_query_expansion(queries, shortlist_embeddings, shortlist_similarities, alpha=3.0, depth=2):
+    """alpha-QE: add the top `depth` results weighted by similarity^alpha to the query, then rescore the shortlist."""
+    weights = shortlist_similarities[:, :depth].clamp(min=0) ** alpha  # (Q, depth)
+    expanded = queries + (weights.unsqueeze(-1) * shortlist_embeddings[:, :depth]).sum(dim=1)
+    expanded = expanded / expanded.norm(dim=-1, keepdim=True)
+    return torch.bmm(shortlist_embeddings, expanded.unsqueeze(2)).squeeze(2)
+
+
+def graph_diffusion(shortlist_similarities, affinity, alpha=0.5, num_iters=10):
+    """Personalised-PageRank style diffusion of the query scores over the shortlist graph."""
+    transition = affinity / affinity.sum(dim=2, keepdim=True).clamp(min=1e-12)
+    scores = shortlist_similarities
+    for _ in range(num_iters):
+        scores = (1 - alpha) * shortlist_similarities + alpha * torch.bmm(transition, scores.unsqueeze(2)).squeeze(2)
+    return scores
+
+
+def rescore_shortlist(args, query_embeddings, topk_similarities, topk_indices, db_embeddings, graph=None,
+                      query_batch_size=1024):
+    """Re-rank every query's shortlist with --rescore; inputs and outputs are raw similarities on CPU."""
+    if args.rescore == 'none':
+        return topk_similarities, topk_indices
+    all_similarities, all_indices = [], []
+    for start in range(0, len(topk_indices), query_batch_size):
+        shortlist = topk_indices[start:start + query_batch_size]
+        similarities = topk_similarities[start:start + query_batch_size].float()
+        if args.rescore == 'aqe':
+            queries = query_embeddings[start:start + query_batch_size].float().cpu()
+            shortlist_embeddings = db_embeddings[shortlist.flatten()].float().view(*shortlist.shape, -1)
+            new_similarities = alpha_query_expansion(queries, shortlist_embeddings, similarities,
+                                                     alpha=args.aqe_alpha, depth=args.aqe_depth)
+        else:
+            neighbors, graph_similarities = graph
+            affinity = shortlist_affinity(neighbors, graph_similarities, shortlist)
+            new_similarities = graph_diffusion(similarities, affinity, alpha=args.diffusion_alpha,
+                                               num_iters=args.diffusion_iters)
+        new_similarities, order = torch.sort(new_similarities, dim=1, descending=True)
+        all_similarities.append(new_similarities)
+        all_indices.append(shortlist.gather(1, order))
+    return torch.cat(all_similarities), torch.cat(all_indices)
+
+
+def get_knn_graph(args, db_embeddings, device, db_ids=None):
+    """Load the persisted graph for --rescore diffusion, building it when missing or stale.
+
+    The graph is reused only when it was built from the same database rows (ids digest)
+    with the same --graph_k.
+    """
+    graph_path = npz_path(args.knn_graph_path or default_graph_path(args.database_folder, args.graph_k))
+    digest = store_digest(args.database_folder, db_ids if db_ids is not None else [])
+    if os.path.exists(graph_path):
+        neighbors, similarities, saved_digest = load_knn_graph(graph_path)
+        if saved_digest == digest and len(neighbors) == len(db_embeddings) and \
+                neighbors.shape[1] == min(args.graph_k, len(db_embeddings) - 1):
+            return neighbors, similarities
+        print(f"⚠️ {graph_path} was built from other database rows or another --graph_k, rebuilding it")
+    with torch.no_grad():
+        neighbors, similarities = build_knn_graph(db_embeddings, k=args.graph_k, device=device)
+    save_knn_graph(graph_path, neighbors, similarities, digest=digest)
+    print(f"Saved kNN graph (k={args.graph_k}) to {graph_path}")
+    return neighbors, similarities
+
+
+def add_rescore_args(parser):
+    parser.add_argument('--rescore', type=str, default='none', choices=RESCORE_METHODS,
+                        help="Cheap second stage on the pre_top_k shortlist: alpha query expansion or kNN-graph diffusion")
+    parser.add_argument('--aqe_alpha', type=float, default=3.0, help="alpha-QE weight exponent")
+    parser.add_argument('--aqe_depth', type=int, default=2, help="Top results added to the query by alpha-QE")
+    parser.add_argument('--diffusion_alpha', type=float, default=0.5,
+                        help="Share of a candidate's score taken from its graph neighbours in the shortlist")
+    parser.add_argument('--diffusion_iters', type=int, default=10, help="Diffusion iterations")
+    parser.add_argument('--graph_k', type=int, default=20, help="Neighbours per database image in the kNN graph")
+    parser.add_argument('--knn_graph_path', type=str, default=None,
+                        help="Where to save/load the kNN graph (default: inside the database folder)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the sparse kNN graph of a database embedding store")
+    parser.add_argument('--database_folder', type=str, default='./embeddings/database_image_internVL_g/')
+    parser.add_argument('--graph_k', type=int, default=20)
+    parser.add_argument('--knn_graph_path', type=str, default=None)
+    parser.add_argument('--device', type=str, default='cuda:0')
+    args = parser.parse_args()
+
+    device = args.device if torch.cuda.is_available() else 'cpu'
+    db_embeddings, db_ids = load_embeddings(args.database_folder, device='cpu')
+    with torch.no_grad():
+        neighbors, similarities = build_knn_graph(db_embeddings, k=args.graph_k, device=device)
+    graph_path = npz_path(args.knn_graph_path or default_graph_path(args.database_folder, args.graph_k))
+    save_knn_graph(graph_path, neighbors, similarities, digest=store_digest(args.database_folder, db_ids))
+    print(f"✅ Saved kNN graph of {len(neighbors)} images (k={args.graph_k}) to {graph_path}")
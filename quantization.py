@@ -0,0 +1,230 @@
+import json
+import time
+import numpy as np
+import torch
+from tqdm import tqdm
+
+
+def kmeans(x, num_clusters, num_iters=20, seed=0, batch_size=65536):
+    """Plain Lloyd k-means on the rows of `x`; returns the (num_clusters, D) centroids."""
+    x = x.float()
+    # Fewer rows than clusters (e.g. PQ's 256 codewords on a tiny database): one centroid per row.
+    num_clusters = min(num_clusters, len(x))
+    generator = torch.Generator(device='cpu').manual_seed(seed)
+    perm = torch.randperm(len(x), generator=generator)[:num_clusters].to(x.device)
+    centroids = x[perm].clone()
+    for _ in range(num_iters):
+        assignments = torch.cat([
+            torch.cdist(x[start:start + batch_size], centroids).argmin(dim=1)
+            for start in range(0, len(x), batch_size)
+        ])
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, x)
+        counts = torch.bincount(assignments, minlength=num_clusters).unsqueeze(1).to(x.dtype)
+        # Empty clusters keep their previous centroid.
+        centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+    return centroids
+
+
+def _training_sample(embeddings, max_train_size, seed=0):
+    if len(embeddings) <= max_train_size:
+        return torch.as_tensor(np.asarray(embeddings)).float()
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(embeddings), max_train_size, replace=False))
+    return torch.as_tensor(np.asarray(embeddings[rows])).float()
+
+
+class Fp16Quantizer():
+    name = 'fp16'
+
+    def fit(self, embeddings, device='cpu'):
+        self.codes = torch.as_tensor(np.asarray(embeddings, dtype=np.float16)).to(device)
+        return self
+
+    def scores(self, queries, start, end):
+        return queries.to(self.codes.dtype) @ self.codes[start:end].T
+
+    def state(self):
+        return {'codes': self.codes.cpu().numpy()}
+
+    def load_state(self, state, device='cpu'):
+        self.codes = torch.from_numpy(state['codes']).to(device)
+
+    @property
+    def nbytes(self):
+        return self.codes.numel() * self.codes.element_size()
+
+
+class Int8Quantizer():
+    """Symmetric per-dimension int8 codes: x[:, d] ~= codes[:, d] * scales[d]."""
+    name = 'int8'
+
+    def fit(self, embeddings, device='cpu', batch_size=65536):
+        scales = np.zeros(embeddings.shape[1], dtype=np.float32)
+        for start in range(0, len(embeddings), batch_size):
+            block = np.abs(np.asarray(embeddings[start:start + batch_size], dtype=np.float32))
+            scales = np.maximum(scales, block.max(axis=0))
+        scales = np.maximum(scales, 1e-12) / 127.0
+        codes = np.empty(embeddings.shape, dtype=np.int8)
+        for start in range(0, len(embeddings), batch_size):
+            block = np.asarray(embeddings[start:start + batch_size], dtype=np.float32)
+            codes[start:start + batch_size] = np.clip(np.rint(block / scales), -127, 127)
+        self.codes = torch.from_numpy(codes).to(device)
+        self.scales = torch.from_numpy(scales).to(device)
+        return self
+
+    def scores(self, queries, start, end):
+        # Fold the scales into the queries so the codes are only cast, never rescaled.
+        return (queries.float() * self.scales) @ self.codes[start:end].float().T
+
+    def state(self):
+        return {'codes': self.codes.cpu().numpy(), 'scales': self.scales.cpu().numpy()}
+
+    def load_state(self, state, device='cpu'):
+        self.codes = torch.from_numpy(state['codes']).to(device)
+        self.scales = torch.from_numpy(state['scales']).to(device)
+
+    @property
+    def nbytes(self):
+        return self.codes.numel() + self.scales.numel() * 4
+
+
+class PQQuantizer():
+    """Product quantization with 256 centroids per subspace (one byte per subspace)."""
+    name = 'pq'
+
+    def __init__(self, num_subspaces=64, num_iters=20, max_train_size=100000):
+        self.num_subspaces = num_subspaces
+        self.num_iters = num_iters
+        self.max_train_size = max_train_size
+
+    def fit(self, embeddings, device='cpu', batch_size=65536):
+        dim = embeddings.shape[1]
+        assert dim % self.num_subspaces == 0, f"dim {dim} is not divisible by {self.num_subspaces} subspaces"
+        sub_dim = dim // self.num_subspaces
+        train = _training_sample(embeddings, self.max_train_size).to(device)
+        self.centroids = torch.stack([
+            kmeans(train[:, j * sub_dim:(j + 1) * sub_dim], 256, num_iters=self.num_iters, seed=j)
+            for j in tqdm(range(self.num_subspaces), desc="Training PQ codebooks")
+        ])  # (M, 256, sub_dim)
+
+        codes = []
+        for start in range(0, len(embeddings), batch_size):
+            block = torch.as_tensor(np.asarray(embeddings[start:start + batch_size])).float().to(device)
+            block = block.view(len(block), self.num_subspaces, sub_dim).transpose(0, 1)  # (M, B, sub_dim)
+            codes.append(torch.cdist(block, self.centroids).argmin(dim=2).T.to(torch.uint8))
+        self.codes = torch.cat(codes)
+        return self
+
+    def scores(self, queries, start, end):
+        num_queries = len(queries)
+        sub_queries = queries.float().view(num_queries, self.num_subspaces, -1).transpose(0, 1)  # (M, Q, sub_dim)
+        tables = torch.bmm(sub_queries, self.centroids.transpose(1, 2))  # (M, Q, 256)
+        codes = self.codes[start:end].long()
+        scores = torch.zeros(num_queries, len(codes), device=queries.device)
+        for j in range(self.num_subspaces):
+            scores += tables[j][:, codes[:, j]]
+        return scores
+
+    def state(self):
+        return {'codes': self.codes.cpu().numpy(), 'centroids': self.centroids.cpu().numpy()}
+
+    def load_state(self, state, device='cpu'):
+        self.codes = torch.from_numpy(state['codes']).to(device)
+        self.centroids = torch.from_numpy(state['centroids']).to(device)
+        self.num_subspaces = self.centroids.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.codes.numel() + self.centroids.numel() * 4
+
+
+QUANTIZERS = {
+    'fp16': Fp16Quantizer,
+    'int8': Int8Quantizer,
+    'pq': PQQuantizer,
+}
+
+
+def build_quantizer(name, embeddings, device='cpu', **kwargs):
+    return QUANTIZERS[name](**kwargs).fit(embeddings, device=device)
+
+
+def quantizer_params(name, **kwargs):
+    """Parameters that change a quantizer's codes; part of the cache key of saved codes."""
+    return {'num_subspaces': kwargs.get('num_subspaces', 64)} if name == 'pq' else {}
+
+
+def save_quantizer(quantizer, path, digest='', params=None):
+    np.savez(path, name=quantizer.name, digest=digest, params=json.dumps(params or {}, sort_keys=True),
+             **quantizer.state())
+
+
+def load_quantizer(path, device='cpu'):
+    """Load saved codes; returns (quantizer, digest, params) with digest None for files that predate it."""
+    state = dict(np.load(path))
+    quantizer = QUANTIZERS[str(state.pop('name'))]()
+    digest = str(state.pop('digest')) if 'digest' in state else None
+    params = json.loads(str(state.pop('params'))) if 'params' in state else None
+    quantizer.load_state(state, device=device)
+    return quantizer, digest, params
+
+
+def quantized_search(quantizer, query_embeddings, db_embeddings, k, rescore_factor=4,
+                     query_batch_size=256, db_batch_size=65536):
+    """Approximate pass over the codes, then exact rescoring of the shortlist.
+
+    `db_embeddings` is the exact float matrix (typically the memory-mapped store
+    on CPU); only the shortlisted rows are read from it.
+    """
+    num_db = len(quantizer.codes)
+    shortlist_size = min(num_db, k * rescore_factor)
+    device = quantizer.codes.device
+    all_similarities, all_indices = [], []
+    for q_start in range(0, len(query_embeddings), query_batch_size):
+        queries = query_embeddings[q_start:q_start + query_batch_size].float().to(device)
+        # Keep a running shortlist so only one (queries x db block) score tile is alive.
+        top_values = torch.full((len(queries), shortlist_size), float('-inf'), device=device)
+        top_indices = torch.zeros((len(queries), shortlist_size), dtype=torch.long, device=device)
+        for start in range(0, num_db, db_batch_size):
+            approx = quantizer.scores(queries, start, start + db_batch_size).float()
+            block_values, block_indices = torch.topk(approx, k=min(shortlist_size, approx.shape[1]), dim=1)
+            merged_values = torch.cat([top_values, block_values], dim=1)
+            merged_indices = torch.cat([top_indices, block_indices + start], dim=1)
+            top_values, order = torch.topk(merged_values, k=shortlist_size, dim=1)
+            top_indices = merged_indices.gather(1, order)
+        shortlist = top_indices.cpu()
+
+        candidates = db_embeddings[shortlist.flatten()].float().view(len(queries), shortlist_size, -1)
+        exact = torch.bmm(candidates.to(device), queries.unsqueeze(2)).squeeze(2)
+        similarities, order = torch.topk(exact, k=min(k, shortlist_size), dim=1)
+        all_similarities.append(similarities)
+        all_indices.append(shortlist.to(device).gather(1, order))
+    return torch.cat(all_similarities), torch.cat(all_indices)
+
+
+def quantization_report(quantizer, query_embeddings, db_embeddings, k, rescore_factor=4):
+    """Print memory saved and R@1 / R@10 agreement with the exact fp32 search."""
+    db_embeddings = db_embeddings.float()
+    start = time.time()
+    exact_indices = torch.cat([
+        torch.topk(query_embeddings[i:i + 256].float().to(db_embeddings.device) @ db_embeddings.T, k=k, dim=1).indices.cpu()
+        for i in range(0, len(query_embeddings), 256)
+    ])
+    exact_time = time.time() - start
+    start = time.time()
+    _, approx_indices = quantized_search(quantizer, query_embeddings, db_embeddings, k, rescore_factor=rescore_factor)
+    approx_time = time.time() - start
+    approx_indices = approx_indices.cpu()
+
+    fp32_bytes = db_embeddings.numel() * 4
+    recall_at_1 = (approx_indices[:, 0] == exact_indices[:, 0]).float().mean().item()
+    top10 = min(10, k)
+    overlap = [
+        len(set(a[:top10].tolist()) & set(e[:top10].tolist())) / top10
+        for a, e in zip(approx_indices, exact_indices)
+    ]
+    print(f"📦 {quantizer.name}: {quantizer.nbytes / 2**20:.1f} MiB vs fp32 {fp32_bytes / 2**20:.1f} MiB "
+          f"({fp32_bytes / max(quantizer.nbytes, 1):.1f}x smaller)")
+    print(f"🎯 Agreement with fp32 search: R@1 {recall_at_1:.4f}, R@{top10} {np.mean(overlap):.4f} "
+          f"(rescore factor {rescore_factor})")
+    print(f"⏱️ fp32 search {exact_time:.2f}s, quantized search {approx_time:.2f}s")
@@ -0,0 +1,131 @@
+import argparse
+import csv
+import os
+import tempfile
+import time
+import torch
+from caption_cache import open_caption_cache
+from dedup import load_clusters
+from internvl import CustonInternVLCaptionModel
+from step_1_rerank import (RERANK_MODES, DATABASE_IMAGE_PATH, DATABASE_CAPTION_MODEL, load_wrong_queries,
+                           extract_rerank_inputs, create_caption_json, rerank_embeddings, rerank_without_generation,
+                           cascade_rerank)
+
+
+def load_ground_truth(path):
+    """{query_id: image_id} from a CSV with query_id and image_id columns."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return {row['query_id']: row['image_id'] for row in csv.DictReader(f)}
+
+
+def run_mode(mode, rerank_inputs, args, clusters, caption_cache, scratch_dir):
+    """Timed run of one mode; returns (results, seconds, candidate captions generated on the way or None).
+
+    generate and cascade run cold: no caption cache and caption checkpoints in an empty
+    `scratch_dir`, so nothing is resumed from an earlier run.
+    """
+    output_path = os.path.join(args.output_dir, f"rerank_results_{mode}.json")
+    captions = None
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    if mode == 'generate':
+        caption_path = os.path.join(scratch_dir, "rerank_caption_generate.json")
+        captions = create_caption_json(rerank_inputs, caption_path, clusters=clusters, caption_cache=None)
+        results = rerank_embeddings(caption_path, output_path, coeff_path=args.coeff_path)
+    elif mode == 'cascade':
+        args.rerank_caption_output_path = os.path.join(scratch_dir, "rerank_caption_cascade.json")
+        args.cascade_cost_path = os.path.join(args.output_dir, "rerank_costs_cascade.json")
+        results = cascade_rerank(rerank_inputs, output_path, args, clusters=clusters, caption_cache=None)
+    else:
+        # Query captions are always generated here so the timing reflects a cold run.
+        results = rerank_without_generation(rerank_inputs, output_path, mode, args, clusters=clusters,
+                                            caption_cache=caption_cache if mode == 'cached_captions' else None)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return results, time.perf_counter() - start, captions
+
+
+def fill_caption_cache(rerank_inputs, clusters, caption_cache, captions, scratch_dir):
+    """Untimed: put large-model captions of every candidate in the cache for the cached_captions mode.
+
+    Captions of a generate run are copied over; without one they are generated here.
+    """
+    if captions is None:
+        create_caption_json(rerank_inputs, os.path.join(scratch_dir, "rerank_caption_fill.json"),
+                            clusters=clusters, caption_cache=caption_cache)
+        return
+    for item in captions:
+        for candidate in item['top_k_captions']:
+            image_id = clusters.representative_of(candidate['image_id']) if clusters is not None else candidate['image_id']
+            try:
+                caption_cache.put(os.path.join(DATABASE_IMAGE_PATH, f"{image_id}.jpg"), DATABASE_CAPTION_MODEL,
+                                  CustonInternVLCaptionModel.SHORT_CAPTION_PROMPT,
+                                  CustonInternVLCaptionModel.SHORT_CAPTION_CONFIG, candidate['caption'])
+            except OSError:
+                pass
+
+
+def top1(results):
+    return {item['query_id']: item['reranked_candidates'][0] for item in results if item['reranked_candidates']}
+
+
+def main(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    wrong_query_ids = load_wrong_queries(args.wrong_sample_json_path)
+    rerank_inputs = extract_rerank_inputs(args.csv_path, wrong_query_ids, args.pre_top_k)[:args.max_queries]
+    clusters = load_clusters(args.dedup_folder)
+    caption_cache = open_caption_cache(args.caption_cache_dir, size_limit_gb=args.caption_cache_size_gb)
+    ground_truth = load_ground_truth(args.ground_truth_csv) if args.ground_truth_csv else None
+
+    first_stage = {item['query_id']: item['top_k_candidates'][0] for item in rerank_inputs}
+    reference = None
+    print(f"📊 Rerank benchmark on {len(rerank_inputs)} hard queries")
+    generated = None
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory(dir=args.output_dir) as scratch_dir:
+            if mode == 'cached_captions' and caption_cache is not None:
+                fill_caption_cache(rerank_inputs, clusters, caption_cache, generated, scratch_dir)
+            results, seconds, captions = run_mode(mode, rerank_inputs, args, clusters, caption_cache, scratch_dir)
+        generated = captions if captions is not None else generated
+        predictions = top1(results)
+        reference = predictions if reference is None else reference
+        line = (f"  {mode:16s} {seconds:8.1f} s total, {seconds / max(len(rerank_inputs), 1) * 1000:8.1f} ms/query, "
+                f"top-1 changed vs first stage {sum(predictions.get(q) != p for q, p in first_stage.items())}, "
+                f"top-1 agreement with {args.modes[0]} "
+                f"{sum(predictions.get(q) == p for q, p in reference.items()) / max(len(reference), 1):.1%}")
+        if ground_truth is not None:
+            scored = [q for q in predictions if q in ground_truth]
+            line += f", R@1 {sum(predictions[q] == ground_truth[q] for q in scored) / max(len(scored), 1):.1%}"
+        print(line)
+    if ground_truth is not None:
+        scored = [q for q in first_stage if q in ground_truth]
+        print(f"  {'first stage':16s} R@1 {sum(first_stage[q] == ground_truth[q] for q in scored) / max(len(scored), 1):.1%}")
+    if caption_cache is not None:
+        caption_cache.report()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare accuracy and latency of the rerank modes on the hard queries")
+    parser.add_argument('--modes', nargs='+', default=RERANK_MODES, choices=RERANK_MODES,
+                        help="Modes to run; the first one is the reference for top-1 agreement")
+    parser.add_argument('--ground_truth_csv', type=str, default=None,
+                        help="Optional CSV with query_id,image_id columns to report R@1")
+    parser.add_argument('--max_queries', type=int, default=None, help="Benchmark only the first N hard queries")
+    parser.add_argument('--wrong_sample_json_path', type=str,
+                        default='./final_json_result/temp_three_ways_wrong_samples_set.npz')
+    parser.add_argument('--csv_path', type=str,
+                        default='./final_csv_result/temp_private_test_image_first_step_retrieval_results_with_caption.csv')
+    parser.add_argument('--pre_top_k', type=int, default=15)
+    parser.add_argument('--database_folder', type=str, default='./embeddings/database_image_internVL_g/')
+    parser.add_argument('--query_folder', type=str, default='./embeddings/track_1_private_internvlg/')
+    parser.add_argument('--coeff_path', type=str, default='./logit_scale.pt')
+    parser.add_argument('--dedup_folder', type=str, default=None)
+    parser.add_argument('--cascade_min_margin', type=float, default=1.0)
+    parser.add_argument('--cascade_max_entropy', type=float, default=None)
+    parser.add_argument('--caption_cache_dir', type=str, default='./cache/captions',
+                        help="Filled before the cached_captions mode (untimed) and read by it; timed modes run without it")
+    parser.add_argument('--caption_cache_size_gb', type=float, default=2.0)
+    parser.add_argument('--output_dir', type=str, default='./rerank_benchmark')
+    args = parser.parse_args()
+    main(args)
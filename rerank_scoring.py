@@ -0,0 +1,174 @@
+import math
+import torch
+
+
+def candidate_matrix(values_per_query, fill):
+    """Pad a ragged list of per-query lists into a (Q, K) tensor and its validity mask."""
+    width = max((len(values) for values in values_per_query), default=0)
+    matrix = torch.full((len(values_per_query), width), fill, dtype=torch.float32 if isinstance(fill, float) else torch.long)
+    mask = torch.zeros((len(values_per_query), width), dtype=torch.bool)
+    for row, values in enumerate(values_per_query):
+        matrix[row, :len(values)] = torch.tensor(values, dtype=matrix.dtype)
+        mask[row, :len(values)] = True
+    return matrix, mask
+
+
+def image_similarity_matrix(image_similarity, query_ids, candidate_ids):
+    """(Q, K) first-stage image scores of the candidates; missing ones score 0 like before."""
+    rows = []
+    for query_id, candidates in zip(query_ids, candidate_ids):
+        scores = image_similarity.get(query_id, {}) or {}
+        rows.append([float(scores.get(image_id, 0.0)) for image_id in candidates])
+    return candidate_matrix(rows, 0.0)[0]
+
+
+def encode_texts_cached(model, texts, text_features=None):
+    """(N, D) CPU features of `texts`; with a {text: feature} cache only texts not in it are encoded (and added)."""
+    if text_features is None:
+        return model.encode_texts(list(texts)).float().cpu()
+    missing = [text for text in dict.fromkeys(texts) if text not in text_features]
+    if missing:
+        text_features.update(zip(missing, model.encode_texts(missing).float().cpu()))
+    if not texts:
+        return model.encode_texts([]).float().cpu()
+    return torch.stack([text_features[text] for text in texts])
+
+
+def caption_similarity_matrix(model, query_captions, candidate_captions, text_features=None):
+    """(Q, K) cosine similarities between every query caption and its candidates' captions.
+
+    All distinct captions are encoded in one batched pass (skipping those already in
+    `text_features`); the scores of all queries then come from a single batched matrix product.
+    """
+    texts = list(dict.fromkeys(list(query_captions) + [c for captions in candidate_captions for c in captions]))
+    position = {text: row for row, text in enumerate(texts)}
+    features = encode_texts_cached(model, texts, text_features)
+
+    query_features = features[[position[text] for text in query_captions]]
+    codes, mask = candidate_matrix([[position[text] for text in captions] for captions in candidate_captions], 0)
+    candidate_features = features[codes]  # (Q, K, D)
+    similarities = torch.bmm(candidate_features, query_features.unsqueeze(2)).squeeze(2)
+    return similarities.masked_fill(~mask, 0.0), mask
+
+
+def rank_candidates(candidate_ids, scores, mask):
+    """Sort every query's candidates by descending score; returns [(ids, scores)] per query."""
+    order = scores.masked_fill(~mask, float('-inf')).argsort(dim=1, descending=True, stable=True)
+    ranked = []
+    for row, candidates in enumerate(candidate_ids):
+        row_order = order[row, :len(candidates)].tolist()
+        ranked.append(([candidates[i] for i in row_order], scores[row, row_order].tolist()))
+    return ranked
+
+
+def fill_missing(similarities, found):
+    """Give candidates without a feature their query's mean similarity so they are neither favoured nor dropped."""
+    counts = found.sum(dim=1, keepdim=True)
+    means = (similarities * found).sum(dim=1, keepdim=True) / counts.clamp(min=1)
+    return torch.where(found, similarities, means.expand_as(similarities))
+
+
+def fuse_and_rank(query_ids, candidate_ids, similarities, found, image_similarity, coeff):
+    """Rank candidates by coeff * similarity + first-stage image similarity."""
+    valid = candidate_matrix([[0] * len(candidates) for candidates in candidate_ids], 0)[1]
+    combined = coeff * fill_missing(similarities, found & valid) + \
+        image_similarity_matrix(image_similarity, query_ids, candidate_ids)
+    return rank_candidates(candidate_ids, combined, valid)
+
+
+def score_caption_rerank(model, rerank_inputs, image_similarity, coeff, text_features=None):
+    """Fuse coeff * caption similarity with the image similarity and rank every query's candidates."""
+    query_ids = [item['query_id'] for item in rerank_inputs]
+    candidate_ids = [[c['image_id'] for c in item['top_k_captions']] for item in rerank_inputs]
+    caption_similarity, mask = caption_similarity_matrix(
+        model,
+        [item['query_caption'] for item in rerank_inputs],
+        [[c['caption'] for c in item['top_k_captions']] for item in rerank_inputs],
+        text_features=text_features,
+    )
+    return fuse_and_rank(query_ids, candidate_ids, caption_similarity, mask, image_similarity, coeff)
+
+
+def rank_confidence(ranked_scores):
+    """(top-1 margin, normalised softmax entropy) of one query's ranked scores."""
+    if len(ranked_scores) < 2:
+        return float('inf'), 0.0
+    scores = torch.tensor(ranked_scores, dtype=torch.float64)
+    probs = scores.softmax(dim=0)
+    entropy = -(probs * probs.clamp(min=1e-12).log()).sum().item() / math.log(len(ranked_scores))
+    return (scores[0] - scores[1]).item(), entropy
+
+
+def needs_escalation(ranked_scores, min_margin=None, max_entropy=None):
+    """Whether a reranked query is still undecided: margin below `min_margin` or entropy above `max_entropy`."""
+    margin, entropy = rank_confidence(ranked_scores)
+    return (min_margin is not None and margin < min_margin) or (max_entropy is not None and entropy > max_entropy)
+
+
+class EarlyStopper():
+    """Tells when captioning more candidates of one query can no longer change its reranked top-1.
+
+    Candidates arrive in first-stage order, so the next candidate's image score bounds
+    all remaining ones. Their caption similarity is bounded optimistically by the best
+    one seen so far plus `slack`. Caption features go to the shared `text_features`
+    cache, so the final rerank does not encode them again.
+    """
+
+    def __init__(self, model, coeff, query_caption, image_scores, slack=0.05, text_features=None):
+        self.model = model
+        self.coeff = float(coeff)
+        self.image_scores = image_scores or {}
+        self.slack = slack
+        self.text_features = {} if text_features is None else text_features
+        self.query_feature = encode_texts_cached(model, [query_caption], self.text_features)[0]
+        self.best_score = float('-inf')
+        self.best_caption_similarity = float('-inf')
+
+    def image_score(self, image_id):
+        return float(self.image_scores.get(image_id, 0.0))
+
+    def add(self, image_id, caption):
+        caption_similarity = float(encode_texts_cached(self.model, [caption], self.text_features)[0] @ self.query_feature)
+        self.best_caption_similarity = max(self.best_caption_similarity, caption_similarity)
+        self.best_score = max(self.best_score, self.coeff * caption_similarity + self.image_score(image_id))
+
+    def decided(self, next_image_id):
+        bound = self.coeff * (self.best_caption_similarity + self.slack) + self.image_score(next_image_id)
+        return self.best_score > bound
+
+
+def store_features(store, ids_per_query):
+    """(Q, K, D) store embeddings of every query's ids and a mask of the ids found in the store."""
+    rows, found = candidate_matrix([[store.index.get(image_id, -1) for image_id in ids] for ids in ids_per_query], -1)
+    found &= rows >= 0
+    features = torch.from_numpy(store.embeddings[rows.clamp(min=0).flatten().numpy()]).float()
+    features = torch.nn.functional.normalize(features, dim=-1).view(*rows.shape, -1)
+    return features.masked_fill(~found.unsqueeze(-1), 0.0), found
+
+
+def score_query_caption_rerank(model, query_ids, query_captions, candidate_ids, database_store, image_similarity, coeff):
+    """Text -> image: one caption per query against the stored candidate image embeddings, no candidate captions."""
+    query_features = model.encode_texts(list(query_captions)).float().cpu()
+    candidate_features, found = store_features(database_store, candidate_ids)
+    similarities = torch.bmm(candidate_features, query_features.unsqueeze(2)).squeeze(2)
+    return fuse_and_rank(query_ids, candidate_ids, similarities, found, image_similarity, coeff)
+
+
+def score_cached_caption_rerank(model, query_ids, query_store, candidate_ids, candidate_captions, image_similarity, coeff):
+    """Image -> text: the stored query image embedding against already generated candidate captions.
+
+    `candidate_captions` holds None for candidates without a caption; they keep the query's mean score.
+    """
+    texts = list(dict.fromkeys(c for captions in candidate_captions for c in captions if c is not None))
+    position = {text: row for row, text in enumerate(texts)}
+    query_features, query_found = store_features(query_store, [[query_id] for query_id in query_ids])
+    if not texts:
+        similarities = torch.zeros(len(query_ids), max((len(c) for c in candidate_ids), default=0))
+        return fuse_and_rank(query_ids, candidate_ids, similarities, similarities.bool(), image_similarity, coeff)
+
+    features = model.encode_texts(texts).float().cpu()
+    codes, found = candidate_matrix([[position.get(c, -1) if c is not None else -1 for c in captions]
+                                     for captions in candidate_captions], -1)
+    found &= (codes >= 0) & query_found
+    similarities = torch.bmm(features[codes.clamp(min=0)], query_features[:, 0].unsqueeze(2)).squeeze(2)
+    return fuse_and_rank(query_ids, candidate_ids, similarities, found, image_similarity, coeff)
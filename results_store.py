@@ -0,0 +1,131 @@
+import json
+import os
+import time
+
+
+def write_json_atomic(path, data, indent=2):
+    """Write JSON to a temporary file and rename it over `path`, so readers never see a partial file."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=indent, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class ResultsStore():
+    """Append-only JSONL checkpoint of keyed results for long-running steps.
+
+    Every result is one line {"key": ..., "value": ...}; the latest line of a key wins.
+    Lines are flushed as they are appended and fsynced in batches (every `fsync_every`
+    records or `fsync_seconds`), so a crash loses at most the last batch and never
+    corrupts earlier results. Reopening the store resumes from the keys already in it;
+    a line torn by a crash is cut off. `export_json` compacts the log into the final
+    JSON file atomically.
+    """
+
+    def __init__(self, path, fsync_every=32, fsync_seconds=5.0):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_seconds = fsync_seconds
+        self.results = {}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._recover()
+        self.file = open(path, 'a', encoding='utf-8')
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _recover(self):
+        if not os.path.exists(self.path):
+            return
+        valid_bytes = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                self.results[record['key']] = record['value']
+                valid_bytes += len(line)
+        if valid_bytes < os.path.getsize(self.path):
+            print(f"⚠️ Dropping a torn record at the end of {self.path}")
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid_bytes)
+
+    def __len__(self):
+        return len(self.results)
+
+    def __contains__(self, key):
+        return key in self.results
+
+    def get(self, key, default=None):
+        return self.results.get(key, default)
+
+    def items(self):
+        return self.results.items()
+
+    def append(self, key, value):
+        self.results[key] = value
+        self.file.write(json.dumps({'key': key, 'value': value}, ensure_ascii=False) + '\n')
+        self.file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_seconds:
+            self.sync()
+
+    def sync(self):
+        if self._unsynced:
+            os.fsync(self.file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def seed(self, results):
+        """Import results of an older run (e.g. a final JSON written before this store existed)."""
+        for key, value in results.items():
+            if key not in self.results:
+                self.append(key, value)
+        self.sync()
+
+    def export_json(self, output_path, keys=None, as_list=False, indent=2):
+        """Atomically write the results (of `keys`, in that order, if given) as a dict or a list of values."""
+        self.sync()
+        keys = [key for key in keys if key in self.results] if keys is not None else list(self.results)
+        data = [self.results[key] for key in keys] if as_list else {key: self.results[key] for key in keys}
+        write_json_atomic(output_path, data, indent=indent)
+        return data
+
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_results_store(output_path, list_key=None, **kwargs):
+    """ResultsStore checkpointing `output_path` (as `<output_path>.jsonl`).
+
+    On the first run with a store, results already in an existing `output_path` are
+    imported so older runs are resumed too; `list_key` names the key field of JSON
+    files that hold a list of records instead of a dict.
+    """
+    store = ResultsStore(f"{output_path}.jsonl", **kwargs)
+    if len(store) == 0 and os.path.exists(output_path):
+        try:
+            with open(output_path, 'r', encoding='utf-8') as f:
+                previous = json.load(f)
+        except ValueError:
+            print(f"⚠️ Ignoring unreadable previous results in {output_path}")
+            previous = {}
+        if list_key is not None and isinstance(previous, list):
+            previous = {record[list_key]: record for record in previous}
+        if isinstance(previous, dict):
+            store.seed(previous)
+    return store
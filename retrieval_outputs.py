@@ -0,0 +1,136 @@
+import os
+import csv
+import torch
+from uncertainty import (compute_uncertainty_stats, select_hard_queries, schedule_hard_queries, rerank_depths,
+                         rerank_costs, add_depth_args, SCHEDULE_UNITS)
+from retrieval_scores import save_topk_scores, TopKScores
+from article_index import load_article_index, FUSIONS
+from dedup import load_clusters
+
+SIMILARITY_OUTPUT_PATH = './final_json_result/private_test_similarity_scores.npz'
+HARD_QUERIES_OUTPUT_PATH = './final_json_result/temp_three_ways_wrong_samples_set.npz'
+RETRIEVAL_CSV_PATH = './final_csv_result/temp_private_test_image_first_step_retrieval_results_with_caption.csv'
+
+
+def load_coeff(model_type, coeff_path, device):
+    if model_type == 'clip':
+        return 1 / 0.7  # temperature scaling
+    if model_type == 'internvl':
+        if not os.path.exists(coeff_path):
+            raise FileNotFoundError(f"Missing coefficient file: {coeff_path}")
+        return torch.load(coeff_path, map_location=device)
+    raise ValueError("Unsupported model_type. Choose from: ['clip', 'internvl']")
+
+
+def add_retrieval_output_args(parser):
+    parser.add_argument('--model_type', type=str, default="internvl", choices=['clip', 'internvl'],
+                        help="Model type: 'clip' or 'internvl'")
+    parser.add_argument('--coeff_path', type=str, default='./logit_scale.pt',
+                        help="Path to coefficient tensor for internvl (required if model_type is internvl)")
+    parser.add_argument('--pre_top_k', type=int, default=15,
+                        help="Number of top similar items to retrieve per query")
+    parser.add_argument('--top_k', type=int, default=10,
+                        help="Number of top similar items to retrieve per query")
+    parser.add_argument('--export_scores_json', action='store_true',
+                        help="Also write the top-k similarity scores as the legacy nested JSON")
+    parser.add_argument('--hard_quotas', type=int, nargs=3, default=[50, 50, 50],
+                        metavar=('ENTROPY', 'GAP', 'LOW_TOP1'),
+                        help="Hardest queries taken per heuristic (entropy, top-1/top-2 gap, low top-1 score)")
+    parser.add_argument('--hard_percentile', type=float, default=None,
+                        help="Also flag queries above this percentile of any heuristic's hardness (e.g. 95)")
+    parser.add_argument('--hard_budget', type=int, default=None,
+                        help="Cap on the total number of hard queries, most uncertain first")
+    parser.add_argument('--schedule_budget', type=float, default=None,
+                        help="Rerank compute budget; replaces the quotas with a cost-aware choice of hard queries")
+    parser.add_argument('--schedule_unit', type=str, default='captions', choices=SCHEDULE_UNITS,
+                        help="Unit of --schedule_budget")
+    parser.add_argument('--caption_seconds', type=float, default=2.0,
+                        help="Expected GPU-seconds per candidate caption (gpu_seconds unit)")
+    parser.add_argument('--query_caption_seconds', type=float, default=1.0,
+                        help="Expected GPU-seconds per query caption (gpu_seconds unit)")
+    add_depth_args(parser)
+    parser.add_argument('--database_json', type=str, default=None,
+                        help="database.json; when given, the CSV also gets article_id_N columns fused from the image scores")
+    parser.add_argument('--article_index', type=str, default=None,
+                        help="Cached image -> article index (default: next to database.json)")
+    parser.add_argument('--article_fusion', type=str, default='max', choices=FUSIONS,
+                        help="How image scores are fused into article scores")
+    parser.add_argument('--article_top_k', type=int, default=10,
+                        help="Number of article_id_N columns")
+
+
+def save_similarity_scores(args, query_names, db_image_names, topk_indices, topk_similarities,
+                           output_path=SIMILARITY_OUTPUT_PATH):
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    save_topk_scores(output_path, query_names, db_image_names, topk_indices, topk_similarities)
+    print(f"Similarity scores saved to: {output_path}")
+    if args.export_scores_json:
+        json_output_path = output_path.replace('.npz', '.json')
+        TopKScores.load(output_path).export_json(json_output_path)
+        print(f"Similarity scores exported to: {json_output_path}")
+
+
+def save_hard_queries(args, query_names, topk_similarities, output_path=HARD_QUERIES_OUTPUT_PATH):
+    query_stats = compute_uncertainty_stats(topk_similarities)
+    if args.schedule_budget is not None:
+        depths = rerank_depths(topk_similarities[:, :args.pre_top_k], method=args.depth_method, mass=args.depth_mass,
+                               temperature=args.depth_temperature, min_depth=args.min_depth).numpy()
+        costs = rerank_costs(depths, unit=args.schedule_unit, caption_seconds=args.caption_seconds,
+                             query_caption_seconds=args.query_caption_seconds)
+        hard_queries, spent = schedule_hard_queries(query_names, query_stats, costs, args.schedule_budget, depths=depths)
+        print(f"🗓️ Scheduled {len(hard_queries)}/{len(query_names)} queries for reranking, "
+              f"{spent:.1f}/{args.schedule_budget:.1f} {args.schedule_unit}")
+    else:
+        hard_queries = select_hard_queries(query_names, query_stats, quotas=args.hard_quotas,
+                                           percentile=args.hard_percentile, budget=args.hard_budget)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    hard_queries.save(output_path)
+    print(f"✅ Final unique wrong samples saved to: {output_path} (total: {len(hard_queries)})")
+    return hard_queries
+
+
+def fuse_articles(args, db_image_names, topk_indices, topk_similarities):
+    """Article ids of every query ranked by fused image scores, or None without --database_json."""
+    if not args.database_json:
+        return None
+    article_index = load_article_index(args.database_json, args.article_index)
+    article_codes, _ = article_index.fuse(db_image_names, topk_indices.numpy(), topk_similarities.float().numpy(),
+                                          top_k=args.article_top_k, fusion=args.article_fusion)
+    return [[article_index.article_ids[code] for code in row if code >= 0] for row in article_codes.tolist()]
+
+
+def write_retrieval_csv(args, query_names, db_image_names, topk_indices, query_articles=None,
+                        output_file=RETRIEVAL_CSV_PATH):
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    article_columns = [f'article_id_{i+1}' for i in range(args.article_top_k)] if query_articles is not None else []
+    with open(output_file, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        header = ['query_id'] + [f'image_id_{i+1}' for i in range(args.pre_top_k)] + article_columns + ['generated_caption']
+        writer.writerow(header)
+
+        for row, (query_name, indices) in enumerate(zip(query_names, topk_indices.tolist())):
+            # All pre_top_k candidates, as the header promises (the rerank step reads every one of them);
+            # only rows padded with -1 (fewer reachable rows) are left empty.
+            top_k_image_ids = [db_image_names[idx] for idx in indices[:args.pre_top_k] if idx >= 0]
+            top_k_image_ids += [''] * (args.pre_top_k - len(top_k_image_ids))
+            article_ids = []
+            if article_columns:
+                article_ids = query_articles[row] + [''] * (len(article_columns) - len(query_articles[row]))
+            caption = "This is an image caption."
+            writer.writerow([query_name] + top_k_image_ids + article_ids + [caption])
+
+    print(f"📄 CSV results (with image_ids only) saved to: {output_file}")
+
+
+def write_retrieval_outputs(args, query_names, db_image_names, topk_indices, topk_similarities):
+    """Similarity scores, hard-query set and first-step CSV for the scaled top-k results (CPU tensors)."""
+    # Uncertainty is measured on the searched rows: expanded duplicates would tie with their representative.
+    save_hard_queries(args, query_names, topk_similarities)
+    clusters = load_clusters(args.database_folder)
+    if clusters is not None:
+        # The database holds one representative per near-duplicate cluster; report every member.
+        db_image_names, topk_indices, topk_similarities = clusters.expand_topk(
+            db_image_names, topk_indices, topk_similarities, args.pre_top_k)
+    save_similarity_scores(args, query_names, db_image_names, topk_indices, topk_similarities)
+    query_articles = fuse_articles(args, db_image_names, topk_indices, topk_similarities)
+    write_retrieval_csv(args, query_names, db_image_names, topk_indices, query_articles)
@@ -0,0 +1,74 @@
+import json
+import numpy as np
+
+
+def save_topk_scores(path, query_ids, db_ids, topk_indices, topk_similarities):
+    """Write the top-k candidates and scores of every query as columnar arrays (.npz).
+
+    Candidate ids are stored once in `candidate_ids`; `candidate_codes[q, j]`
+    points into it, so the file holds Q x k int32 codes and float32 scores
+    instead of Q x k repeated id strings. Padding cells (index -1, when fewer
+    than k rows were reachable) are stored as code -1 and skipped on reading.
+    """
+    topk_indices = np.asarray(topk_indices.cpu() if hasattr(topk_indices, 'cpu') else topk_indices)
+    topk_similarities = np.asarray(topk_similarities.cpu() if hasattr(topk_similarities, 'cpu') else topk_similarities)
+    valid = topk_indices >= 0
+    used_rows, valid_codes = np.unique(topk_indices[valid], return_inverse=True)
+    codes = np.full(topk_indices.shape, -1, dtype=np.int32)
+    codes[valid] = valid_codes
+    np.savez(
+        path,
+        query_ids=np.asarray(query_ids, dtype=str),
+        candidate_ids=np.asarray(db_ids, dtype=str)[used_rows],
+        candidate_codes=codes,
+        scores=topk_similarities.astype(np.float32),
+    )
+
+
+class TopKScores():
+    def __init__(self, query_ids, candidate_ids, candidate_codes, scores):
+        self.query_ids = query_ids
+        self.candidate_ids = candidate_ids
+        self.candidate_codes = candidate_codes
+        self.scores = scores
+        self.query_index = {query_id: row for row, query_id in enumerate(query_ids.tolist())}
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['query_ids'], data['candidate_ids'], data['candidate_codes'], data['scores'])
+
+    def __len__(self):
+        return len(self.query_ids)
+
+    def __contains__(self, query_id):
+        return query_id in self.query_index
+
+    def candidates(self, query_id):
+        """(image_ids, scores) of one query, best first."""
+        row = self.query_index[query_id]
+        valid = self.candidate_codes[row] >= 0
+        return self.candidate_ids[self.candidate_codes[row][valid]].tolist(), self.scores[row][valid]
+
+    def get(self, query_id, default=None):
+        """{image_id: score} of one query, like the legacy JSON entry."""
+        if query_id not in self.query_index:
+            return default
+        image_ids, scores = self.candidates(query_id)
+        return dict(zip(image_ids, scores.tolist()))
+
+    def export_json(self, path):
+        similarity_dict = {}
+        for query_id in self.query_ids.tolist():
+            ids, scores = self.candidates(query_id)
+            similarity_dict[query_id] = dict(zip(ids, np.round(scores.astype(np.float64), 6).tolist()))
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(similarity_dict, f)
+
+
+def load_topk_scores(path):
+    """Load columnar scores, or a legacy nested JSON file (anything with .get(query_id, default))."""
+    if path.endswith('.npz'):
+        return TopKScores.load(path)
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
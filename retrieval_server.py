@@ -0,0 +1,223 @@
+import argparse
+import asyncio
+import base64
+import io
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import List, Optional
+import numpy as np
+import torch
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from pydantic import BaseModel
+from PIL import Image
+from dedup import load_clusters
+from embedding_store import load_embeddings
+from search_index import (build_search_index, get_quantizer, place_database, add_search_index_args,
+                          check_search_index_args)
+
+
+class SearchRequest(BaseModel):
+    embeddings: Optional[List[List[float]]] = None  # L2-normalized query embeddings
+    images: Optional[List[str]] = None  # base64-encoded image files
+    top_k: int = 10
+
+
+class LatencyTracker():
+    def __init__(self, window=10000):
+        self.latencies_ms = deque(maxlen=window)
+        self.num_requests = 0
+
+    def record(self, latency_ms):
+        self.latencies_ms.append(latency_ms)
+        self.num_requests += 1
+
+    def summary(self):
+        if not self.latencies_ms:
+            return {"requests": self.num_requests}
+        latencies = np.asarray(self.latencies_ms)
+        return {
+            "requests": self.num_requests,
+            "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+            "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+            "mean_ms": round(float(latencies.mean()), 3),
+        }
+
+
+class MicroBatcher():
+    """Coalesces concurrent search requests into one index search.
+
+    Requests that arrive within `max_wait_ms` of the first one (up to
+    `max_batch_size` query vectors) are searched together, then split back.
+    """
+
+    def __init__(self, search_fn, max_batch_size=256, max_wait_ms=5.0):
+        self.search_fn = search_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.queue = asyncio.Queue()
+        self.num_batches = 0
+        self.num_queries = 0
+
+    async def submit(self, queries, k):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((queries, k, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            num_rows = len(batch[0][0])
+            deadline = loop.time() + self.max_wait_ms / 1000
+            while num_rows < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                num_rows += len(item[0])
+
+            queries = torch.cat([queries for queries, _, _ in batch])
+            k = max(k for _, k, _ in batch)
+            try:
+                similarities, indices = await loop.run_in_executor(None, self.search_fn, queries, k)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.num_batches += 1
+            self.num_queries += len(queries)
+
+            start = 0
+            for request_queries, request_k, future in batch:
+                end = start + len(request_queries)
+                if not future.done():
+                    future.set_result((similarities[start:end, :request_k], indices[start:end, :request_k]))
+                start = end
+
+    def summary(self):
+        return {
+            "batches": self.num_batches,
+            "mean_batch_size": round(self.num_queries / max(self.num_batches, 1), 2),
+        }
+
+
+def create_app(args):
+    device = args.device if torch.cuda.is_available() else 'cpu'
+
+    # Everything expensive happens once, at startup. The encoder is loaded first so the
+    # database is only pinned on the device when it fits next to it.
+    embedding_model = None
+    if args.load_model:
+        from internvl import CustonInternVLRetrievalModel
+        embedding_model = CustonInternVLRetrievalModel(device=device)
+
+    db_embeddings, db_image_names = load_embeddings(args.database_folder, device='cpu')
+    print(f"Loaded {len(db_embeddings)} database embeddings of shape {db_embeddings.shape}")
+    if not os.path.exists(args.coeff_path):
+        raise FileNotFoundError(f"Missing coefficient file: {args.coeff_path}")
+    coeff = torch.load(args.coeff_path, map_location='cpu').float()
+    quantizer = get_quantizer(args, db_embeddings, device, db_ids=db_image_names) if args.quantization != 'none' else None
+    if quantizer is None:
+        db_embeddings, resident = place_database(db_embeddings, device, args.resident_db_mb)
+        print(f"Database {'pinned on' if resident else 'streamed from CPU to'} {device}")
+    index = build_search_index(args, db_embeddings, device, quantizer=quantizer, db_ids=db_image_names)
+    # A deduplicated store holds one representative per near-duplicate cluster; results list every member.
+    clusters = load_clusters(args.database_folder)
+    database_size = len(clusters.ids) if clusters is not None else len(db_image_names)
+
+    def search(queries, k):
+        with torch.no_grad():
+            similarities, indices = index.search(queries.to(device), k)
+        return (coeff * similarities.float().cpu()), indices.cpu()
+
+    def encode_images(images):
+        with torch.no_grad():
+            return embedding_model.encode_image(images, mode=args.mode).float().cpu()
+
+    def ranked_results(indices, similarities, k):
+        """Per query [{image_id, score}], skipping -1 padding; cluster members inherit their representative's score."""
+        results = []
+        for row_indices, row_scores in zip(indices.tolist(), similarities.tolist()):
+            entries = [(db_image_names[idx], score) for idx, score in zip(row_indices, row_scores) if idx >= 0]
+            if clusters is not None:
+                entries = [(member, score) for image_id, score in entries
+                           for member in clusters.members.get(image_id, [image_id])]
+            results.append([{"image_id": image_id, "score": round(score, 6)} for image_id, score in entries[:k]])
+        return results
+
+    batcher = MicroBatcher(search, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    latency = LatencyTracker()
+
+    @asynccontextmanager
+    async def lifespan(app):
+        batcher_task = asyncio.create_task(batcher.run())
+        yield
+        batcher_task.cancel()
+
+    app = FastAPI(title="ENRIC retrieval service", lifespan=lifespan)
+
+    @app.post("/search")
+    async def search_endpoint(request: SearchRequest):
+        start = time.perf_counter()
+        if request.embeddings is not None:
+            queries = torch.tensor(request.embeddings, dtype=torch.float32)
+        elif request.images is not None:
+            if embedding_model is None:
+                raise HTTPException(status_code=400, detail="Server started without --load_model; send embeddings instead")
+            try:
+                images = [Image.open(io.BytesIO(base64.b64decode(image))).convert('RGB') for image in request.images]
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+            queries = await asyncio.get_running_loop().run_in_executor(None, encode_images, images)
+        else:
+            raise HTTPException(status_code=400, detail="Provide either 'embeddings' or 'images'")
+        if queries.ndim != 2 or queries.shape[1] != db_embeddings.shape[1]:
+            raise HTTPException(status_code=400, detail=f"Expected query vectors of dim {db_embeddings.shape[1]}")
+
+        similarities, indices = await batcher.submit(queries, min(request.top_k, len(db_image_names)))
+        results = ranked_results(indices, similarities, request.top_k)
+        latency_ms = (time.perf_counter() - start) * 1000
+        latency.record(latency_ms)
+        return {"results": results, "latency_ms": round(latency_ms, 3)}
+
+    @app.get("/stats")
+    async def stats_endpoint():
+        return {**latency.summary(), **batcher.summary(), "database_size": database_size}
+
+    @app.get("/health")
+    async def health_endpoint():
+        return {"status": "ok"}
+
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve top-k image retrieval from an in-memory database")
+    parser.add_argument('--database_folder', type=str, default='./embeddings/database_image_internVL_g/',
+                        help="Embedding store with database image embeddings")
+    parser.add_argument('--coeff_path', type=str, default='./logit_scale.pt',
+                        help="Path to the InternVL logit-scale coefficient")
+    parser.add_argument('--device', type=str, default='cuda:0', help="Search (and encoder) device")
+    parser.add_argument('--load_model', action='store_true',
+                        help="Load CustonInternVLRetrievalModel so raw images can be searched")
+    parser.add_argument('--mode', type=str, default='InternVL-G', choices=['InternVL-G', 'InternVL-C'],
+                        help="Embedding head used for raw image queries")
+    parser.add_argument('--max_batch_size', type=int, default=256,
+                        help="Most query vectors coalesced into one search")
+    parser.add_argument('--max_wait_ms', type=float, default=5.0,
+                        help="How long the first request of a micro-batch waits for others")
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    add_search_index_args(parser)
+    args = parser.parse_args()
+    check_search_index_args(parser, args)
+
+    uvicorn.run(create_app(args), host=args.host, port=args.port)
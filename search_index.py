@@ -0,0 +1,249 @@
+import os
+import numpy as np
+import torch
+from tqdm import tqdm
+from embedding_store import store_digest, npz_path
+from quantization import (kmeans, _training_sample, quantized_search, build_quantizer, save_quantizer, load_quantizer,
+                          quantizer_params)
+
+# Every index answers search(queries, k) -> (similarities, indices), both (Q, k),
+# with raw inner products of L2-normalized embeddings and indices into the
+# database rows. Callers apply the logit scale themselves.
+
+
+def blocked_topk(queries, embeddings, k, max_memory_mb=4096, excluded_rows=None):
+    """Exact top-k of queries @ embeddings.T without materialising the full Q x N matrix.
+
+    The database is streamed once in row blocks (so it may be a memory-mapped CPU
+    tensor while the queries live on GPU); each block is scored against tiles of
+    queries and merged into a running top-k. Block sizes are derived from
+    `max_memory_mb`, which bounds the working set instead of Q x N.
+    `excluded_rows` (optional (N,) bool mask) drops rows from the search; when fewer
+    than k rows remain, the missing results are padded with index -1 and score -inf.
+    """
+    device = queries.device
+    num_queries, dim = queries.shape
+    num_rows = len(embeddings)
+    k = min(k, num_rows)
+    budget = max_memory_mb * 2**20
+    # A quarter of the budget for the database block, half for similarity tiles
+    # (scores plus the concatenated merge buffer).
+    db_block = max(k, min(num_rows, budget // (4 * 4 * dim)))
+    query_block = max(1, min(num_queries, (budget // 2) // (8 * (db_block + k))))
+
+    queries = queries.float()
+    top_values = torch.full((num_queries, k), float('-inf'), device=device)
+    top_indices = torch.zeros((num_queries, k), dtype=torch.long, device=device)
+    if excluded_rows is not None:
+        excluded_rows = excluded_rows.to(device)
+    for start in range(0, num_rows, db_block):
+        block = embeddings[start:start + db_block].to(device).float()
+        for q_start in range(0, num_queries, query_block):
+            q_end = q_start + query_block
+            scores = queries[q_start:q_end] @ block.T
+            if excluded_rows is not None:
+                scores.masked_fill_(excluded_rows[start:start + len(block)], float('-inf'))
+            block_values, block_indices = torch.topk(scores, k=min(k, len(block)), dim=1)
+            merged_values = torch.cat([top_values[q_start:q_end], block_values], dim=1)
+            merged_indices = torch.cat([top_indices[q_start:q_end], block_indices + start], dim=1)
+            top_values[q_start:q_end], order = torch.topk(merged_values, k=k, dim=1)
+            top_indices[q_start:q_end] = merged_indices.gather(1, order)
+    if excluded_rows is not None:
+        top_indices.masked_fill_(top_values == float('-inf'), -1)
+    return top_values, top_indices
+
+
+class FlatIndex():
+    kind = 'flat'
+
+    def __init__(self, embeddings, max_memory_mb=4096):
+        self.embeddings = embeddings
+        self.max_memory_mb = max_memory_mb
+
+    def search(self, queries, k):
+        return blocked_topk(queries, self.embeddings, k, max_memory_mb=self.max_memory_mb)
+
+
+class QuantizedFlatIndex():
+    kind = 'flat'
+
+    def __init__(self, quantizer, embeddings, rescore_factor=4):
+        self.quantizer = quantizer
+        self.embeddings = embeddings
+        self.rescore_factor = rescore_factor
+
+    def search(self, queries, k):
+        return quantized_search(self.quantizer, queries, self.embeddings, k, rescore_factor=self.rescore_factor)
+
+
+class IVFIndex():
+    """Inverted file index: k-means coarse quantizer plus one posting list per centroid."""
+    kind = 'ivf'
+
+    def __init__(self, embeddings, nlist=1024, nprobe=16):
+        self.embeddings = embeddings
+        # nlist may be clamped to the training size; the requested value keys the saved index.
+        self.requested_nlist = nlist
+        self.nlist = nlist
+        self.nprobe = nprobe
+
+    def build(self, device='cpu', num_iters=20, max_train_size=262144, batch_size=65536):
+        train = _training_sample(self.embeddings, max_train_size).to(device)
+        self.nlist = min(self.nlist, len(train))
+        centroids = kmeans(train, self.nlist, num_iters=num_iters)
+        self.centroids = centroids / centroids.norm(dim=-1, keepdim=True)
+        assignments = torch.cat([
+            (self.embeddings[start:start + batch_size].float().to(device) @ self.centroids.T).argmax(dim=1).cpu()
+            for start in tqdm(range(0, len(self.embeddings), batch_size), desc="Assigning posting lists")
+        ])
+        # Rows grouped by list: list c holds order[offsets[c]:offsets[c + 1]].
+        self.order = torch.argsort(assignments, stable=True)
+        self.offsets = torch.zeros(self.nlist + 1, dtype=torch.long)
+        self.offsets[1:] = torch.cumsum(torch.bincount(assignments, minlength=self.nlist), dim=0)
+        return self
+
+    def _probe_counts(self, probe_orders, k):
+        """Lists probed per query: at least nprobe, and more while they hold fewer than k rows."""
+        sizes = (self.offsets[1:] - self.offsets[:-1])[probe_orders]
+        reach_k = (sizes.cumsum(dim=1) < k).sum(dim=1) + 1
+        return reach_k.clamp(min=self.nprobe).clamp(max=self.nlist)
+
+    def search(self, queries, k):
+        """Probe lists for all queries at once: every probed list is scored once against the queries probing it."""
+        device = self.centroids.device
+        k = min(k, self.num_rows())
+        batch = queries.float().to(device)
+        probe_orders = torch.argsort(batch @ self.centroids.T, dim=1, descending=True).cpu()
+        counts = self._probe_counts(probe_orders, k)
+        probed = torch.arange(probe_orders.shape[1]) < counts.unsqueeze(1)
+        query_rows, ranks = probed.nonzero(as_tuple=True)
+        lists = probe_orders[query_rows, ranks]
+        order = torch.argsort(lists, stable=True)
+        list_ids, list_counts = torch.unique_consecutive(lists[order], return_counts=True)
+
+        # Padded with -inf / -1 where a query reaches fewer than k rows.
+        top_values = torch.full((len(batch), k), float('-inf'), device=device)
+        top_indices = torch.full((len(batch), k), -1, dtype=torch.long, device=device)
+        for c, probing in zip(list_ids.tolist(), torch.split(query_rows[order], list_counts.tolist())):
+            rows = self.order[self.offsets[c]:self.offsets[c + 1]]
+            if len(rows) == 0:
+                continue
+            probing = probing.to(device)
+            block = self.embeddings[rows.to(self.embeddings.device)].float().to(device)
+            block_values, positions = torch.topk(batch[probing] @ block.T, k=min(k, len(rows)), dim=1)
+            merged_values = torch.cat([top_values[probing], block_values], dim=1)
+            merged_indices = torch.cat([top_indices[probing], rows.to(device)[positions]], dim=1)
+            top_values[probing], best = torch.topk(merged_values, k=k, dim=1)
+            top_indices[probing] = merged_indices.gather(1, best)
+        return top_values.to(queries.device), top_indices.to(queries.device)
+
+    def save(self, path, digest=''):
+        np.savez(path, kind=self.kind, centroids=self.centroids.cpu().numpy(),
+                 order=self.order.numpy(), offsets=self.offsets.numpy(), digest=digest, nlist=self.requested_nlist)
+
+    def load(self, path, device='cpu'):
+        state = np.load(path)
+        self.centroids = torch.from_numpy(state['centroids']).to(device)
+        self.order = torch.from_numpy(state['order'])
+        self.offsets = torch.from_numpy(state['offsets'])
+        self.nlist = len(self.centroids)
+        # Files written before the digest was stored never match, so they are rebuilt once.
+        self.digest = str(state['digest']) if 'digest' in state else None
+        self.saved_nlist = int(state['nlist']) if 'nlist' in state else None
+        return self
+
+    def num_rows(self):
+        return self.offsets[-1].item()
+
+
+def add_search_index_args(parser):
+    parser.add_argument('--max_memory_mb', type=int, default=4096,
+                        help="Working-set budget of exact flat search; queries and database are tiled to fit it")
+    parser.add_argument('--index', type=str, default='flat', choices=['flat', 'ivf'],
+                        help="Search structure: exact flat search or an IVF index built once and saved")
+    parser.add_argument('--nlist', type=int, default=1024,
+                        help="Number of IVF posting lists (k-means centroids)")
+    parser.add_argument('--nprobe', type=int, default=16,
+                        help="Number of IVF lists probed per query (recall vs. speed)")
+    parser.add_argument('--index_path', type=str, default=None,
+                        help="Where to save/load the IVF index (default: inside the database folder)")
+    parser.add_argument('--resident_db_mb', type=int, default=8192,
+                        help="Keep the database matrix on the search device when it is at most this large (0 to always stream it)")
+    parser.add_argument('--quantization', type=str, default='none', choices=['none', 'fp16', 'int8', 'pq'],
+                        help="Search compressed database codes, then rescore the shortlist exactly")
+    parser.add_argument('--rescore_factor', type=int, default=4,
+                        help="Shortlist pre_top_k * rescore_factor candidates from the codes for exact rescoring")
+    parser.add_argument('--pq_subspaces', type=int, default=64,
+                        help="Number of product-quantization subspaces (one byte each per vector)")
+    parser.add_argument('--quantized_path', type=str, default=None,
+                        help="Where to cache the database codes (default: inside the database folder)")
+
+
+def place_database(db_embeddings, device, resident_db_mb):
+    """Move the database matrix to the search device once when it fits, so searches stop re-streaming it.
+
+    It fits when it is at most `resident_db_mb` and takes at most half of the free
+    device memory. Returns (embeddings, resident); a CPU search device always counts as resident.
+    """
+    if torch.device(device).type == 'cpu':
+        return db_embeddings, True
+    size = db_embeddings.numel() * db_embeddings.element_size()
+    if size > resident_db_mb * 2**20:
+        return db_embeddings, False
+    if torch.device(device).type == 'cuda' and size > torch.cuda.mem_get_info(device)[0] // 2:
+        return db_embeddings, False
+    return db_embeddings.to(device), True
+
+
+def get_quantizer(args, db_embeddings, device, db_ids=None):
+    """Load cached codes when they were built from these rows with the same quantizer parameters, else rebuild."""
+    quantized_path = npz_path(args.quantized_path or os.path.join(args.database_folder, f"quantized_{args.quantization}.npz"))
+    kwargs = {'num_subspaces': args.pq_subspaces} if args.quantization == 'pq' else {}
+    params = quantizer_params(args.quantization, **kwargs)
+    digest = store_digest(args.database_folder, db_ids if db_ids is not None else [])
+    if os.path.exists(quantized_path):
+        quantizer, saved_digest, saved_params = load_quantizer(quantized_path, device=device)
+        if quantizer.name == args.quantization and saved_digest == digest and saved_params == params \
+                and len(quantizer.codes) == len(db_embeddings):
+            return quantizer
+        print(f"⚠️ {quantized_path} was built from other database rows or parameters, rebuilding it")
+    quantizer = build_quantizer(args.quantization, db_embeddings.numpy(), device=device, **kwargs)
+    save_quantizer(quantizer, quantized_path, digest=digest, params=params)
+    print(f"Saved {args.quantization} codes to {quantized_path}")
+    return quantizer
+
+
+def check_search_index_args(parser, args):
+    """Reject flag combinations that would otherwise be silently ignored."""
+    if args.index == 'ivf' and args.quantization != 'none':
+        parser.error("--quantization is only supported with --index flat")
+
+
+def build_search_index(args, db_embeddings, device, quantizer=None, db_ids=None):
+    """Create the index selected by --index, loading a saved IVF index when it was built from these rows.
+
+    `db_ids` are the row ids; with the store's manifest they identify the rows a saved index was built from.
+    """
+    if args.index == 'flat':
+        if quantizer is not None:
+            return QuantizedFlatIndex(quantizer, db_embeddings, rescore_factor=args.rescore_factor)
+        return FlatIndex(db_embeddings, max_memory_mb=args.max_memory_mb)
+
+    if args.index == 'ivf':
+        if quantizer is not None:
+            raise ValueError("--quantization is only supported with --index flat")
+        index_path = npz_path(args.index_path or os.path.join(args.database_folder, f"index_ivf{args.nlist}.npz"))
+        digest = store_digest(args.database_folder, db_ids if db_ids is not None else [])
+        index = IVFIndex(db_embeddings, nlist=args.nlist, nprobe=args.nprobe)
+        if os.path.exists(index_path):
+            index.load(index_path, device=device)
+            if index.digest == digest and index.saved_nlist == args.nlist and index.num_rows() == len(db_embeddings):
+                return index
+            print(f"⚠️ {index_path} was built from other database rows or another --nlist, rebuilding it")
+            index = IVFIndex(db_embeddings, nlist=args.nlist, nprobe=args.nprobe)
+        index.build(device=device)
+        index.save(index_path, digest=digest)
+        print(f"Saved IVF index with {index.nlist} lists to {index_path}")
+        return index
+
+    raise ValueError(f"Unsupported index: {args.index}")
@@ -0,0 +1,278 @@
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+import torch
+from embedding_store import EmbeddingStore, EmbeddingStoreWriter, is_embedding_store
+from search_index import blocked_topk
+
+# Layout of a segmented database folder:
+#   segments.json        list of live segments, replaced atomically on every change
+#   segments/<name>/     one embedding store per append (or per compaction)
+#   tombstones.txt       append-only "<generation>\t<image_id>" deletes
+#   .lock                flock()ed by every change, so several processes can share the folder
+# Every segment has a generation; a row is dead when its id has a tombstone of
+# the same or a later generation. Deleting or re-adding an id therefore never
+# touches existing segments, and compaction rewrites the live rows into one
+# segment without changing any image id.
+SEGMENTS_FILE = 'segments.json'
+SEGMENTS_DIR = 'segments'
+TOMBSTONES_FILE = 'tombstones.txt'
+LOCK_FILE = '.lock'
+
+
+def is_segmented_index(folder):
+    return os.path.exists(os.path.join(folder, SEGMENTS_FILE))
+
+
+def check_segmented_args(parser, args):
+    """A segmented database only supports exact flat search; reject flags it would otherwise ignore."""
+    if not is_segmented_index(args.database_folder):
+        return
+    if args.index != 'flat' or args.quantization != 'none':
+        parser.error("a segmented database only supports --index flat without --quantization")
+    if getattr(args, 'rescore', 'none') != 'none':
+        parser.error("--rescore needs a plain database store, not a segmented one")
+
+
+def _read_tombstones(path):
+    tombstones = {}
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                generation, image_id = line.rstrip('\n').split('\t', 1)
+                tombstones[image_id] = max(int(generation), tombstones.get(image_id, -1))
+    return tombstones
+
+
+class SegmentedIndex():
+    """Append-only flat index over several embedding stores, with tombstoned deletes.
+
+    search() follows the search_index contract; indices point into `self.ids`
+    as it was when search() was called. Changes hold a thread lock plus an flock()
+    on the folder's lock file and reload the on-disk state first, so other threads
+    and other processes (e.g. `add` while another process compacts) never overwrite
+    each other's segment list.
+    """
+    kind = 'segmented'
+
+    def __init__(self, folder, max_memory_mb=4096):
+        self.folder = folder
+        self.max_memory_mb = max_memory_mb
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(folder, SEGMENTS_DIR), exist_ok=True)
+        self.refresh()
+
+    def _path(self, *parts):
+        return os.path.join(self.folder, *parts)
+
+    @contextmanager
+    def _exclusive(self):
+        with self.lock, open(self._path(LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._reload()
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def refresh(self):
+        """(Re)load the segment list and tombstones from disk."""
+        with self._exclusive():
+            pass
+
+    def _reload(self):
+        if is_segmented_index(self.folder):
+            with open(self._path(SEGMENTS_FILE), 'r', encoding='utf-8') as f:
+                self.state = json.load(f)
+        else:
+            self.state = {'generation': 0, 'next_segment': 0, 'segments': []}
+        self.tombstones = _read_tombstones(self._path(TOMBSTONES_FILE))
+        self._load_segments()
+
+    def _load_segments(self):
+        self.segments = [
+            (segment['generation'], EmbeddingStore(self._path(SEGMENTS_DIR, segment['name'])))
+            for segment in self.state['segments']
+        ]
+        self.ids = [image_id for _, store in self.segments for image_id in store.ids]
+
+    def _save_state(self):
+        tmp_path = self._path(SEGMENTS_FILE + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self._path(SEGMENTS_FILE))
+
+    def _dead_rows(self, generation, store):
+        return [row for row, image_id in enumerate(store.ids) if self.tombstones.get(image_id, -1) >= generation]
+
+    def _tombstone(self, image_ids, generation):
+        with open(self._path(TOMBSTONES_FILE), 'a', encoding='utf-8') as f:
+            f.writelines(f"{generation}\t{image_id}\n" for image_id in image_ids)
+            f.flush()
+            os.fsync(f.fileno())
+        for image_id in image_ids:
+            self.tombstones[image_id] = max(generation, self.tombstones.get(image_id, -1))
+
+    def __len__(self):
+        return sum(len(store) - len(self._dead_rows(generation, store)) for generation, store in self.segments)
+
+    def __contains__(self, image_id):
+        return any(image_id in store and self.tombstones.get(image_id, -1) < generation
+                   for generation, store in self.segments)
+
+    def live_ids(self):
+        return [image_id for generation, store in self.segments for image_id in store.ids
+                if self.tombstones.get(image_id, -1) < generation]
+
+    def add(self, image_ids, embeddings, batch_size=65536):
+        """Append rows as a new segment. Ids that are already live are replaced."""
+        if len(image_ids) == 0:
+            return
+        with self._exclusive():
+            existing = [image_id for image_id in image_ids if image_id in self]
+            if existing:
+                self._tombstone(existing, self.state['generation'])
+            generation = self.state['generation'] + 1
+            name = f"segment_{self.state['next_segment']:06d}"
+            with EmbeddingStoreWriter(self._path(SEGMENTS_DIR, name)) as writer:
+                for start in range(0, len(image_ids), batch_size):
+                    writer.append(image_ids[start:start + batch_size], embeddings[start:start + batch_size])
+            self.state['segments'].append({'name': name, 'generation': generation})
+            self.state['generation'] = generation
+            self.state['next_segment'] += 1
+            self._save_state()
+            self._load_segments()
+        print(f"➕ Added {len(image_ids)} embeddings as {name} ({len(existing)} replaced)")
+
+    def delete(self, image_ids):
+        """Tombstone ids; their rows are masked at search time until compaction drops them."""
+        with self._exclusive():
+            image_ids = [image_id for image_id in image_ids if image_id in self]
+            if image_ids:
+                self._tombstone(image_ids, self.state['generation'])
+        print(f"🪦 Tombstoned {len(image_ids)} embeddings")
+        return len(image_ids)
+
+    def search(self, queries, k):
+        with self.lock:
+            segments, tombstones = list(self.segments), dict(self.tombstones)
+        all_values, all_indices = [], []
+        offset = 0
+        for generation, store in segments:
+            dead_rows = torch.tensor([tombstones.get(image_id, -1) >= generation for image_id in store.ids])
+            if not dead_rows.all():
+                # Tombstoned rows are masked while scoring, so each segment costs plain k.
+                values, indices = blocked_topk(queries, store.as_tensor('cpu'), k, max_memory_mb=self.max_memory_mb,
+                                               excluded_rows=dead_rows if dead_rows.any() else None)
+                all_values.append(values)
+                all_indices.append(torch.where(indices >= 0, indices + offset, indices))
+            offset += len(store)
+
+        if not all_values:
+            raise ValueError(f"Segmented index {self.folder} has no live rows")
+        values, indices = torch.cat(all_values, dim=1), torch.cat(all_indices, dim=1)
+        top_values, order = torch.topk(values, k=min(k, values.shape[1]), dim=1)
+        # Fewer than k live rows: the rest is padding (-1 / -inf), as in IVFIndex.search.
+        return top_values, indices.gather(1, order).masked_fill_(top_values == float('-inf'), -1)
+
+    def needs_compaction(self, max_segments=8, max_dead_fraction=0.2):
+        num_rows = sum(len(store) for _, store in self.segments)
+        num_dead = num_rows - len(self)
+        return len(self.segments) > max_segments or num_dead > max_dead_fraction * max(num_rows, 1)
+
+    def compact(self, batch_size=65536):
+        """Rewrite the live rows of the current segments into one segment.
+
+        Appends and deletes may continue while this runs, in this or another
+        process: segments added meanwhile are kept as they are, and tombstones
+        written meanwhile are kept. If another compaction replaced the same
+        segments first, this one is dropped.
+        """
+        with self._exclusive():
+            if len(self.segments) <= 1 and not self.tombstones:
+                return
+            snapshot = list(self.segments)
+            snapshot_names = {segment['name'] for segment in self.state['segments']}
+            generation = self.state['generation']
+            tombstones = dict(self.tombstones)
+            name = f"segment_{self.state['next_segment']:06d}"
+            self.state['next_segment'] += 1
+            self._save_state()
+            tombstones_path = self._path(TOMBSTONES_FILE)
+            num_tombstone_bytes = os.path.getsize(tombstones_path) if os.path.exists(tombstones_path) else 0
+
+        num_live = 0
+        with EmbeddingStoreWriter(self._path(SEGMENTS_DIR, name)) as writer:
+            for segment_generation, store in snapshot:
+                live_rows = [row for row, image_id in enumerate(store.ids)
+                             if tombstones.get(image_id, -1) < segment_generation]
+                for start in range(0, len(live_rows), batch_size):
+                    rows = live_rows[start:start + batch_size]
+                    writer.append([store.ids[row] for row in rows], store.embeddings[rows])
+                num_live += len(live_rows)
+
+        with self._exclusive():
+            superseded = not snapshot_names <= {segment['name'] for segment in self.state['segments']}
+            if not superseded:
+                # The compacted segment keeps the snapshot generation, so tombstones
+                # written during compaction still apply to its rows.
+                later_segments = [segment for segment in self.state['segments'] if segment['name'] not in snapshot_names]
+                compacted = [{'name': name, 'generation': generation}] if num_live else []
+                self.state['segments'] = compacted + later_segments
+                self._save_state()
+                later_tombstones = ''
+                if os.path.exists(tombstones_path):
+                    with open(tombstones_path, 'r', encoding='utf-8') as f:
+                        f.seek(num_tombstone_bytes)
+                        later_tombstones = f.read()
+                tmp_path = tombstones_path + '.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(later_tombstones)
+                os.replace(tmp_path, tombstones_path)
+                self.tombstones = _read_tombstones(tombstones_path)
+                self._load_segments()
+        if superseded:
+            shutil.rmtree(self._path(SEGMENTS_DIR, name), ignore_errors=True)
+            print(f"⚠️ Segments were compacted by another process meanwhile, dropped {name}")
+            return
+        if not num_live:
+            shutil.rmtree(self._path(SEGMENTS_DIR, name), ignore_errors=True)
+        for segment_name in snapshot_names:
+            shutil.rmtree(self._path(SEGMENTS_DIR, segment_name), ignore_errors=True)
+        print(f"🧹 Compacted {len(snapshot)} segments into {name} ({num_live} live rows)")
+
+
+def _read_id_list(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Maintain an append-only segmented database index")
+    parser.add_argument('--index_folder', type=str, required=True)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add_parser = subparsers.add_parser('add', help="Append the rows of an embedding store as a new segment")
+    add_parser.add_argument('--store_folder', type=str, required=True)
+    add_parser.add_argument('--compact', action='store_true', help="Compact afterwards if there are many segments or tombstones")
+    delete_parser = subparsers.add_parser('delete', help="Tombstone the ids listed in a file (one per line)")
+    delete_parser.add_argument('--ids_file', type=str, required=True)
+    subparsers.add_parser('compact', help="Merge all segments and drop tombstoned rows")
+    args = parser.parse_args()
+
+    index = SegmentedIndex(args.index_folder)
+    if args.command == 'add':
+        if not is_embedding_store(args.store_folder):
+            raise FileNotFoundError(f"No embedding store in {args.store_folder}")
+        store = EmbeddingStore(args.store_folder)
+        index.add(store.ids, store.embeddings)
+        if args.compact and index.needs_compaction():
+            index.compact()
+    elif args.command == 'delete':
+        index.delete(_read_id_list(args.ids_file))
+    else:
+        index.compact()
+    print(f"✅ {args.index_folder}: {len(index)} live rows in {len(index.segments)} segments")
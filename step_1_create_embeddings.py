@@ -1,50 +1,256 @@
 import argparse
 import os
+import shutil
+import time
 from tqdm import tqdm
 import torch
 from internvl import CustonInternVLRetrievalModel
+from image_dataset import build_image_loader
+from embedding_store import EmbeddingStore, EmbeddingStoreWriter, is_embedding_store, drop_rows
+from embedding_manifest import load_manifest, save_manifest, new_manifest, plan_incremental_update
+from work_queue import FileLeaseQueue
+
+
+def image_id_of(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def output_targets(args):
+    """(mode, store folder) pairs written by this job; the first one is --mode / --output_folder."""
+    extra_modes = args.extra_modes or []
+    extra_folders = args.extra_output_folders or []
+    if len(extra_modes) != len(extra_folders):
+        raise ValueError("--extra_modes and --extra_output_folders must have the same length")
+    return [(args.mode, args.output_folder)] + list(zip(extra_modes, extra_folders))
+
+
+def encode_images(embedding_model, image_files, targets, args, wanted_ids=None, on_batch=None):
+    """Encode images once and append every requested mode to its store.
+
+    wanted_ids: optional {mode: set of image ids} restricting which rows each store receives.
+    """
+    loader = build_image_loader(image_files, embedding_model.image_processor, batch_size=args.batch_size,
+                                num_workers=args.num_workers, fast_decode=not args.full_decode)
+    modes = [mode for mode, _ in targets]
+
+    encoded_ids = []
+    failed_ids = []
+    start_time = time.time()
+    writers = [EmbeddingStoreWriter(folder) for _, folder in targets]
+    with tqdm(total=len(image_files), desc="Generating Embeddings") as pbar:
+        for paths, pixel_values, failed_paths in loader:
+            failed_ids.extend(image_id_of(path) for path in failed_paths)
+            if paths:
+                # One vision pass serves every requested head.
+                embeddings = embedding_model.encode_pixel_values_multi(pixel_values, modes=modes)
+                names = [image_id_of(path) for path in paths]
+                for (mode, _), writer in zip(targets, writers):
+                    rows = [row for row, name in enumerate(names)
+                            if wanted_ids is None or name in wanted_ids[mode]]
+                    writer.append([names[row] for row in rows], embeddings[mode][rows])
+                encoded_ids.extend(names)
+            if on_batch is not None:
+                on_batch()
+            pbar.update(len(paths) + len(failed_paths))
+            pbar.set_postfix(img_per_sec=f"{len(encoded_ids) / max(time.time() - start_time, 1e-6):.1f}")
+    for writer in writers:
+        writer.close()
+
+    elapsed = time.time() - start_time
+    print(f"⚡ Encoded {len(encoded_ids)} images ({', '.join(modes)}) in {elapsed:.1f}s "
+          f"({len(encoded_ids) / max(elapsed, 1e-6):.1f} images/sec), skipped {len(failed_ids)} unreadable images")
+    return encoded_ids, failed_ids
+
+
+def merge_chunk_stores(args, output_folder, mode, part_folders, entries, stale_ids, to_encode):
+    part_folders = [folder for folder in part_folders if is_embedding_store(folder)]
+    encode_ids = {image_id_of(path) for path in to_encode}
+    num_dropped = drop_rows(output_folder, stale_ids)
+
+    merged_ids = set()
+    with EmbeddingStoreWriter(output_folder) as writer:
+        for part_folder in part_folders:
+            part_manifest = load_manifest(part_folder)
+            if part_manifest is None or (part_manifest['model_name'], part_manifest['mode']) != (args.model_name, mode):
+                print(f"⚠️ Skipping {part_folder}: it was not produced with {args.model_name} / {mode}")
+                continue
+            part_store = EmbeddingStore(part_folder)
+            # Only take rows that still describe the current file contents.
+            rows = [
+                row for row, image_id in enumerate(part_store.ids)
+                if image_id in encode_ids and image_id not in merged_ids
+                and part_manifest['images'].get(image_id, {}).get('hash') == entries[image_id]['hash']
+            ]
+            writer.append([part_store.ids[row] for row in rows], part_store.embeddings[rows])
+            merged_ids.update(part_store.ids[row] for row in rows)
+
+    images = {image_id: entry for image_id, entry in entries.items() if image_id not in encode_ids or image_id in merged_ids}
+    save_manifest(output_folder, new_manifest(args.model_name, mode, images))
+    print(f"✅ Merged {len(merged_ids)} {mode} embeddings from {len(part_folders)} chunks into {output_folder}, "
+          f"dropped {num_dropped} stale rows ({len(encode_ids) - len(merged_ids)} images still missing)")
+
+
+def run_queue_worker(args, device, targets, plan_all):
+    queue = FileLeaseQueue(args.queue_dir, lease_seconds=args.lease_seconds, worker_id=args.worker_id)
+
+    def make_items():
+        to_encode, entries, wanted_ids, _ = plan_all()
+        # Every item records which stores still need it.
+        return [[path, entries[image_id_of(path)], [mode for mode, _ in targets if image_id_of(path) in wanted_ids[mode]]]
+                for path in to_encode]
+
+    queue.initialize(make_items, args.chunk_size)
+
+    embedding_model = None
+    num_chunks = 0
+    while (chunk := queue.acquire()) is not None:
+        items = queue.load_items(chunk)
+        if embedding_model is None:
+            embedding_model = CustonInternVLRetrievalModel(model_name=args.model_name, device=device)
+            if args.full_decode:
+                embedding_model.decode_size = None
+        result_folder = queue.result_folder(chunk)
+        print(f"🔹 Worker {queue.worker_id}: chunk {chunk} ({len(items)} images)")
+        chunk_targets = [(mode, os.path.join(result_folder, mode)) for mode, _ in targets]
+        wanted_ids = {mode: {image_id_of(path) for path, _, modes in items if mode in modes} for mode, _ in targets}
+        encode_images(embedding_model, [path for path, _, _ in items], chunk_targets, args,
+                      wanted_ids=wanted_ids, on_batch=lambda: queue.heartbeat(chunk))
+        if args.verify_samples > 0 and num_chunks == 0:
+            # Checked on the first chunk of every worker, so each node's encoder is verified once.
+            samples = [path for path, _, _ in items[:args.verify_samples]]
+            for mode, folder in chunk_targets:
+                if is_embedding_store(folder):
+                    verify_against_single_image_path(embedding_model, samples, folder, mode)
+        entries = {image_id_of(path): entry for path, entry, _ in items}
+        for mode, folder in chunk_targets:
+            stored_ids = EmbeddingStore(folder).ids if is_embedding_store(folder) else []
+            save_manifest(folder, new_manifest(args.model_name, mode,
+                                               {image_id: entries[image_id] for image_id in stored_ids}))
+        if not queue.complete(chunk, result_folder):
+            print(f"⚠️ Chunk {chunk} was already finished by another worker, discarding this copy")
+            shutil.rmtree(result_folder, ignore_errors=True)
+        num_chunks += 1
+    print(f"✅ Worker {queue.worker_id} finished {num_chunks} chunks; queue complete: {queue.all_done()}")
+
 
 def main():
     parser = argparse.ArgumentParser(description="Generate image embeddings using CustonInternVLRetrievalModel.")
-    parser.add_argument("--part", type=int, default=None, help="Part number to process (1-based index).")
-    parser.add_argument("--total_parts", type=int, default=4, help="Total number of parts to split workload.")
+    parser.add_argument("--queue_dir", type=str, default=None,
+                        help="Shared work-queue folder. Any number of workers on any node may join the same queue.")
+    parser.add_argument("--chunk_size", type=int, default=1024, help="Images per work-queue chunk.")
+    parser.add_argument("--lease_seconds", type=int, default=600,
+                        help="A chunk without heartbeat for this long is handed to another worker.")
+    parser.add_argument("--worker_id", type=str, default=None, help="Worker name in the queue (default: host-pid).")
+    parser.add_argument("--merge_queue", action="store_true", help="Merge finished queue chunks into the output store.")
     parser.add_argument("--device", type=str, default="cuda:0", help="Torch device (e.g., 'cuda:0', 'cpu').")
+    parser.add_argument("--model_name", type=str, default="OpenGVLab/InternVL-14B-224px", help="Retrieval model to embed with.")
+    parser.add_argument("--mode", type=str, default="InternVL-G", choices=["InternVL-G", "InternVL-C"], help="Embedding head to use.")
+    parser.add_argument("--extra_modes", type=str, nargs='*', default=[], choices=["InternVL-G", "InternVL-C"],
+                        help="Further heads computed from the same vision pass, each written to its own store.")
+    parser.add_argument("--extra_output_folders", type=str, nargs='*', default=[],
+                        help="Embedding store folder of each --extra_modes entry.")
     parser.add_argument("--input_folder", type=str, default="./data/database/database_origin/database_img/", help="Folder containing input images.")
-    parser.add_argument("--output_folder", type=str, default="./embeddings/database/", help="Folder to save output embeddings.")
+    parser.add_argument("--output_folder", type=str, default="./embeddings/database/", help="Embedding store folder to write to.")
+    parser.add_argument("--batch_size", type=int, default=1, help="Number of images encoded per forward pass.")
+    parser.add_argument("--num_workers", type=int, default=8, help="CPU workers decoding and preprocessing images ahead of the encoder.")
+    parser.add_argument("--full_decode", action="store_true",
+                        help="Decode images at full resolution instead of near the 224px encoder input size.")
+    parser.add_argument("--verify_samples", type=int, default=0,
+                        help="Re-encode this many images one by one and report the max difference "
+                             "(in queue mode, on the first chunk of every worker).")
 
     args = parser.parse_args()
+    if args.merge_queue and args.queue_dir is None:
+        parser.error("--merge_queue needs --queue_dir")
+    if args.merge_queue and args.verify_samples > 0:
+        parser.error("--verify_samples applies to encoding runs, not to --merge_queue")
     device = torch.device(args.device if torch.cuda.is_available() or "cpu" in args.device else "cpu")
+    targets = output_targets(args)
 
-    if not os.path.exists(args.output_folder):
-        os.makedirs(args.output_folder)
-
-    with torch.no_grad():
-        embedding_model = CustonInternVLRetrievalModel(device=device)
+    for _, folder in targets:
+        os.makedirs(folder, exist_ok=True)
 
+    def list_images():
         image_paths = [f for f in os.listdir(args.input_folder) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
         image_paths.sort()
+        image_files = [os.path.join(args.input_folder, image) for image in image_paths]
+        return [path for path in image_files if os.path.isfile(path)]
+
+    def plan(mode, folder, image_files, known_entries=None):
+        # Only new or changed images are encoded; rows of deleted or changed
+        # images are dropped from the store.
+        store_ids = EmbeddingStore(folder).ids if is_embedding_store(folder) else []
+        to_encode, entries, stale_ids = plan_incremental_update(
+            load_manifest(folder), store_ids, image_files, args.model_name, mode, known_entries=known_entries)
+        print(f"🔹 {mode} -> {folder}: {len(to_encode)} new or changed images, "
+              f"{len(image_files) - len(to_encode)} up to date, {len(stale_ids)} stale rows")
+        return to_encode, entries, stale_ids
+
+    def plan_all():
+        """Plan every store over the same files; images are encoded once if any store needs them."""
+        image_files = list_images()
+        plans = {}
+        entries = None
+        for mode, folder in targets:
+            plans[mode] = plan(mode, folder, image_files, known_entries=entries)
+            entries = plans[mode][1]
+        wanted_ids = {mode: {image_id_of(path) for path in plans[mode][0]} for mode, _ in targets}
+        needed = set().union(*wanted_ids.values())
+        to_encode = [path for path in image_files if image_id_of(path) in needed]
+        stale_ids = {mode: plans[mode][2] for mode, _ in targets}
+        return to_encode, entries, wanted_ids, stale_ids
+
+    with torch.no_grad():
+        if args.merge_queue:
+            queue = FileLeaseQueue(args.queue_dir)
+            if not queue.all_done():
+                print(f"⚠️ {len(queue.chunks()) - len(queue.done_chunks())} chunks are still pending; merging the finished ones")
+            image_files = list_images()
+            for mode, folder in targets:
+                to_encode, entries, stale_ids = plan(mode, folder, image_files)
+                part_folders = [os.path.join(part, mode) for part in queue.completed_results()]
+                merge_chunk_stores(args, folder, mode, part_folders, entries, stale_ids, to_encode)
+            if queue.all_done():
+                shutil.rmtree(args.queue_dir)
+            return
+
+        if args.queue_dir is not None:
+            run_queue_worker(args, device, targets, plan_all)
+            return
+
+        to_encode, entries, wanted_ids, stale_ids = plan_all()
+        for mode, folder in targets:
+            num_dropped = drop_rows(folder, stale_ids[mode])
+            print(f"🔹 Running Full Mode: {len(wanted_ids[mode])} {mode} images to encode, dropped {num_dropped} stale rows")
+
+        failed_ids = []
+        if to_encode:
+            embedding_model = CustonInternVLRetrievalModel(model_name=args.model_name, device=device)
+            if args.full_decode:
+                embedding_model.decode_size = None
+            _, failed_ids = encode_images(embedding_model, to_encode, targets, args, wanted_ids=wanted_ids)
+            if args.verify_samples > 0:
+                for mode, folder in targets:
+                    verify_against_single_image_path(embedding_model, to_encode[:args.verify_samples], folder, mode)
+
+        failed_ids = set(failed_ids)
+        images = {image_id: entry for image_id, entry in entries.items() if image_id not in failed_ids}
+        for mode, folder in targets:
+            save_manifest(folder, new_manifest(args.model_name, mode, images))
+
+
+def verify_against_single_image_path(embedding_model, image_files, store_folder, mode):
+    store = EmbeddingStore(store_folder)
+    max_diff = 0.0
+    for image_path in image_files:
+        name = image_id_of(image_path)
+        if name not in store:
+            continue
+        expected = embedding_model.encode_image([image_path], mode=mode, is_path=True).squeeze(0).cpu()
+        batched = torch.from_numpy(store.get([name])[1][0])
+        max_diff = max(max_diff, (expected.float() - batched.float()).abs().max().item())
+    print(f"🔎 Max abs difference vs. per-image encoding on {len(image_files)} samples: {max_diff:.3e}")
+
 
-        if args.part is not None:
-            assert 1 <= args.part <= args.total_parts, "part must be between 1 and total_parts"
-            total = len(image_paths)
-            split_size = total // args.total_parts
-            start = (args.part - 1) * split_size
-            end = total if args.part == args.total_parts else start + split_size
-            image_subset = image_paths[start:end]
-            print(f"🔹 Running Part {args.part}/{args.total_parts}: Processing {len(image_subset)} images")
-        else:
-            image_subset = image_paths
-            print(f"🔹 Running Full Mode: Processing all {len(image_subset)} images")
-
-        for image in tqdm(image_subset, desc="Generating Embeddings"):
-            name = os.path.splitext(image)[0]
-            image_path = os.path.join(args.input_folder, image)
-            if not os.path.isfile(image_path):
-                continue
-            embedding = embedding_model.encode_image([image_path], is_path=True).to(device)
-            embedding = embedding.squeeze(0)
-            output_path = os.path.join(args.output_folder, f"{name}.pt")
-            torch.save(embedding.cpu(), output_path)
-        
 if __name__ == "__main__":
     main()
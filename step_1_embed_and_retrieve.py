@@ -0,0 +1,131 @@
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+import torch
+from internvl import CustonInternVLRetrievalModel
+from image_dataset import build_image_loader
+from embedding_store import load_embeddings
+from search_index import (build_search_index, get_quantizer, place_database, add_search_index_args,
+                          check_search_index_args)
+from segmented_index import SegmentedIndex, is_segmented_index, check_segmented_args
+from retrieval_outputs import load_coeff, add_retrieval_output_args, write_retrieval_outputs
+from step_1_create_embeddings import image_id_of
+
+
+def embed_and_retrieve(embedding_model, image_files, index, args, search_block_size=None):
+    """Encode query images batch by batch and search them while the next batches are encoded.
+
+    Encoded queries are searched in blocks of `search_block_size` (default: every batch
+    on its own). When the database is streamed from CPU, a large block amortises one pass
+    over it across many queries. Query embeddings never leave memory; returns
+    (query_names, topk_similarities, topk_indices) with raw inner products on CPU.
+    """
+    loader = build_image_loader(image_files, embedding_model.image_processor, batch_size=args.batch_size,
+                                num_workers=args.num_workers, fast_decode=not args.full_decode)
+
+    def search(queries):
+        with torch.no_grad():
+            similarities, indices = index.search(queries, args.pre_top_k)
+        return similarities.cpu(), indices.cpu()
+
+    search_block_size = search_block_size or args.batch_size
+    query_names, pending, block = [], [], []
+    block_size = 0
+    num_failed = 0
+    start_time = time.time()
+    # One search thread: the GPU kernels of the search overlap with decoding and
+    # encoding of the next batch, and batches are searched in order.
+    with ThreadPoolExecutor(max_workers=1) as search_pool, \
+            tqdm(total=len(image_files), desc="Embedding and searching queries") as pbar:
+        for paths, pixel_values, failed_paths in loader:
+            num_failed += len(failed_paths)
+            if paths:
+                with torch.no_grad():
+                    embeddings = embedding_model.encode_pixel_values(pixel_values, mode=args.mode)
+                block.append(embeddings)
+                block_size += len(embeddings)
+                query_names.extend(image_id_of(path) for path in paths)
+                if block_size >= search_block_size:
+                    pending.append(search_pool.submit(search, torch.cat(block)))
+                    block, block_size = [], 0
+            pbar.update(len(paths) + len(failed_paths))
+            pbar.set_postfix(img_per_sec=f"{len(query_names) / max(time.time() - start_time, 1e-6):.1f}")
+        if block:
+            pending.append(search_pool.submit(search, torch.cat(block)))
+        results = [future.result() for future in pending]
+
+    elapsed = time.time() - start_time
+    print(f"⚡ Embedded and searched {len(query_names)} queries in {elapsed:.1f}s "
+          f"({len(query_names) / max(elapsed, 1e-6):.1f} queries/sec), skipped {num_failed} unreadable images")
+    topk_similarities = torch.cat([similarities for similarities, _ in results])
+    topk_indices = torch.cat([indices for _, indices in results])
+    return query_names, topk_similarities, topk_indices
+
+
+def main(args):
+    device = args.device if torch.cuda.is_available() else 'cpu'
+    if device == 'cpu':
+        torch.set_num_threads(os.cpu_count())
+
+    # The encoder is loaded first so the database is only kept on the device when it fits next to it.
+    embedding_model = CustonInternVLRetrievalModel(model_name=args.model_name, device=device)
+
+    search_block_size = None
+    if is_segmented_index(args.database_folder):
+        index = SegmentedIndex(args.database_folder, max_memory_mb=args.max_memory_mb)
+        db_image_names = index.ids
+        search_block_size = args.search_block_size
+        print(f"Loaded segmented database with {len(index)} live embeddings in {len(index.segments)} segments")
+    else:
+        db_embeddings, db_image_names = load_embeddings(args.database_folder, device='cpu')
+        print(f"Loaded {len(db_embeddings)} database embeddings of shape {db_embeddings.shape}")
+        quantizer = get_quantizer(args, db_embeddings, device, db_ids=db_image_names) if args.quantization != 'none' else None
+        if quantizer is None:
+            # The codes already live on the device; otherwise keep the float matrix there when it fits.
+            db_embeddings, resident = place_database(db_embeddings, device, args.resident_db_mb)
+            if not resident:
+                search_block_size = args.search_block_size
+                print(f"Database does not fit on {device}, searching queries in blocks of {search_block_size}")
+        index = build_search_index(args, db_embeddings, device, quantizer=quantizer, db_ids=db_image_names)
+    coeff = load_coeff(args.model_type, args.coeff_path, 'cpu')
+
+    image_files = sorted(
+        os.path.join(args.input_folder, f) for f in os.listdir(args.input_folder)
+        if f.lower().endswith(('.jpg', '.jpeg', '.png'))
+    )
+    print(f"🔹 {len(image_files)} query images in {args.input_folder}")
+
+    query_names, topk_similarities, topk_indices = embed_and_retrieve(embedding_model, image_files, index, args,
+                                                                         search_block_size=search_block_size)
+    topk_similarities = coeff * topk_similarities
+    print(topk_indices.size())
+
+    write_retrieval_outputs(args, query_names, db_image_names, topk_indices, topk_similarities)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Embed query images and retrieve from the database in one pass")
+    parser.add_argument('--input_folder', type=str, default='./data/track1_private/query/',
+                        help="Folder containing query images")
+    parser.add_argument('--database_folder', type=str, default='./embeddings/database_image_internVL_g/',
+                        help="Embedding store, segmented index or legacy folder of .pt files with database image embeddings")
+    parser.add_argument('--device', type=str, default='cuda:1', help="Encoder and search device")
+    parser.add_argument('--model_name', type=str, default='OpenGVLab/InternVL-14B-224px',
+                        help="Retrieval model to embed with (must match the database embeddings)")
+    parser.add_argument('--mode', type=str, default='InternVL-G', choices=['InternVL-G', 'InternVL-C'],
+                        help="Embedding head to use")
+    parser.add_argument('--batch_size', type=int, default=64, help="Query images encoded and searched per batch")
+    parser.add_argument('--search_block_size', type=int, default=4096,
+                        help="Queries accumulated per search when the database (or a segmented index) is streamed from CPU")
+    parser.add_argument('--num_workers', type=int, default=8,
+                        help="CPU workers decoding and preprocessing images ahead of the encoder")
+    parser.add_argument('--full_decode', action='store_true',
+                        help="Decode images at full resolution instead of near the 224px encoder input size")
+    add_retrieval_output_args(parser)
+    add_search_index_args(parser)
+    args = parser.parse_args()
+    check_search_index_args(parser, args)
+    check_segmented_args(parser, args)
+    main(args)
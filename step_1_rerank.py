@@ -5,11 +5,32 @@ from internvl import CustonInternVLCaptionModel, CustonInternVLRetrievalModel
 from tqdm import tqdm
 import torch 
 import os
-import torch.nn.functional as F
-
-
-def load_wrong_queries(wrong_sample_json_path):
-    with open(wrong_sample_json_path, 'r', encoding='utf-8') as f:
+import time
+from uncertainty import HardQuerySet, rerank_depths, add_depth_args
+from retrieval_scores import load_topk_scores
+from dedup import load_clusters
+from caption_cache import open_caption_cache
+from rerank_scoring import (score_caption_rerank, score_query_caption_rerank, score_cached_caption_rerank,
+                            rank_confidence, needs_escalation, image_similarity_matrix, EarlyStopper)
+from retrieval_outputs import load_coeff
+from embedding_store import EmbeddingStore
+from results_store import open_results_store, write_json_atomic
+
+QUERY_IMAGE_PATH = 'data/track1_private/query/'
+DATABASE_IMAGE_PATH = 'data/database/database_origin/database_img/'
+QUERY_CAPTION_MODEL = 'OpenGVLab/InternVL2_5-4B'
+DATABASE_CAPTION_MODEL = 'OpenGVLab/InternVL2_5-8B'
+# generate: caption the query and every candidate; query_caption: caption only the query and score it
+# against the stored candidate image embeddings; cached_captions: score the stored query image embedding
+# against candidate captions already in the caption cache; cascade: caption candidates with the small model
+# and re-caption them with the large one only for queries that are still undecided.
+RERANK_MODES = ['generate', 'query_caption', 'cached_captions', 'cascade']
+
+
+def load_wrong_queries(wrong_sample_path):
+    if wrong_sample_path.endswith('.npz'):
+        return HardQuerySet.load(wrong_sample_path)
+    with open(wrong_sample_path, 'r', encoding='utf-8') as f:
         wrong_samples = json.load(f)
     return {entry["query_id"] for entry in wrong_samples}
 
@@ -20,114 +41,365 @@ def extract_rerank_inputs(csv_path, wrong_query_ids, pre_top_k):
         for row in reader:
             query_id = row['query_id']
             if query_id in wrong_query_ids:
-                image_ids = [row[f'image_id_{i+1}'] for i in range(pre_top_k)]
+                # Empty cells (CSVs padded past the reachable rows) are not candidates.
+                image_ids = [row[f'image_id_{i+1}'] for i in range(pre_top_k) if row.get(f'image_id_{i+1}')]
                 rerank_inputs.append({
                     "query_id": query_id,
                     "top_k_candidates": image_ids,
                 })
+    if isinstance(wrong_query_ids, HardQuerySet):
+        # Most uncertain first, so a run that is cut short has already reranked the queries that matter most.
+        priority = {query_id: row for row, query_id in enumerate(wrong_query_ids)}
+        rerank_inputs.sort(key=lambda item: priority[item['query_id']])
     return rerank_inputs
 
-def create_caption_json(rerank_inputs, output_path):
-    caption_model_query = CustonInternVLCaptionModel(model_name='OpenGVLab/InternVL2_5-4B', device='cuda:7')
-    caption_model_db = CustonInternVLCaptionModel(model_name='OpenGVLab/InternVL2_5-8B', device='cuda:7')
-
-    query_image_path = 'data/track1_private/query/'
-    database_path = 'data/database/database_origin/database_img/'
-
-    results = []
+def new_cost():
+    return {'captions': 0, 'cached': 0, 'seconds': 0.0}
+
+
+def timed_short_caption(caption_model, image_file, cost=None, label='image'):
+    """Short caption of one image; generated captions, cache hits and GPU time are added to `cost`."""
+    cache = caption_model.caption_cache
+    hits = cache.hits if cache is not None else 0
+    start = time.perf_counter()
+    try:
+        caption = caption_model.generate__short_caption(image_file)
+    except Exception as e:
+        print(f"❌ Failed to caption {label} {image_file}: {e}")
+        caption = ""
+    if cost is not None:
+        cost['cached' if cache is not None and cache.hits > hits else 'captions'] += 1
+        cost['seconds'] += time.perf_counter() - start
+    return caption
+
+def caption_query(caption_model, query_id, cost=None):
+    return timed_short_caption(caption_model, os.path.join(QUERY_IMAGE_PATH, f"{query_id}.jpg"), cost, label='query')
+
+def caption_candidates(caption_model, candidate_ids, clusters=None, representative_captions=None, cost=None,
+                       early_stopper=None):
+    """[{image_id, caption}] of the candidates; near-duplicates reuse the caption of their cluster representative.
+
+    With an EarlyStopper, captioning stops as soon as the remaining candidates cannot change the top-1.
+    """
+    top_k_captions = []
+    for position, candidate_id in enumerate(candidate_ids):
+        if early_stopper is not None and position > 0 and early_stopper.decided(candidate_id):
+            break
+        representative_id = clusters.representative_of(candidate_id) if clusters is not None else candidate_id
+        if representative_captions is not None and representative_id in representative_captions:
+            caption = representative_captions[representative_id]
+        else:
+            candidate_image_file = os.path.join(DATABASE_IMAGE_PATH, f"{representative_id}.jpg")
+            caption = timed_short_caption(caption_model, candidate_image_file, cost, label='db image')
+            if clusters is not None and representative_captions is not None:
+                representative_captions[representative_id] = caption
+        top_k_captions.append({
+            "image_id": candidate_id,
+            "caption": caption
+        })
+        if early_stopper is not None:
+            early_stopper.add(candidate_id, caption)
+    return top_k_captions
+
+def reusable_captions(previous, candidate_ids, caption_models, allow_prefix=False):
+    """Whether a checkpointed caption record can stand in for captioning `candidate_ids` again.
+
+    Records name the model that captioned their candidates (`caption_model`); they are reused
+    only when it is one of `caption_models` and they cover the same candidates (a prefix of
+    them with `allow_prefix`, for early stopping). Records without it predate the field and
+    are redone.
+    """
+    if previous is None or previous.get('caption_model') not in caption_models:
+        return False
+    captioned_ids = [c['image_id'] for c in previous['top_k_captions']]
+    return captioned_ids == candidate_ids or (allow_prefix and captioned_ids == candidate_ids[:len(captioned_ids)])
+
+
+def create_caption_json(rerank_inputs, output_path, clusters=None, caption_cache=None, early_stop_slack=None,
+                        coeff_path='./logit_scale.pt', text_features=None):
+    """Caption every query and its candidates into `output_path`.
+
+    With early stopping, the caption features the stoppers encode are kept in the
+    `text_features` dict, so rerank_embeddings can reuse them.
+    """
+    caption_model_query = CustonInternVLCaptionModel(model_name=QUERY_CAPTION_MODEL, device='cuda:7',
+                                                     caption_cache=caption_cache)
+    caption_model_db = CustonInternVLCaptionModel(model_name=DATABASE_CAPTION_MODEL, device='cuda:7',
+                                                  caption_cache=caption_cache)
+    if early_stop_slack is not None:
+        retrieval_model = CustonInternVLRetrievalModel(device='cuda:7' if torch.cuda.is_available() else 'cpu')
+        coeff = load_coeff('internvl', coeff_path, 'cpu').float().squeeze()
+        image_similarity_dict = load_image_similarity()
+
+    # Each finished query is checkpointed, so a restarted run resumes where the last one stopped.
+    store = open_results_store(output_path, list_key='query_id')
+    # Near-duplicates share the caption of their cluster representative, which is generated once.
+    representative_captions = {}
+    num_candidates, num_captioned = 0, 0
 
     for item in tqdm(rerank_inputs, desc="Generating captions"):
         query_id = item['query_id']
-        query_image_file = os.path.join(query_image_path, f"{query_id}.jpg")
-        try:
-            query_caption = caption_model_query.generate__short_caption(query_image_file)
-        except Exception as e:
-            print(f"❌ Failed to caption query {query_image_file}: {e}")
-            query_caption = ""
-
-        top_k_captions = []
-        for candidate_id in item['top_k_candidates']:
-            candidate_image_file = os.path.join(database_path, f"{candidate_id}.jpg")
-            try:
-                caption = caption_model_db.generate__short_caption(candidate_image_file)
-            except Exception as e:
-                print(f"❌ Failed to caption db image {candidate_image_file}: {e}")
-                caption = ""
-            top_k_captions.append({
-                "image_id": candidate_id,
-                "caption": caption
-            })
-
-        results.append({
+        previous = store.get(query_id)
+        # Captions a cascade run left with the small model are not reused here.
+        if reusable_captions(previous, item['top_k_candidates'], (DATABASE_CAPTION_MODEL,),
+                             allow_prefix=early_stop_slack is not None):
+            num_candidates += len(item['top_k_candidates'])
+            num_captioned += len(previous['top_k_captions'])
+            continue
+        query_caption = caption_query(caption_model_query, query_id)
+        early_stopper = None
+        if early_stop_slack is not None:
+            early_stopper = EarlyStopper(retrieval_model, coeff, query_caption, image_similarity_dict.get(query_id, {}),
+                                         slack=early_stop_slack, text_features=text_features)
+        top_k_captions = caption_candidates(caption_model_db, item['top_k_candidates'], clusters=clusters,
+                                            representative_captions=representative_captions,
+                                            early_stopper=early_stopper)
+        num_candidates += len(item['top_k_candidates'])
+        num_captioned += len(top_k_captions)
+
+        store.append(query_id, {
             "query_id": query_id,
             "query_caption": query_caption,
-            "top_k_captions": top_k_captions
+            "top_k_captions": top_k_captions,
+            "caption_model": DATABASE_CAPTION_MODEL,
         })
-        # Save final caption JSON
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(results, f, indent=2, ensure_ascii=False)
-        print(f"✅ Captions saved to: {output_path} (total: {len(results)})")
-
-
-
-
-
-def rerank_embeddings(rerank_input_path, output_path):
+    results = store.export_json(output_path, keys=[item['query_id'] for item in rerank_inputs], as_list=True)
+    store.close()
+    print(f"✅ Captions saved to: {output_path} (total: {len(results)})")
+    if early_stop_slack is not None:
+        print(f"⏹️ Early stopping captioned {num_captioned}/{num_candidates} candidates "
+              f"({num_candidates - num_captioned} captions saved)")
+    if caption_cache is not None:
+        caption_cache.report()
+    return results
+
+
+def truncate_to_depth(candidate_ids, depth, clusters=None):
+    """The first `depth` searched rows of a candidate list; with clusters, a depth counts
+    representatives and keeps every expanded member of the ones it covers."""
+    if clusters is None:
+        return candidate_ids[:depth]
+    kept, representatives = [], set()
+    for candidate_id in candidate_ids:
+        representative_id = clusters.representative_of(candidate_id)
+        if representative_id not in representatives:
+            if len(representatives) == depth:
+                break
+            representatives.add(representative_id)
+        kept.append(candidate_id)
+    return kept
+
+
+def apply_adaptive_depth(rerank_inputs, args, hard_queries=None, clusters=None):
+    """Keep only as many candidates per query as its first-stage score distribution calls for.
+
+    A scheduled HardQuerySet carries the depths its budget was computed with; they are
+    used as they are, so the rerank spends what the scheduler planned.
+    """
+    if not rerank_inputs:
+        return rerank_inputs
+    scheduled = hard_queries.depth_of() if isinstance(hard_queries, HardQuerySet) else None
+    candidate_ids = [item['top_k_candidates'] for item in rerank_inputs]
+    if scheduled is not None:
+        method = 'scheduled'
+        depths = [scheduled.get(item['query_id'], len(item['top_k_candidates'])) for item in rerank_inputs]
+    elif args.depth_method == 'fixed':
+        return rerank_inputs
+    else:
+        method = args.depth_method
+        query_ids = [item['query_id'] for item in rerank_inputs]
+        scores = image_similarity_matrix(load_image_similarity(), query_ids, candidate_ids)
+        depths = rerank_depths(scores, method=args.depth_method, mass=args.depth_mass,
+                               temperature=args.depth_temperature, min_depth=args.min_depth).tolist()
+        clusters = None
+    adapted = [dict(item, top_k_candidates=truncate_to_depth(item['top_k_candidates'], depth, clusters))
+               for item, depth in zip(rerank_inputs, depths)]
+    total = sum(map(len, candidate_ids))
+    kept = sum(len(item['top_k_candidates']) for item in adapted)
+    print(f"📏 Adaptive depth ({method}): {kept}/{total} candidates kept, "
+          f"mean depth {kept / len(adapted):.1f}, {total - kept} captions saved")
+    return adapted
+
+
+
+
+
+def rerank_embeddings(rerank_input_path, output_path, coeff_path='./logit_scale.pt', text_features=None):
     with open(rerank_input_path, 'r', encoding='utf-8') as f:
         rerank_inputs = json.load(f)
     
 
-    # Image similarity scores JSON
-    image_similarity_path = "final_json_result/private_test_similarity_scores.json"
-    with open(image_similarity_path, 'r', encoding='utf-8') as f:
-        image_similarity_dict = json.load(f)
-
+    image_similarity_dict = load_image_similarity()
     device = 'cuda:7' if torch.cuda.is_available() else 'cpu'
     model = CustonInternVLRetrievalModel(device=device)
+    coeff = load_coeff('internvl', coeff_path, 'cpu').float().squeeze()
 
-    rerank_results = []
-    for item in tqdm(rerank_inputs, desc="Reranking embeddings"):
-        query_id = item['query_id']
-        query_caption = item['query_caption']
-        top_k_captions = item['top_k_captions']
-        image_scores = image_similarity_dict.get(query_id, {})
-        try:   
-            query_embedding = model.encode_text(query_caption)  # shape (1, D)
-        except Exception as e:
-            print(f"❌ Failed to encode query caption for {query_id}: {e}")
-            continue
-        
-        rerank_scores = []
-        for candidate in top_k_captions:
-            image_id = candidate['image_id']
-            caption_text = candidate['caption']
-            try:
-                candidate_embedding = model.encode_text(caption_text)  # shape (1, D)
-                coeff = torch.load("./logit_scale.pt", map_location= device)  # shape: []
-                if coeff.dim() > 0:
-                    coeff = coeff.squeeze()
-                
-                sim_score = (coeff * (query_embedding @ candidate_embedding.T)).item()
-            except Exception as e:
-                print(f"❌ Failed to encode caption for {image_id}: {e}")
-                sim_score = 0.0
+    ranked = []
+    if rerank_inputs:
+        with torch.no_grad():
+            ranked = score_caption_rerank(model, rerank_inputs, image_similarity_dict, coeff,
+                                          text_features=text_features)
+    return save_rerank_results([item['query_id'] for item in rerank_inputs], ranked, output_path)
 
-            image_sim = image_scores.get(image_id, 0.0)
-            combined_score = round(sim_score + image_sim, 6)
 
-            rerank_scores.append((image_id, combined_score))
+def load_image_similarity():
+    image_similarity_path = "final_json_result/private_test_similarity_scores.npz"
+    if not os.path.exists(image_similarity_path):
+        image_similarity_path = "final_json_result/private_test_similarity_scores.json"
+    return load_topk_scores(image_similarity_path)
 
 
-        reranked_ids = [img_id for img_id, _ in rerank_scores]
-        rerank_results.append({
+def save_rerank_results(query_ids, ranked, output_path):
+    rerank_results = [
+        {
             "query_id": query_id,
-            "reranked_candidates": reranked_ids
-        })
-  
-  
+            "reranked_candidates": reranked_ids,
+            "reranked_scores": [round(score, 6) for score in reranked_scores],
+        }
+        for query_id, (reranked_ids, reranked_scores) in zip(query_ids, ranked)
+    ]
     with open(output_path, 'w', encoding='utf-8') as f:
         json.dump(rerank_results, f, indent=2, ensure_ascii=False)
     print(f"✅ Reranked results saved to: {output_path} (total: {len(rerank_results)})")
+    return rerank_results
+
+
+def cached_database_captions(caption_cache, candidate_ids, clusters=None):
+    """Short captions of the candidates already in the cache (None where missing); nothing is generated."""
+    captions = []
+    for candidates in candidate_ids:
+        row = []
+        for candidate_id in candidates:
+            representative_id = clusters.representative_of(candidate_id) if clusters is not None else candidate_id
+            image_file = os.path.join(DATABASE_IMAGE_PATH, f"{representative_id}.jpg")
+            try:
+                row.append(caption_cache.lookup(image_file, DATABASE_CAPTION_MODEL,
+                                                CustonInternVLCaptionModel.SHORT_CAPTION_PROMPT,
+                                                CustonInternVLCaptionModel.SHORT_CAPTION_CONFIG))
+            except OSError:
+                row.append(None)
+        captions.append(row)
+    return captions
+
+
+def cascade_rerank(rerank_inputs, output_path, args, clusters=None, caption_cache=None):
+    """Small-to-large captioning cascade with per-query cost accounting.
+
+    Every candidate is first captioned by the small model (which also captions the
+    query). Only queries whose reranked top-1 margin or entropy is still uncertain
+    are re-captioned by the large model, which is loaded only if any query needs it.
+    """
+    image_similarity_dict = load_image_similarity()
+    device = 'cuda:7' if torch.cuda.is_available() else 'cpu'
+    model = CustonInternVLRetrievalModel(device=device)
+    coeff = load_coeff('internvl', args.coeff_path, 'cpu').float().squeeze()
+    costs = {item['query_id']: {'tier': QUERY_CAPTION_MODEL, 'candidates': len(item['top_k_candidates']),
+                                QUERY_CAPTION_MODEL: new_cost(), DATABASE_CAPTION_MODEL: new_cost()}
+             for item in rerank_inputs}
+
+    # Captions go through the same checkpoint as generate mode, each record naming the model that
+    # captioned its candidates, so a later generate run never mistakes small-model captions for its own.
+    store = open_results_store(args.rerank_caption_output_path, list_key='query_id')
+    small_model = CustonInternVLCaptionModel(model_name=QUERY_CAPTION_MODEL, device='cuda:7', caption_cache=caption_cache)
+    representative_captions = {}
+    caption_items = []
+    for item in tqdm(rerank_inputs, desc=f"Captioning with {QUERY_CAPTION_MODEL}"):
+        previous = store.get(item['query_id'])
+        if reusable_captions(previous, item['top_k_candidates'], (QUERY_CAPTION_MODEL, DATABASE_CAPTION_MODEL)):
+            costs[item['query_id']]['tier'] = previous['caption_model']
+            caption_items.append(previous)
+            continue
+        cost = costs[item['query_id']][QUERY_CAPTION_MODEL]
+        caption_items.append({
+            "query_id": item['query_id'],
+            "query_caption": caption_query(small_model, item['query_id'], cost),
+            "top_k_captions": caption_candidates(small_model, item['top_k_candidates'], clusters=clusters,
+                                                 representative_captions=representative_captions, cost=cost),
+            "caption_model": QUERY_CAPTION_MODEL,
+        })
+        store.append(item['query_id'], caption_items[-1])
+    with torch.no_grad():
+        ranked = score_caption_rerank(model, caption_items, image_similarity_dict, coeff) if caption_items else []
+
+    # Queries already re-captioned by the large model in an earlier run are final.
+    uncertain = [row for row, (_, scores) in enumerate(ranked)
+                 if caption_items[row]['caption_model'] == QUERY_CAPTION_MODEL
+                 and needs_escalation(scores, args.cascade_min_margin, args.cascade_max_entropy)]
+    print(f"🪜 {len(ranked) - len(uncertain)}/{len(ranked)} queries resolved without new {DATABASE_CAPTION_MODEL} "
+          f"captions, {len(uncertain)} escalated to {DATABASE_CAPTION_MODEL}")
+    if uncertain:
+        del small_model
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        large_model = CustonInternVLCaptionModel(model_name=DATABASE_CAPTION_MODEL, device='cuda:7',
+                                                 caption_cache=caption_cache)
+        representative_captions = {}
+        for row in tqdm(uncertain, desc=f"Captioning with {DATABASE_CAPTION_MODEL}"):
+            item = caption_items[row] = dict(caption_items[row], caption_model=DATABASE_CAPTION_MODEL)
+            costs[item['query_id']]['tier'] = DATABASE_CAPTION_MODEL
+            item['top_k_captions'] = caption_candidates(
+                large_model, [c['image_id'] for c in item['top_k_captions']], clusters=clusters,
+                representative_captions=representative_captions, cost=costs[item['query_id']][DATABASE_CAPTION_MODEL])
+            store.append(item['query_id'], item)
+        with torch.no_grad():
+            escalated = score_caption_rerank(model, [caption_items[row] for row in uncertain], image_similarity_dict, coeff)
+        for row, result in zip(uncertain, escalated):
+            ranked[row] = result
+
+    for item, (_, scores) in zip(caption_items, ranked):
+        costs[item['query_id']]['margin'], costs[item['query_id']]['entropy'] = rank_confidence(scores)
+    store.export_json(args.rerank_caption_output_path, keys=[item['query_id'] for item in caption_items], as_list=True)
+    store.close()
+    write_json_atomic(args.cascade_cost_path, costs)
+    report_cascade_costs(costs)
+    if caption_cache is not None:
+        caption_cache.report()
+    return save_rerank_results([item['query_id'] for item in caption_items], ranked, output_path)
+
+
+def report_cascade_costs(costs):
+    for tier in (QUERY_CAPTION_MODEL, DATABASE_CAPTION_MODEL):
+        tier_costs = [cost[tier] for cost in costs.values()]
+        print(f"💰 {tier}: {sum(c['captions'] for c in tier_costs)} captions generated, "
+              f"{sum(c['cached'] for c in tier_costs)} cached, {sum(c['seconds'] for c in tier_costs) / 3600:.2f} GPU-hours")
+    # What captioning every candidate with the large model would have cost, at its measured per-caption latency.
+    large = [cost[DATABASE_CAPTION_MODEL] for cost in costs.values()]
+    generated = sum(c['captions'] for c in large)
+    if generated:
+        per_caption = sum(c['seconds'] for c in large) / generated
+        all_candidates = sum(cost['candidates'] for cost in costs.values())
+        spent = sum(cost[tier]['seconds'] for cost in costs.values() for tier in (QUERY_CAPTION_MODEL, DATABASE_CAPTION_MODEL))
+        print(f"💰 Cascade {spent / 3600:.2f} GPU-hours vs ~{all_candidates * per_caption / 3600:.2f} "
+              f"for {DATABASE_CAPTION_MODEL} on every candidate")
+
+
+def rerank_without_generation(rerank_inputs, output_path, mode, args, clusters=None, caption_cache=None):
+    """Rerank with no candidate caption generation, fully batched over all queries."""
+    query_ids = [item['query_id'] for item in rerank_inputs]
+    candidate_ids = [item['top_k_candidates'] for item in rerank_inputs]
+    image_similarity_dict = load_image_similarity()
+    device = 'cuda:7' if torch.cuda.is_available() else 'cpu'
+    model = CustonInternVLRetrievalModel(device=device)
+    coeff = load_coeff('internvl', args.coeff_path, 'cpu').float().squeeze()
+
+    ranked = []
+    with torch.no_grad():
+        if rerank_inputs and mode == 'query_caption':
+            caption_model = CustonInternVLCaptionModel(model_name=QUERY_CAPTION_MODEL, device='cuda:7',
+                                                       caption_cache=caption_cache)
+            query_captions = [caption_query(caption_model, query_id)
+                              for query_id in tqdm(query_ids, desc="Generating query captions")]
+            ranked = score_query_caption_rerank(model, query_ids, query_captions, candidate_ids,
+                                                EmbeddingStore(args.database_folder), image_similarity_dict, coeff)
+        elif rerank_inputs and mode == 'cached_captions':
+            if caption_cache is None:
+                raise ValueError("--rerank_mode cached_captions needs --caption_cache_dir")
+            candidate_captions = cached_database_captions(caption_cache, candidate_ids, clusters=clusters)
+            num_cached = sum(caption is not None for captions in candidate_captions for caption in captions)
+            print(f"🗂️ {num_cached}/{sum(map(len, candidate_ids))} candidates have a cached caption")
+            ranked = score_cached_caption_rerank(model, query_ids, EmbeddingStore(args.query_folder), candidate_ids,
+                                                 candidate_captions, image_similarity_dict, coeff)
+    return save_rerank_results(query_ids, ranked, output_path)
 
 
 
@@ -148,7 +420,11 @@ def update_csv_with_rerank_results(csv_path, rerank_results_path, output_path):
     for row in rows:
         query_id = row['query_id']
         if query_id in rerank_dict:
-            reranked = rerank_dict[query_id]
+            # Candidates that were not reranked (adaptive depth, early stopping) keep their order after the reranked ones.
+            reranked = list(rerank_dict[query_id])
+            reranked_set = set(reranked)
+            reranked += [row[f'image_id_{i+1}'] for i in range(pre_top_k)
+                         if row[f'image_id_{i+1}'] and row[f'image_id_{i+1}'] not in reranked_set]
             for i in range(pre_top_k):
                 key = f'image_id_{i+1}'
                 row[key] = reranked[i] if i < len(reranked) else ""
@@ -163,16 +439,30 @@ def update_csv_with_rerank_results(csv_path, rerank_results_path, output_path):
 
 def main(args):
     wrong_query_ids = load_wrong_queries(args.wrong_sample_json_path)
-    rerank_inputs = extract_rerank_inputs(args.csv_path, wrong_query_ids, args.pre_top_k)
-    create_caption_json(rerank_inputs, args.rerank_caption_output_path)
-    rerank_embeddings(args.rerank_caption_output_path, args.rerank_output_path)
+    clusters = load_clusters(args.dedup_folder)
+    rerank_inputs = apply_adaptive_depth(extract_rerank_inputs(args.csv_path, wrong_query_ids, args.pre_top_k), args,
+                                         hard_queries=wrong_query_ids, clusters=clusters)
+    caption_cache = open_caption_cache(args.caption_cache_dir, size_limit_gb=args.caption_cache_size_gb)
+    if args.rerank_mode == 'generate':
+        # Caption features encoded by early stopping are reused by the rerank.
+        text_features = {}
+        create_caption_json(rerank_inputs, args.rerank_caption_output_path, clusters=clusters, caption_cache=caption_cache,
+                            early_stop_slack=args.early_stop_slack, coeff_path=args.coeff_path,
+                            text_features=text_features)
+        rerank_embeddings(args.rerank_caption_output_path, args.rerank_output_path, coeff_path=args.coeff_path,
+                          text_features=text_features)
+    elif args.rerank_mode == 'cascade':
+        cascade_rerank(rerank_inputs, args.rerank_output_path, args, clusters=clusters, caption_cache=caption_cache)
+    else:
+        rerank_without_generation(rerank_inputs, args.rerank_output_path, args.rerank_mode, args,
+                                  clusters=clusters, caption_cache=caption_cache)
     update_csv_with_rerank_results(args.csv_path, args.rerank_output_path, args.rerank_final_path)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Filter rerank queries from CSV using wrong-sample list")
     parser.add_argument('--wrong_sample_json_path', type=str,
-                        default='./final_json_result/temp_three_ways_wrong_samples_set.json',
-                        help="Path to JSON file containing wrong sample query_ids")
+                        default='./final_json_result/temp_three_ways_wrong_samples_set.npz',
+                        help="Hard-query set (.npz from step_1_retrieval, or a legacy JSON list)")
     parser.add_argument('--csv_path', type=str,
                         default='./final_csv_result/temp_private_test_image_first_step_retrieval_results_with_caption.csv',
                         help="Path to CSV file with retrieval results")
@@ -185,10 +475,34 @@ if __name__ == '__main__':
     parser.add_argument('--rerank_output_path', type=str, default='./rerank_results.json', help="Path to save the reranked results as JSON")
     parser.add_argument('--rerank_final_path', type=str, default='./final_csv_result/temp_final_rerank.csv',
                         help="Path to save the reranked results as CSV")
+    parser.add_argument('--rerank_mode', type=str, default='generate', choices=RERANK_MODES,
+                        help="generate: caption every candidate; query_caption / cached_captions: no candidate captioning")
+    parser.add_argument('--early_stop_slack', type=float, default=None,
+                        help="generate mode: stop captioning a query's candidates once the top-1 can no longer "
+                             "change, assuming later captions score at most this above the best one so far")
+    parser.add_argument('--cascade_min_margin', type=float, default=1.0,
+                        help="Cascade: escalate a query whose top-1 combined score leads by less than this")
+    parser.add_argument('--cascade_max_entropy', type=float, default=None,
+                        help="Cascade: also escalate a query whose normalised score entropy exceeds this (0-1)")
+    parser.add_argument('--cascade_cost_path', type=str, default='./rerank_costs.json',
+                        help="Cascade: per-query tier, captions, cache hits and GPU-seconds")
+    parser.add_argument('--database_folder', type=str, default='./embeddings/database_image_internVL_g/',
+                        help="Database embedding store (query_caption mode)")
+    parser.add_argument('--query_folder', type=str, default='./embeddings/track_1_private_internvlg/',
+                        help="Query embedding store (cached_captions mode)")
+    parser.add_argument('--coeff_path', type=str, default='./logit_scale.pt',
+                        help="Logit scale applied to the caption similarities")
+    parser.add_argument('--dedup_folder', type=str, default=None,
+                        help="Deduplicated database store (from dedup.py); only cluster representatives are captioned")
+    parser.add_argument('--caption_cache_dir', type=str, default='./cache/captions',
+                        help="Persistent caption cache shared across runs (empty string disables it)")
+    parser.add_argument('--caption_cache_size_gb', type=float, default=2.0,
+                        help="Size limit of the caption cache; least recently used captions are evicted first")
     parser.add_argument('--output_dir', type=str, default='./private_test_final_elements_json',
                         help="Directory to save the final caption JSON")
     
 
 
+    add_depth_args(parser)
     args = parser.parse_args()
     main(args)
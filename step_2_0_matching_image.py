@@ -6,10 +6,14 @@ from pathlib import Path
 from PIL import Image
 import numpy as np
 import torch
+from functools import partial
+from embedding_store import load_embeddings
+from image_loading import load_image
 
 
 # Configuration
 THRESHOLD_PIXEL_DIFF = 0.01  # Threshold for pixel difference in image comparison
+MATCH_DECODE_SIZE = 256  # Images are compared at about this resolution (JPEG scale-on-decode)
 OUTPUT_MATCHING_FOLDER = "matching-01-no-threshold"
 ORIGIN_EMBEDDING = "../embeddings/database_image_internVL_g"
 NEW_EMBEDDING = "../embeddings/maching_new_database_internvlg"
@@ -18,55 +22,29 @@ NEW_IMG_FOLDER = "imgs"
 ORIGIN_DATABASE_JSON = "./data/database/database.json"
 CRAWLED_FOLDER = Path("crawled")
 
-##################################################
-
-matching_dir = Path(OUTPUT_MATCHING_FOLDER)
-os.makedirs(matching_dir, exist_ok=True)
 device = "cuda:0" if torch.cuda.is_available() else "cpu"
-print(f"Using device: {device}")
-
-origin_embedding = Path(ORIGIN_EMBEDDING)
-my_embedding = Path(NEW_EMBEDDING)
-origin_img = Path(ORIGIN_IMG_FOLDER)
-my_img = Path(NEW_IMG_FOLDER)
-
-with open(ORIGIN_DATABASE_JSON, "r", encoding="utf-8") as f:
-    origin_db = json.load(f)
-my_db = dict()
-
-filenames = list(os.listdir(CRAWLED_FOLDER))
-for idx, filename in enumerate(filenames):
-    key = filename.split(".")[0]
-    try:
-        with open(CRAWLED_FOLDER / filename, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            my_db[key] = data
-    except Exception as e:
-        print(f"Error reading {filename} at index {idx}: {e}")
-
-# Get intersection of keys
-origin_keys = set(origin_db.keys())
-my_keys = set(my_db.keys())
-key_intersection = origin_keys & my_keys
-print(f"Number of key intersections: {len(key_intersection)}")
 
 ##################################################
 
 def load_images_from_list(img_dir, img_id_list, ext=".jpg"):
+    """{img_id: (full-resolution size, reduced-resolution pixel array)}"""
     img_dict = {}
     for img_id in img_id_list:
         img_path = img_dir / (img_id + ext)
         try:
-            img = Image.open(img_path).convert("RGB")
-            arr = np.array(img)
-            img_dict[img_id] = arr
+            with Image.open(img_path) as img:
+                full_size = img.size
+            arr = np.array(load_image(img_path, MATCH_DECODE_SIZE))
+            img_dict[img_id] = (full_size, arr)
         except Exception as e:
             print(f"Error loading {img_path}: {e}")
     return img_dict
 
 
-def compare_img_arrays(arr1, arr2, threshold=THRESHOLD_PIXEL_DIFF):
-    if arr1.shape != arr2.shape:
+def compare_img_arrays(img1, img2, threshold=THRESHOLD_PIXEL_DIFF):
+    (size1, arr1), (size2, arr2) = img1, img2
+    # Images of different full sizes are never identical, even if they decode to the same reduced shape.
+    if size1 != size2 or arr1.shape != arr2.shape:
         return False
     abs_diff = np.abs(arr1.astype(np.int32) - arr2.astype(np.int32))
     total_diff = np.sum(abs_diff)
@@ -75,17 +53,19 @@ def compare_img_arrays(arr1, arr2, threshold=THRESHOLD_PIXEL_DIFF):
     return diff_ratio <= threshold
 
 
-def load_embeddings_from_list(embedding_dir, id_list):
-    embedding_dict = {}
-    for id in id_list:
-        embedding_path = embedding_dir / (id + ".pt")
-        if not embedding_path.exists(): continue
-        try:
-            embedding = torch.load(embedding_path, map_location=device).unsqueeze(0)
-            embedding_dict[id] = embedding
-        except Exception as e:
-            print(f"Error loading {embedding_path}: {e}")
-    return embedding_dict
+def load_embedding_folder(folder):
+    """(CPU embeddings, {id: row}) of a store or a legacy folder of .pt files."""
+    embeddings, ids = load_embeddings(folder, device="cpu")
+    return embeddings, {id: row for row, id in enumerate(ids)}
+
+
+def load_embeddings_from_list(embedding_folder, id_list):
+    embeddings, rows = embedding_folder
+    found_ids = [id for id in id_list if id in rows]
+    if not found_ids:
+        return {}
+    matrix = embeddings[[rows[id] for id in found_ids]].float().to(device)
+    return {id: matrix[row].unsqueeze(0) for row, id in enumerate(found_ids)}
 
 
 def cosine_similarity(embedding1, embedding2):
@@ -94,7 +74,7 @@ def cosine_similarity(embedding1, embedding2):
 
 
 empty_tensor = torch.zeros(1, 768).to(device)
-def process_key(key):
+def process_key(key, origin_db, my_db, origin_embedding, my_embedding, origin_img, my_img, matching_dir):
     origin_images = origin_db[key]["images"]  # List of origin image ids (strings)
     my_images = [img_obj["id"] for img_obj in my_db[key]["images"]]  # List of my image ids
     my_ids = [filename.split(".")[0] for filename in my_images]
@@ -145,5 +125,41 @@ def process_key(key):
         json.dump(mapping, f, ensure_ascii=False, indent=2)
 
 
-with ThreadPoolExecutor(max_workers=64) as executor:
-    results = list(tqdm(executor.map(process_key, key_intersection), total=len(key_intersection), desc="Processing"))
+def main():
+    matching_dir = Path(OUTPUT_MATCHING_FOLDER)
+    os.makedirs(matching_dir, exist_ok=True)
+    print(f"Using device: {device}")
+
+    origin_embedding = load_embedding_folder(ORIGIN_EMBEDDING)
+    my_embedding = load_embedding_folder(NEW_EMBEDDING)
+    origin_img = Path(ORIGIN_IMG_FOLDER)
+    my_img = Path(NEW_IMG_FOLDER)
+
+    with open(ORIGIN_DATABASE_JSON, "r", encoding="utf-8") as f:
+        origin_db = json.load(f)
+    my_db = dict()
+
+    filenames = list(os.listdir(CRAWLED_FOLDER))
+    for idx, filename in enumerate(filenames):
+        key = filename.split(".")[0]
+        try:
+            with open(CRAWLED_FOLDER / filename, "r", encoding="utf-8") as f:
+                data = json.load(f)
+                my_db[key] = data
+        except Exception as e:
+            print(f"Error reading {filename} at index {idx}: {e}")
+
+    # Get intersection of keys
+    origin_keys = set(origin_db.keys())
+    my_keys = set(my_db.keys())
+    key_intersection = origin_keys & my_keys
+    print(f"Number of key intersections: {len(key_intersection)}")
+
+    match_key = partial(process_key, origin_db=origin_db, my_db=my_db, origin_embedding=origin_embedding,
+                        my_embedding=my_embedding, origin_img=origin_img, my_img=my_img, matching_dir=matching_dir)
+    with ThreadPoolExecutor(max_workers=64) as executor:
+        results = list(tqdm(executor.map(match_key, key_intersection), total=len(key_intersection), desc="Processing"))
+
+
+if __name__ == "__main__":
+    main()
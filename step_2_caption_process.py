@@ -6,6 +6,7 @@ from tqdm import tqdm
 from llmassemblers import LLMAssembler
 import time
 from step_2_merge_all_elements import merge_function
+from results_store import open_results_store
 
 PROMPT_TEMPLATE_DIR = Path('./assemble_caption_prompt_template')
 RESULT_DIR = Path('./assemble_result')
@@ -106,9 +107,13 @@ def main(args):
             f.write(prompt)
         return
     
-    result = []
+    output_path = RESULT_DIR / f"{strat}_{model_name}.json"
+    # Enhanced captions are checkpointed one per line and compacted into output_path at the end.
+    result = open_results_store(output_path, list_key='query_id')
     
     for batch in tqdm(inputs, desc="Processing batches"):
+        if batch['query_id'] in result:
+            continue
         input = compose_input(batch, examples)
         if qa:
             enhanced_caption = model_qa(input, strat)
@@ -116,13 +121,13 @@ def main(args):
             enhanced_caption = model_name_entity(input, strat)
         else:
             enhanced_caption = assemble(input, strat)
-        result.append({
+        result.append(batch['query_id'], {
             'query_id': batch['query_id'],
             'enhanced_caption': enhanced_caption,
         })
-        
-        with open(RESULT_DIR / f"{strat}_{model_name}.json", "w", encoding="utf-8") as f:
-            json.dump(result, f, indent=2, ensure_ascii=False)
+
+    result.export_json(output_path, keys=[batch['query_id'] for batch in inputs], as_list=True)
+    result.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
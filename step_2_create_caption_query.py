@@ -1,16 +1,19 @@
-import json
 import os
 from internvl import CustonInternVLCaptionModel
+from caption_cache import open_caption_cache
+from results_store import ResultsStore, write_json_atomic
 from tqdm import tqdm
 import csv
 
 def preprocess_caption_query(args):
-    model = CustonInternVLCaptionModel(model_name=args.model, device="cuda:5")
-    if os.path.exists(args.output_file):
-        with open(args.output_file, 'r') as f:
-            caption_json = json.load(f)
-    else:
-        caption_json = {}
+    caption_cache = open_caption_cache(args.caption_cache_dir, size_limit_gb=args.caption_cache_size_gb)
+    model = CustonInternVLCaptionModel(model_name=args.model, device="cuda:5", caption_cache=caption_cache)
+    # Captions are checkpointed one per line under "query_id:image_id" and compacted into
+    # output_file ({query_id: caption}) at the end. A query whose top-1 image changed since
+    # the checkpoint was written gets a new caption; older JSON outputs are not seeded since
+    # they do not record which image was captioned.
+    caption_store = ResultsStore(f"{args.output_file}.jsonl")
+    captions = {}
 
     db_base_path = 'data/database/database_origin/database_img'
     csv_file = 'final_csv_result/temp_final_rerank.csv'
@@ -22,7 +25,9 @@ def preprocess_caption_query(args):
                 query_id = row['query_id']
                 image_id = row.get('image_id_1')
 
-                if query_id in caption_json and len(caption_json[query_id]) == 5:
+                key = f"{query_id}:{image_id}"
+                if key in caption_store:
+                    captions[query_id] = caption_store.get(key)
                     pbar.set_postfix_str(f"✔ Skipped {query_id}")
                     pbar.update(1)
                     continue
@@ -30,15 +35,18 @@ def preprocess_caption_query(args):
                 image_path = os.path.join(db_base_path, image_id + '.jpg')
                 caption = model.generate_caption(image_path)
 
-                caption_json[query_id] = caption
+                caption_store.append(key, caption)
+                captions[query_id] = caption
 
 
                 pbar.set_postfix_str(f"📌 {query_id}")
                 pbar.update(1)
 
-                with open(args.output_file, 'w') as f:
-                    json.dump(caption_json, f, indent=4)
+        caption_store.close()
+        write_json_atomic(args.output_file, captions, indent=4)
         print(f"✅ Captions saved to {args.output_file}")
+    if caption_cache is not None:
+        caption_cache.report()
 
 def main():
     import argparse
@@ -47,6 +55,8 @@ def main():
     parser.add_argument('--output_file', type=str, default='./private_test_final_elements_json/final_rerank_private_test_detail_top1_caption.json', help='Output file to save the captions')
     parser.add_argument('--start_index', type=int, default=0, help='Start index to resume processing from')
     parser.add_argument('--device', type=str, default='cuda:0', help='Device to run the model on')
+    parser.add_argument('--caption_cache_dir', type=str, default='./cache/captions', help='Persistent caption cache shared across runs (empty string disables it)')
+    parser.add_argument('--caption_cache_size_gb', type=float, default=2.0, help='Size limit of the caption cache (LRU eviction)')
     parser.add_argument('--batch', type=bool, default=False, help='Batch size for processing images')
     args = parser.parse_args()
 
@@ -4,6 +4,7 @@ from tqdm import tqdm
 import argparse
 import json
 import csv
+from results_store import open_results_store
 from llama3 import Llama  # Make sure Llama class is correctly implemented
 
 def main(args):
@@ -24,11 +25,8 @@ def main(args):
     with open(database_file, 'r') as file:
         database_data = json.load(file)
 
-    if os.path.exists(output_file):
-        with open(output_file, 'r') as infile:
-            result = json.load(infile)
-    else:
-        result = {}
+    # Summaries are checkpointed one per line and compacted into output_file at the end.
+    result = open_results_store(output_file)
 
     for row in tqdm(data):
         query = row["query_id"]
@@ -42,14 +40,13 @@ def main(args):
         article_content = database_data[first_article]["content"]
 
         summarized_content = llms_bot.summarize_news(article_content)
-        result[query] = {
+        result.append(query, {
             "article_id": first_article,
             "summary": summarized_content
-        }
-        
-        with open(output_file, 'w') as outfile:
-            json.dump(result, outfile, indent=2)
+        })
 
+    result.export_json(output_file)
+    result.close()
     print(f"Summarized results saved to: {output_file}")
 
 if __name__ == "__main__":
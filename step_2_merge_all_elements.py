@@ -1,5 +1,6 @@
 import json
 import csv
+from results_store import write_json_atomic
 
 
 def merge_function(generative_caption_path, query_first_article_path, entity_name_path, question_answer_path, new_database_path, output_path):
@@ -43,8 +44,7 @@ def merge_function(generative_caption_path, query_first_article_path, entity_nam
         }
         final_merge_result.append(batch)    
 
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(final_merge_result, f, ensure_ascii=False, indent=2)
-        print(f"Final merged result saved to: {output_path}")
+    write_json_atomic(output_path, final_merge_result)
+    print(f"Final merged result saved to: {output_path}")
 
 
@@ -0,0 +1,25 @@
+import json
+import numpy as np
+
+from retrieval_scores import save_topk_scores, TopKScores
+
+
+def test_padded_ivf_result_round_trips(tmp_path):
+    # IVF search pads queries with fewer than k reachable rows with index -1 / score -inf.
+    path = str(tmp_path / 'scores.npz')
+    topk_indices = np.array([[2, -1, -1], [0, 1, 2]])
+    topk_similarities = np.array([[0.9, -np.inf, -np.inf], [0.8, 0.7, 0.6]], dtype=np.float32)
+    save_topk_scores(path, ['q', 'r'], ['a', 'b', 'c'], topk_indices, topk_similarities)
+
+    scores = TopKScores.load(path)
+    image_ids, values = scores.candidates('q')
+    assert image_ids == ['c']
+    assert np.allclose(values, [0.9])
+    assert scores.get('q') == {'c': np.float32(0.9).item()}
+    assert scores.candidates('r')[0] == ['a', 'b', 'c']
+
+    json_path = str(tmp_path / 'scores.json')
+    scores.export_json(json_path)
+    with open(json_path, encoding='utf-8') as f:
+        exported = json.load(f)
+    assert exported == {'q': {'c': 0.9}, 'r': {'a': 0.8, 'b': 0.7, 'c': 0.6}}
@@ -0,0 +1,266 @@
+import argparse
+import csv
+import json
+import numpy as np
+import torch
+import torch.nn.functional as F
+from retrieval_scores import TopKScores
+
+# Each heuristic flags a query as likely wrong; higher hardness = more uncertain.
+HEURISTICS = ('entropy', 'gap', 'low_top1_sim')
+# How many candidates of a hard query to rerank, from its top-k score distribution.
+DEPTH_METHODS = ('fixed', 'mass', 'knee')
+SCHEDULE_UNITS = ('captions', 'gpu_seconds')
+
+
+def compute_uncertainty_stats(topk_similarities):
+    """Entropy of the softmaxed top-k scores, top-1/top-2 gap and top-1 score for every query at once."""
+    topk_similarities = topk_similarities.float()
+    probs = F.softmax(topk_similarities, dim=1)
+    entropy = -torch.sum(probs * torch.log(probs + 1e-10), dim=1)
+    gap = topk_similarities[:, 0] - topk_similarities[:, 1]
+    top1_sim = topk_similarities[:, 0]
+    return {
+        'entropy': entropy.cpu().numpy(),
+        'gap': gap.cpu().numpy(),
+        'low_top1_sim': top1_sim.cpu().numpy(),
+    }
+
+
+def hardness(stats):
+    """(H, Q) matrix where larger means more uncertain, one row per heuristic."""
+    return np.stack([stats['entropy'], -stats['gap'], -stats['low_top1_sim']])
+
+
+class HardQuerySet():
+    """Selected hard queries as parallel arrays, ordered from most to least uncertain.
+
+    `reasons` is a bitmask over HEURISTICS telling which heuristics picked the query.
+    `depths` (optional) is the rerank depth the scheduler budgeted for each query, in
+    searched rows (cluster representatives of a deduplicated database).
+    """
+
+    def __init__(self, query_ids, entropy, gap, low_top1_sim, reasons, depths=None):
+        self.query_ids = np.asarray(query_ids, dtype=str)
+        self.entropy = np.asarray(entropy, dtype=np.float32)
+        self.gap = np.asarray(gap, dtype=np.float32)
+        self.low_top1_sim = np.asarray(low_top1_sim, dtype=np.float32)
+        self.reasons = np.asarray(reasons, dtype=np.uint8)
+        self.depths = np.asarray(depths, dtype=np.int32) if depths is not None else None
+        self._ids = set(self.query_ids.tolist())
+
+    def __len__(self):
+        return len(self.query_ids)
+
+    def __contains__(self, query_id):
+        return query_id in self._ids
+
+    def __iter__(self):
+        return iter(self.query_ids.tolist())
+
+    def save(self, path):
+        depths = {'depths': self.depths} if self.depths is not None else {}
+        np.savez(path, query_ids=self.query_ids, entropy=self.entropy, gap=self.gap,
+                 low_top1_sim=self.low_top1_sim, reasons=self.reasons, **depths)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['query_ids'], data['entropy'], data['gap'], data['low_top1_sim'], data['reasons'],
+                   depths=data['depths'] if 'depths' in data.files else None)
+
+    def depth_of(self):
+        """{query_id: scheduled rerank depth}, or None when the set was not scheduled."""
+        if self.depths is None:
+            return None
+        return dict(zip(self.query_ids.tolist(), self.depths.tolist()))
+
+    def to_records(self):
+        records = [{
+            "query_id": query_id,
+            "entropy": round(float(entropy), 6),
+            "gap": round(float(gap), 6),
+            "low_top1_sim": round(float(top1), 6),
+            "reasons": [name for bit, name in enumerate(HEURISTICS) if reasons & (1 << bit)],
+        } for query_id, entropy, gap, top1, reasons in zip(
+            self.query_ids.tolist(), self.entropy, self.gap, self.low_top1_sim, self.reasons)]
+        if self.depths is not None:
+            for record, depth in zip(records, self.depths.tolist()):
+                record["depth"] = depth
+        return records
+
+    def save_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_records(), f, indent=2)
+
+
+def hardness_percentiles(stats):
+    """(H, Q) percentile rank in [0, 1] of every query's hardness under each heuristic (1 = hardest)."""
+    scores = hardness(stats)
+    num_heuristics, num_queries = scores.shape
+    percentiles = np.empty_like(scores, dtype=np.float64)
+    percentiles[np.arange(num_heuristics)[:, None], np.argsort(scores, axis=1, kind='stable')] = \
+        np.arange(num_queries) / max(num_queries - 1, 1)
+    return percentiles
+
+
+def select_hard_queries(query_ids, stats, quotas=(50, 50, 50), percentile=None, budget=None):
+    """Pick hard queries from the uncertainty statistics.
+
+    quotas: per-heuristic count of the hardest queries (in HEURISTICS order).
+    percentile: additionally flag queries above this hardness percentile of any heuristic.
+    budget: cap on the total; queries are taken by their best rank across heuristics.
+    """
+    scores = hardness(stats)
+    num_heuristics, num_queries = scores.shape
+    # ranks[h, q] = position of query q when sorted from hardest to easiest by heuristic h.
+    ranks = np.empty_like(scores, dtype=np.int64)
+    ranks[np.arange(num_heuristics)[:, None], np.argsort(-scores, axis=1, kind='stable')] = np.arange(num_queries)
+
+    flagged = np.zeros_like(scores, dtype=bool)
+    if quotas is not None:
+        flagged |= ranks < np.asarray(quotas)[:, None]
+    if percentile is not None:
+        flagged |= scores >= np.percentile(scores, percentile, axis=1, keepdims=True)
+    if quotas is None and percentile is None:
+        flagged[:] = True
+
+    # Most uncertain first: a query's priority is its best rank among the heuristics that flagged it.
+    best_rank = np.where(flagged, ranks, num_queries).min(axis=0)
+    selected = np.flatnonzero(flagged.any(axis=0))
+    selected = selected[np.argsort(best_rank[selected], kind='stable')]
+    if budget is not None:
+        selected = selected[:budget]
+
+    reasons = (flagged[:, selected] * (1 << np.arange(num_heuristics))[:, None]).sum(axis=0)
+    query_ids = np.asarray(query_ids, dtype=str)
+    return HardQuerySet(query_ids[selected], stats['entropy'][selected], stats['gap'][selected],
+                        stats['low_top1_sim'][selected], reasons)
+
+
+def rerank_depths(topk_similarities, method='mass', mass=0.95, temperature=1.0, min_depth=2):
+    """Per-query number of candidates worth reranking, from (Q, K) descending first-stage scores.
+
+    mass: smallest depth whose softmax(scores / temperature) mass reaches `mass`, i.e. the
+          probability that the true match lies below that rank is under 1 - mass once
+          `temperature` is fitted with calibrate_depth_temperature.
+    knee: cut at the largest gap between consecutive scores at or after `min_depth`.
+    fixed: all K candidates.
+    """
+    topk_similarities = topk_similarities.float()
+    num_queries, k = topk_similarities.shape
+    min_depth = min(max(min_depth, 1), k)
+    if method == 'fixed' or k <= min_depth:
+        return torch.full((num_queries,), k, dtype=torch.long)
+    if method == 'mass':
+        cumulative = F.softmax(topk_similarities / temperature, dim=1).cumsum(dim=1)
+        depths = (cumulative < mass).sum(dim=1) + 1
+    elif method == 'knee':
+        gaps = topk_similarities[:, :-1] - topk_similarities[:, 1:]
+        # gaps[:, i] separates rank i + 1 from rank i + 2; a cut there keeps i + 1 candidates.
+        depths = gaps[:, min_depth - 1:].argmax(dim=1) + min_depth
+    else:
+        raise ValueError(f"Unknown depth method {method}, choose from {DEPTH_METHODS}")
+    return depths.clamp(min=min_depth, max=k)
+
+
+def calibrate_depth_temperature(topk_similarities, true_ranks, temperatures=None):
+    """Fit the `mass` depth temperature on labelled queries.
+
+    true_ranks: (Q,) 0-based rank of every query's true match in its (Q, K) descending
+    scores, -1 when it was not retrieved (skipped: the softmax only covers the shortlist).
+    Returns the temperature with the lowest mean negative log-likelihood of the true ranks
+    over a log-spaced grid, and that NLL.
+    """
+    topk_similarities = topk_similarities.float()
+    true_ranks = torch.as_tensor(true_ranks, dtype=torch.long)
+    found = true_ranks >= 0
+    if not found.any():
+        raise ValueError("No labelled query has its true match in the top-k")
+    scores, ranks = topk_similarities[found], true_ranks[found]
+    temperatures = torch.logspace(-2, 2, 81) if temperatures is None else torch.as_tensor(temperatures, dtype=torch.float32)
+    nll = torch.stack([F.cross_entropy(scores / temperature, ranks) for temperature in temperatures])
+    best = nll.argmin()
+    return temperatures[best].item(), nll[best].item()
+
+
+def rerank_costs(depths, unit='captions', caption_seconds=2.0, query_caption_seconds=1.0):
+    """Expected cost of reranking each query: one query caption plus one caption per candidate."""
+    depths = np.asarray(depths, dtype=np.float64)
+    if unit == 'captions':
+        return depths + 1
+    if unit == 'gpu_seconds':
+        return depths * caption_seconds + query_caption_seconds
+    raise ValueError(f"Unknown schedule unit {unit}, choose from {SCHEDULE_UNITS}")
+
+
+def schedule_hard_queries(query_ids, stats, costs, budget, depths=None):
+    """Choose the queries worth reranking within `budget`, ordered from most to least uncertain.
+
+    A query's priority is its highest hardness percentile across the heuristics, a proxy
+    for the chance that its first-stage top-1 is wrong (i.e. the expected fix). Queries
+    are packed greedily by priority per unit of cost; the ones that no longer fit are
+    skipped in favour of cheaper ones. The `depths` behind the costs are kept in the
+    set, so the rerank step spends exactly what was budgeted. Returns (HardQuerySet, total cost).
+    """
+    percentiles = hardness_percentiles(stats)
+    priority = percentiles.max(axis=0)
+    costs = np.asarray(costs, dtype=np.float64)
+
+    selected, spent = [], 0.0
+    for q in np.argsort(-priority / np.maximum(costs, 1e-9), kind='stable'):
+        if spent + costs[q] <= budget:
+            selected.append(q)
+            spent += costs[q]
+    selected = np.asarray(selected, dtype=np.int64)
+    selected = selected[np.argsort(-priority[selected], kind='stable')]
+
+    reasons = 1 << percentiles[:, selected].argmax(axis=0)
+    query_ids = np.asarray(query_ids, dtype=str)
+    return HardQuerySet(query_ids[selected], stats['entropy'][selected], stats['gap'][selected],
+                        stats['low_top1_sim'][selected], reasons,
+                        depths=np.asarray(depths)[selected] if depths is not None else None), spent
+
+
+def add_depth_args(parser):
+    parser.add_argument('--depth_method', type=str, default='fixed', choices=DEPTH_METHODS,
+                        help="Per-query rerank depth: all pre_top_k, cumulative softmax mass, or largest score gap")
+    parser.add_argument('--depth_mass', type=float, default=0.95,
+                        help="mass: keep candidates until their softmax mass reaches this")
+    parser.add_argument('--depth_temperature', type=float, default=1.0,
+                        help="mass: temperature of the softmax over the first-stage scores")
+    parser.add_argument('--min_depth', type=int, default=2, help="Fewest candidates reranked per query")
+
+
+def true_ranks_from_csv(scores, ground_truth_csv):
+    """(query_ids, (Q,) rank of the true image in each labelled query's top-k or -1) from query_id,image_id rows."""
+    with open(ground_truth_csv, 'r', encoding='utf-8') as f:
+        ground_truth = {row['query_id']: row['image_id'] for row in csv.DictReader(f)}
+    query_ids = [query_id for query_id in scores.query_ids.tolist() if query_id in ground_truth]
+    true_ranks = []
+    for query_id in query_ids:
+        candidates, _ = scores.candidates(query_id)
+        true_ranks.append(candidates.index(ground_truth[query_id]) if ground_truth[query_id] in candidates else -1)
+    return query_ids, np.asarray(true_ranks, dtype=np.int64)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fit --depth_temperature of the mass rerank depth on labelled queries")
+    parser.add_argument('--scores_path', type=str, default='./final_json_result/private_test_similarity_scores.npz',
+                        help="First-stage top-k scores (.npz) written by retrieval")
+    parser.add_argument('--ground_truth_csv', type=str, required=True, help="CSV with query_id,image_id columns")
+    parser.add_argument('--depth_mass', type=float, default=0.95)
+    parser.add_argument('--min_depth', type=int, default=2)
+    args = parser.parse_args()
+
+    scores = TopKScores.load(args.scores_path)
+    query_ids, true_ranks = true_ranks_from_csv(scores, args.ground_truth_csv)
+    topk_similarities = torch.from_numpy(scores.scores[[scores.query_index[query_id] for query_id in query_ids]])
+    temperature, nll = calibrate_depth_temperature(topk_similarities, true_ranks)
+    depths = rerank_depths(topk_similarities, method='mass', mass=args.depth_mass, temperature=temperature,
+                           min_depth=args.min_depth).numpy()
+    covered = (true_ranks >= 0) & (true_ranks < depths)
+    print(f"🌡️ --depth_temperature {temperature:.4g} (NLL {nll:.4f} on {int((true_ranks >= 0).sum())}/{len(true_ranks)} "
+          f"labelled queries with the true match in the top-k)")
+    print(f"   mass {args.depth_mass}: mean depth {depths.mean():.1f}, true match kept for "
+          f"{covered.sum() / max((true_ranks >= 0).sum(), 1):.1%} of them")
@@ -0,0 +1,141 @@
+import json
+import os
+import socket
+import time
+import uuid
+
+# Layout of a queue folder shared by all workers (e.g. on NFS):
+#   chunks/<chunk>.json   the work items of each chunk
+#   leases/<chunk>.lease  held by the worker processing the chunk; its mtime is
+#                         the heartbeat, and it may be stolen once it expires
+#   done/<chunk>.json     written once per chunk, names the folder with its result
+#   results/<chunk>.<worker>/  per-worker output, so a worker whose lease was
+#                         stolen can never write into the thief's output
+CHUNKS_DIR = 'chunks'
+LEASES_DIR = 'leases'
+DONE_DIR = 'done'
+RESULTS_DIR = 'results'
+READY_FILE = 'READY'
+INIT_LOCK_FILE = 'INIT.lock'
+
+
+def _create_exclusive(path, content):
+    # Write to a private temp file, then hard-link it into place: the link
+    # fails if the target exists, and readers never see a partial file.
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    try:
+        os.link(tmp_path, path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp_path)
+
+
+class FileLeaseQueue():
+    """Hands out chunks of work to any number of workers through a shared folder."""
+
+    def __init__(self, queue_dir, lease_seconds=600, worker_id=None):
+        self.queue_dir = queue_dir
+        self.lease_seconds = lease_seconds
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        for name in (CHUNKS_DIR, LEASES_DIR, DONE_DIR, RESULTS_DIR):
+            os.makedirs(os.path.join(queue_dir, name), exist_ok=True)
+
+    def _path(self, *parts):
+        return os.path.join(self.queue_dir, *parts)
+
+    def initialize(self, make_items, chunk_size, poll_seconds=5):
+        """Split the work into chunks exactly once; other workers wait for it."""
+        if _create_exclusive(self._path(INIT_LOCK_FILE), self.worker_id):
+            items = make_items()
+            for start in range(0, len(items), chunk_size):
+                chunk = f"{start // chunk_size:06d}"
+                tmp_path = self._path(CHUNKS_DIR, f".{chunk}.json.tmp")
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(items[start:start + chunk_size], f)
+                os.replace(tmp_path, self._path(CHUNKS_DIR, f"{chunk}.json"))
+            _create_exclusive(self._path(READY_FILE), str(len(items)))
+            print(f"🔹 Queued {len(items)} items in {len(self.chunks())} chunks of {chunk_size}")
+            return
+        while not os.path.exists(self._path(READY_FILE)):
+            time.sleep(poll_seconds)
+
+    def chunks(self):
+        return sorted(name[:-len('.json')] for name in os.listdir(self._path(CHUNKS_DIR))
+                      if name.endswith('.json') and not name.startswith('.'))
+
+    def done_chunks(self):
+        return sorted(name[:-len('.json')] for name in os.listdir(self._path(DONE_DIR)) if name.endswith('.json'))
+
+    def all_done(self):
+        return set(self.chunks()) <= set(self.done_chunks())
+
+    def load_items(self, chunk):
+        with open(self._path(CHUNKS_DIR, f"{chunk}.json"), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def result_folder(self, chunk):
+        return self._path(RESULTS_DIR, f"{chunk}.{self.worker_id}")
+
+    def completed_results(self):
+        results = []
+        for chunk in self.done_chunks():
+            with open(self._path(DONE_DIR, f"{chunk}.json"), 'r', encoding='utf-8') as f:
+                results.append(self._path(RESULTS_DIR, json.load(f)['result_folder']))
+        return results
+
+    def acquire(self):
+        """Lease the next unfinished chunk, stealing expired leases; None when nothing is left."""
+        done = set(self.done_chunks())
+        for chunk in self.chunks():
+            if chunk in done:
+                continue
+            lease_path = self._path(LEASES_DIR, f"{chunk}.lease")
+            if _create_exclusive(lease_path, self.worker_id):
+                return chunk
+            try:
+                expired = time.time() - os.path.getmtime(lease_path) > self.lease_seconds
+            except FileNotFoundError:
+                expired = True
+            if not expired:
+                continue
+            # Renaming is atomic, so only one worker can retire an expired lease.
+            retired_path = f"{lease_path}.expired.{self.worker_id}"
+            try:
+                os.rename(lease_path, retired_path)
+            except FileNotFoundError:
+                continue
+            if time.time() - os.path.getmtime(retired_path) <= self.lease_seconds:
+                # Another worker re-leased the chunk in the meantime; hand it back.
+                os.rename(retired_path, lease_path)
+                continue
+            os.remove(retired_path)
+            if os.path.exists(self._path(DONE_DIR, f"{chunk}.json")):
+                continue
+            if _create_exclusive(lease_path, self.worker_id):
+                print(f"⚠️ Took over expired lease on chunk {chunk}")
+                return chunk
+        return None
+
+    def owns(self, chunk):
+        try:
+            with open(self._path(LEASES_DIR, f"{chunk}.lease"), 'r', encoding='utf-8') as f:
+                return f.read() == self.worker_id
+        except FileNotFoundError:
+            return False
+
+    def heartbeat(self, chunk):
+        if self.owns(chunk):
+            os.utime(self._path(LEASES_DIR, f"{chunk}.lease"))
+
+    def complete(self, chunk, result_folder):
+        """Record the result of a chunk; False if another worker finished it first."""
+        recorded = _create_exclusive(
+            self._path(DONE_DIR, f"{chunk}.json"),
+            json.dumps({'worker_id': self.worker_id, 'result_folder': os.path.basename(result_folder)}))
+        if self.owns(chunk):
+            os.remove(self._path(LEASES_DIR, f"{chunk}.lease"))
+        return recorded